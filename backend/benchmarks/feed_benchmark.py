@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+ストリームフィードのベンチマーク
+
+ページサイズとリアクション数を変えながら
+GET /api/streams/{stream_id}/announcements を呼び出し、
+1リクエストあたりのクエリ数とp95レイテンシを計測する。
+
+Run with: python -m benchmarks.feed_benchmark
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+
+from src.auth import get_current_user
+from src.database import get_async_session
+from src.main import app
+from src.models import (
+    Announcement,
+    AnnouncementReaction,
+    Stream,
+    StreamMembership,
+    StreamRole,
+    User,
+)
+from src.reaction_counters import rebuild_reaction_counts
+
+PAGE_SIZES = [10, 50, 100]
+REACTIONS_PER_ANNOUNCEMENT = [0, 10, 50]
+REACTION_TYPES = ["like", "read", "important"]
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+async def seed(session_factory, page_size: int, reactions: int) -> tuple[User, str]:
+    """ベンチマーク用のストリーム・お知らせ・リアクションを作成"""
+    async with session_factory() as session:
+        viewer = User(email=f"viewer-{page_size}-{reactions}@example.com", name="閲覧者")
+        readers = [
+            User(email=f"reader-{page_size}-{reactions}-{i}@example.com", name=f"生徒{i}")
+            for i in range(reactions)
+        ]
+        session.add(viewer)
+        session.add_all(readers)
+        await session.flush()
+
+        stream = Stream(name="全校", created_by=viewer.id)
+        session.add(stream)
+        await session.flush()
+        session.add(
+            StreamMembership(
+                user_id=viewer.id, stream_id=stream.id, role=StreamRole.STUDENT
+            )
+        )
+
+        now = datetime.utcnow()
+        for i in range(page_size):
+            announcement = Announcement(
+                title=f"お知らせ{i}",
+                content="明日は全校集会があります。",
+                stream_id=stream.id,
+                created_by=readers[i % len(readers)].id if readers else viewer.id,
+                created_at=now - timedelta(minutes=i),
+            )
+            session.add(announcement)
+            await session.flush()
+            session.add_all(
+                AnnouncementReaction(
+                    announcement_id=announcement.id,
+                    user_id=reader.id,
+                    reaction_type=REACTION_TYPES[j % len(REACTION_TYPES)],
+                )
+                for j, reader in enumerate(readers)
+            )
+
+        await session.flush()
+        await rebuild_reaction_counts(session)
+        await session.commit()
+        return viewer, stream.id
+
+
+async def run(iterations: int):
+    db_path = os.path.join(tempfile.mkdtemp(), "feed_benchmark.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+    session_factory = sessionmaker(
+        bind=engine, class_=AsyncSession, expire_on_commit=False
+    )
+    counter = QueryCounter(engine)
+
+    async def override_session():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_async_session] = override_session
+
+    print(
+        f"{'page_size':>9} {'reactions':>9} {'queries':>8} {'p50 ms':>8} {'p95 ms':>8}"
+    )
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        for page_size in PAGE_SIZES:
+            for reactions in REACTIONS_PER_ANNOUNCEMENT:
+                viewer, stream_id = await seed(session_factory, page_size, reactions)
+                app.dependency_overrides[get_current_user] = lambda: viewer
+
+                url = f"/api/streams/{stream_id}/announcements"
+                params = {"limit": page_size}
+                await client.get(url, params=params)  # ウォームアップ
+
+                timings = []
+                queries = []
+                for _ in range(iterations):
+                    before = counter.count
+                    started = time.perf_counter()
+                    response = await client.get(url, params=params)
+                    timings.append((time.perf_counter() - started) * 1000)
+                    queries.append(counter.count - before)
+                    response.raise_for_status()
+
+                p95 = statistics.quantiles(timings, n=20)[-1]
+                print(
+                    f"{page_size:>9} {reactions:>9} {max(queries):>8} "
+                    f"{statistics.median(timings):>8.2f} {p95:>8.2f}"
+                )
+
+    app.dependency_overrides.clear()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args.iterations))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+フィードキャッシュのベンチマーク
+
+同時接続数を変えながら GET /api/streams/{stream_id}/announcements の
+先頭ページを呼び出し、キャッシュなし・ありのレイテンシとヒット率を比較する。
+
+Run with: python -m benchmarks.feed_cache_benchmark --backend local
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+
+from benchmarks.feed_benchmark import seed
+from src.auth import get_current_user
+from src.database import get_async_session
+from src.feed_cache import LocalFeedCacheStore, RedisFeedCacheStore, feed_cache
+from src.main import app
+from src.metrics import metrics
+
+CONCURRENCY = [1, 10, 50]
+PAGE_SIZE = 20
+REACTIONS = 30
+PAGE_PARAMS = {"limit": PAGE_SIZE}
+
+
+async def measure(
+    client, url: str, concurrency: int, requests: int, params=PAGE_PARAMS
+):
+    timings = []
+
+    async def worker(count: int):
+        for _ in range(count):
+            started = time.perf_counter()
+            response = await client.get(url, params=params)
+            timings.append((time.perf_counter() - started) * 1000)
+            response.raise_for_status()
+
+    per_worker = max(1, requests // concurrency)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(per_worker) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return timings, len(timings) / elapsed
+
+
+async def run(backend: str, requests: int):
+    db_path = os.path.join(tempfile.mkdtemp(), "feed_cache_benchmark.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+    session_factory = sessionmaker(
+        bind=engine, class_=AsyncSession, expire_on_commit=False
+    )
+
+    async def override_session():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_async_session] = override_session
+
+    viewer, stream_id = await seed(session_factory, PAGE_SIZE, REACTIONS)
+    app.dependency_overrides[get_current_user] = lambda: viewer
+    url = f"/api/streams/{stream_id}/announcements"
+
+    stores = {
+        "none": None,
+        "local": LocalFeedCacheStore(),
+        "redis": RedisFeedCacheStore(),
+    }
+    modes = ["none", backend]
+
+    print(
+        f"{'cache':>6} {'clients':>7} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'req/s':>8} {'hit %':>6}"
+    )
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        for mode in modes:
+            feed_cache.store = stores[mode]
+            for concurrency in CONCURRENCY:
+                await feed_cache.invalidate_stream(stream_id)
+                await client.get(url, params={"limit": PAGE_SIZE})  # ウォームアップ
+                metrics.reset()
+
+                timings, throughput = await measure(client, url, concurrency, requests)
+
+                lookups = metrics.get("feed_cache.hit") + metrics.get("feed_cache.miss")
+                hit_ratio = (
+                    100 * metrics.get("feed_cache.hit") / lookups if lookups else 0
+                )
+                p95 = statistics.quantiles(timings, n=20)[-1]
+                print(
+                    f"{mode:>6} {concurrency:>7} {statistics.median(timings):>8.2f} "
+                    f"{p95:>8.2f} {throughput:>8.1f} {hit_ratio:>6.1f}"
+                )
+
+    app.dependency_overrides.clear()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backend", choices=["local", "redis"], default="redis")
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args.backend, args.requests))
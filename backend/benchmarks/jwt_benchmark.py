@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+JWT の検証のマイクロベンチマーク
+
+python-jose と PyJWT でアクセストークンの署名・検証1回あたりの時間を測り、
+検証済みペイロードのキャッシュに当たった場合（SHA-256 の計算と辞書の参照）と
+比較する。
+
+Run with: python -m benchmarks.jwt_benchmark
+"""
+import argparse
+import timeit
+from datetime import datetime, timedelta
+
+from src.auth import JWT_ALGORITHM, JWT_SECRET_KEY
+from src.jwt_backend import JoseBackend, PyJWTBackend, VerifiedTokenCache
+
+PAYLOAD = {
+    "sub": "0f8e7d6c-5b4a-3928-1706-f5e4d3c2b1a0",
+    "email": "student@example.com",
+    "role": "student",
+}
+
+
+def per_call_us(func, number: int) -> float:
+    # 3回測って最速の値を使う
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def run(number: int):
+    payload = {**PAYLOAD, "exp": datetime.utcnow() + timedelta(minutes=30)}
+    print(f"{'backend':>8} {'encode us':>10} {'decode us':>10} {'cached us':>10}")
+    for backend in (JoseBackend(), PyJWTBackend()):
+        token = backend.encode(payload, JWT_SECRET_KEY, JWT_ALGORITHM)
+        cache = VerifiedTokenCache()
+        cache.set(token, backend.decode(token, JWT_SECRET_KEY, JWT_ALGORITHM))
+
+        encode = per_call_us(
+            lambda: backend.encode(payload, JWT_SECRET_KEY, JWT_ALGORITHM), number
+        )
+        decode = per_call_us(
+            lambda: backend.decode(token, JWT_SECRET_KEY, JWT_ALGORITHM), number
+        )
+        cached = per_call_us(lambda: cache.get(token), number)
+        print(f"{backend.name:>8} {encode:>10.1f} {decode:>10.1f} {cached:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+    run(args.number)
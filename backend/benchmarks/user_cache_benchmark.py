@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+ユーザーキャッシュのベンチマーク
+
+実際のアクセストークンで GET /api/auth/me を呼び出し（get_current_user は
+差し替えない）、キャッシュなし・ありのスループットとヒット率を比較する。
+
+Run with: python -m benchmarks.user_cache_benchmark --backend local
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+
+import httpx
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+
+from benchmarks.feed_cache_benchmark import measure
+from src import auth
+from src.auth import auth_manager
+from src.database import get_async_session
+from src.main import app
+from src.metrics import metrics
+from src.models import User
+from src.user_cache import create_user_cache
+
+CONCURRENCY = [1, 10, 50]
+URL = "/api/auth/me"
+
+
+async def run(backend: str, requests: int):
+    db_path = os.path.join(tempfile.mkdtemp(), "user_cache_benchmark.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+    session_factory = sessionmaker(
+        bind=engine, class_=AsyncSession, expire_on_commit=False
+    )
+
+    async def override_session():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_async_session] = override_session
+
+    async with session_factory() as session:
+        user = User(email="bench@example.com", name="ベンチマーク", grade=1)
+        session.add(user)
+        await session.commit()
+    token = auth_manager.create_access_token(data={"sub": user.id})
+
+    print(
+        f"{'cache':>6} {'clients':>7} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'req/s':>8} {'hit %':>6}"
+    )
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport,
+        base_url="http://bench",
+        headers={"Authorization": f"Bearer {token}"},
+    ) as client:
+        for mode in ["none", backend]:
+            auth.user_cache = create_user_cache(mode)
+            for concurrency in CONCURRENCY:
+                await auth.user_cache.invalidate(user.id)
+                await client.get(URL)  # ウォームアップ
+                metrics.reset()
+
+                timings, throughput = await measure(
+                    client, URL, concurrency, requests, params=None
+                )
+
+                hits = metrics.get("user_cache.local_hit") + metrics.get(
+                    "user_cache.redis_hit"
+                )
+                lookups = hits + metrics.get("user_cache.miss")
+                hit_ratio = 100 * hits / lookups if lookups else 0
+                p95 = statistics.quantiles(timings, n=20)[-1]
+                print(
+                    f"{mode:>6} {concurrency:>7} {statistics.median(timings):>8.2f} "
+                    f"{p95:>8.2f} {throughput:>8.1f} {hit_ratio:>6.1f}"
+                )
+
+    app.dependency_overrides.clear()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backend", choices=["local", "redis"], default="redis")
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(run(args.backend, args.requests))
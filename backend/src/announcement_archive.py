@@ -0,0 +1,176 @@
+"""
+お知らせの一括削除と年度単位のアーカイブ
+
+削除は関連テーブルごとに announcement_id の IN で1文ずつ発行する集合演算で行う。
+新しく作成したテーブルには ON DELETE CASCADE を付けているが、既存の SQLite の
+テーブルには後から外部キーを追加できないため、子行も明示的に削除する。
+
+保持期間を過ぎたお知らせ（ピン留めを除く）は INSERT ... SELECT で
+*_archive テーブルへ移し、フィードのインデックスを現年度分だけに保つ。
+"""
+import os
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+from sqlalchemy import delete, literal, select
+
+from .announcement_tags import delete_announcement_tags
+from .announcement_targets import delete_announcement_targets
+from .database import task_sessions
+from .feed_cache import FeedCache, RedisFeedCacheStore, feed_cache
+from .models import (
+    Announcement,
+    AnnouncementReaction,
+    AnnouncementTag,
+    AnnouncementTargetClass,
+    AnnouncementTargetGrade,
+    ArchivedAnnouncement,
+    ArchivedAnnouncementReaction,
+    ArchivedAnnouncementTag,
+    ArchivedAnnouncementTargetClass,
+    ArchivedAnnouncementTargetGrade,
+)
+from .reaction_counters import delete_reaction_counts
+from .read_state import delete_read_marks
+from .redis_client import create_task_redis
+
+# 年度の開始月（日本の学校は4月）
+ACADEMIC_YEAR_START_MONTH = int(os.getenv("ACADEMIC_YEAR_START_MONTH", "4"))
+# 現年度に加えて残す過去の年度数（0 なら前年度以前をすべてアーカイブ）
+ANNOUNCEMENT_RETENTION_YEARS = int(os.getenv("ANNOUNCEMENT_RETENTION_YEARS", "1"))
+ARCHIVE_BATCH_SIZE = 500
+
+ANNOUNCEMENT_COLUMNS = [c.name for c in Announcement.__table__.columns]
+
+# (live テーブル, archive テーブル) の組。お知らせ本体の後にコピーする
+ARCHIVED_CHILD_TABLES = (
+    (AnnouncementReaction, ArchivedAnnouncementReaction),
+    (AnnouncementTargetGrade, ArchivedAnnouncementTargetGrade),
+    (AnnouncementTargetClass, ArchivedAnnouncementTargetClass),
+    (AnnouncementTag, ArchivedAnnouncementTag),
+)
+
+
+def academic_year_start(now: datetime) -> datetime:
+    """now が属する年度の開始日時"""
+    year = now.year if now.month >= ACADEMIC_YEAR_START_MONTH else now.year - 1
+    return datetime(year, ACADEMIC_YEAR_START_MONTH, 1)
+
+
+def archive_cutoff(
+    now: Optional[datetime] = None, retention_years: Optional[int] = None
+) -> datetime:
+    """これより前に投稿されたお知らせをアーカイブする境界"""
+    if retention_years is None:
+        retention_years = ANNOUNCEMENT_RETENTION_YEARS
+    start = academic_year_start(now or datetime.utcnow())
+    return start.replace(year=start.year - retention_years)
+
+
+async def delete_announcements(session, announcement_ids: Sequence[str]):
+    """お知らせと関連する行を、件数に依存しない固定回数の文で削除"""
+    if not announcement_ids:
+        return
+
+    # タグ件数の減算はお知らせの stream_id を参照するため本体より先に行う
+    await delete_announcement_tags(session, announcement_ids)
+    await delete_announcement_targets(session, announcement_ids)
+    await delete_reaction_counts(session, announcement_ids)
+    await delete_read_marks(session, announcement_ids)
+    await session.execute(
+        delete(AnnouncementReaction).where(
+            AnnouncementReaction.announcement_id.in_(announcement_ids)
+        )
+    )
+    await session.execute(
+        delete(Announcement).where(Announcement.id.in_(announcement_ids))
+    )
+
+
+async def _copy_rows(session, source, target, announcement_ids: List[str]):
+    columns = [c.name for c in source.__table__.columns]
+    rows = select(*[source.__table__.c[name] for name in columns]).where(
+        source.announcement_id.in_(announcement_ids)
+    )
+    await session.execute(target.__table__.insert().from_select(columns, rows))
+
+
+async def archive_announcements(
+    session, cutoff: datetime, batch_size: int = ARCHIVE_BATCH_SIZE
+) -> List[str]:
+    """cutoff より前のお知らせを1バッチ分アーカイブし、移動した ID を返す
+
+    既読の例外とリアクション数は現年度のフィード用なので移さずに削除する。
+    検索インデックスの文書は残し、検索で include_archive を指定したときに使う。
+    """
+    result = await session.execute(
+        select(Announcement.id)
+        .where(Announcement.created_at < cutoff, Announcement.is_pinned.is_(False))
+        .order_by(Announcement.created_at, Announcement.id)
+        .limit(batch_size)
+    )
+    announcement_ids = list(result.scalars().all())
+    if not announcement_ids:
+        return []
+
+    archived_at = datetime.utcnow()
+    rows = select(
+        *[Announcement.__table__.c[name] for name in ANNOUNCEMENT_COLUMNS],
+        literal(archived_at).label("archived_at"),
+    ).where(Announcement.id.in_(announcement_ids))
+    await session.execute(
+        ArchivedAnnouncement.__table__.insert().from_select(
+            ANNOUNCEMENT_COLUMNS + ["archived_at"], rows
+        )
+    )
+    for source, target in ARCHIVED_CHILD_TABLES:
+        await _copy_rows(session, source, target, announcement_ids)
+
+    await delete_announcements(session, announcement_ids)
+    return announcement_ids
+
+
+async def archive_old_announcements(
+    now: Optional[datetime] = None, batch_size: int = ARCHIVE_BATCH_SIZE
+) -> dict:
+    """保持期間を過ぎたお知らせをバッチごとにコミットしながらアーカイブ
+
+    Celery のタスクから asyncio.run で呼ぶため、タスク用のエンジンを使う。
+    """
+    cutoff = archive_cutoff(now)
+    async with task_sessions() as sessions:
+        async with sessions() as session:
+            streams = await session.execute(
+                select(Announcement.stream_id)
+                .where(
+                    Announcement.created_at < cutoff,
+                    Announcement.is_pinned.is_(False),
+                )
+                .distinct()
+            )
+            stream_ids = list(streams.scalars().all())
+
+        archived = 0
+        while True:
+            async with sessions() as session:
+                announcement_ids = await archive_announcements(
+                    session, cutoff, batch_size
+                )
+                await session.commit()
+            archived += len(announcement_ids)
+            if len(announcement_ids) < batch_size:
+                break
+
+    # 共有の Redis クライアントも前のタスクのイベントループに結び付いているため使わない
+    client = None
+    cache = feed_cache
+    if isinstance(feed_cache.store, RedisFeedCacheStore):
+        client = create_task_redis()
+        cache = FeedCache(RedisFeedCacheStore(client))
+    try:
+        for stream_id in stream_ids:
+            await cache.invalidate_stream(stream_id)
+    finally:
+        if client is not None:
+            await client.aclose()
+    return {"cutoff": cutoff.isoformat(), "archived": archived}
@@ -0,0 +1,238 @@
+"""
+お知らせのタグ
+
+タグは tags / announcement_tags に正規化し、タグの完全一致・前方一致による
+絞り込みを (tag_id, announcement_id) の転置インデックスで行う。
+ストリームごとのタグ別件数は stream_tag_counts に書き込み時に加減算し、
+ファセットの取得で全件を走査しないようにする。
+"""
+import json
+import unicodedata
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence
+from uuid import uuid4
+
+from sqlalchemy import delete, exists, func, insert, select
+
+from .database import async_engine, dialect_insert
+from .models import Announcement, AnnouncementTag, StreamTagCount, Tag
+
+MAX_TAG_LENGTH = 50
+
+
+def normalize_tag(name: str) -> str:
+    return unicodedata.normalize("NFKC", name).strip()[:MAX_TAG_LENGTH]
+
+
+def normalize_tags(names: Iterable[str]) -> List[str]:
+    """正規化して重複と空文字を除く（順序は保持）"""
+    tags = []
+    for name in names:
+        tag = normalize_tag(str(name))
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+@dataclass(frozen=True)
+class TagFilter:
+    """タグの完全一致・前方一致による絞り込み"""
+
+    exact: Optional[str] = None
+    prefix: Optional[str] = None
+
+    @classmethod
+    def from_params(
+        cls, tag: Optional[str], tag_prefix: Optional[str]
+    ) -> Optional["TagFilter"]:
+        exact = normalize_tag(tag) if tag else None
+        prefix = normalize_tag(tag_prefix) if tag_prefix else None
+        if not exact and not prefix:
+            return None
+        return cls(exact or None, prefix or None)
+
+    def condition(self, announcement_id=Announcement.id, tag_table=AnnouncementTag):
+        """お知らせに条件に合うタグが付いているか（相関サブクエリ）"""
+        conditions = [tag_table.announcement_id == announcement_id]
+        if self.exact:
+            conditions.append(Tag.name == self.exact)
+        if self.prefix:
+            conditions.append(Tag.name.startswith(self.prefix, autoescape=True))
+        return exists().where(tag_table.tag_id == Tag.id, *conditions)
+
+    def cache_key(self) -> list:
+        return [self.exact, self.prefix]
+
+
+async def ensure_tags(session, names: Sequence[str]) -> Dict[str, str]:
+    """タグ名から ID を取得（存在しないタグは作成）"""
+    if not names:
+        return {}
+    statement = (
+        dialect_insert(session, Tag)
+        .values([{"id": str(uuid4()), "name": name} for name in names])
+        .on_conflict_do_nothing(index_elements=["name"])
+    )
+    await session.execute(statement)
+    result = await session.execute(select(Tag.name, Tag.id).where(Tag.name.in_(names)))
+    return dict(result.all())
+
+
+async def _apply_tag_count_deltas(
+    session, stream_id: str, tag_ids: Iterable[str], delta: int
+):
+    await _upsert_tag_counts(
+        session,
+        [
+            {"stream_id": stream_id, "tag_id": tag_id, "count": delta}
+            for tag_id in tag_ids
+        ],
+    )
+
+
+async def _upsert_tag_counts(session, values: List[dict]):
+    if not values:
+        return
+    statement = dialect_insert(session, StreamTagCount).values(values)
+    statement = statement.on_conflict_do_update(
+        index_elements=["stream_id", "tag_id"],
+        set_={"count": StreamTagCount.count + statement.excluded.count},
+    )
+    await session.execute(statement)
+
+
+async def _load_tag_ids(session, announcement_id: str) -> set:
+    result = await session.execute(
+        select(AnnouncementTag.tag_id).where(
+            AnnouncementTag.announcement_id == announcement_id
+        )
+    )
+    return set(result.scalars().all())
+
+
+async def set_announcement_tags(
+    session, announcement: Announcement, names: Optional[Iterable[str]]
+):
+    """タグを置き換え、差分だけ件数を加減算する（None の場合は変更しない）
+
+    お知らせは flush 済みであること。
+    """
+    if names is None:
+        return
+    tags = normalize_tags(names)
+    announcement.tags = json.dumps(tags, ensure_ascii=False) if tags else None
+
+    tag_ids = set((await ensure_tags(session, tags)).values())
+    current = await _load_tag_ids(session, announcement.id)
+    added = tag_ids - current
+    removed = current - tag_ids
+
+    if removed:
+        await session.execute(
+            delete(AnnouncementTag).where(
+                AnnouncementTag.announcement_id == announcement.id,
+                AnnouncementTag.tag_id.in_(removed),
+            )
+        )
+        await _apply_tag_count_deltas(session, announcement.stream_id, removed, -1)
+    if added:
+        await session.execute(
+            insert(AnnouncementTag),
+            [{"announcement_id": announcement.id, "tag_id": t} for t in added],
+        )
+        await _apply_tag_count_deltas(session, announcement.stream_id, added, 1)
+
+
+async def delete_announcement_tags(session, announcement_ids: Sequence[str]):
+    """お知らせのタグの対応を削除し、ストリームごとの件数をまとめて減算"""
+    removed = await session.execute(
+        select(Announcement.stream_id, AnnouncementTag.tag_id, func.count())
+        .join(Announcement, Announcement.id == AnnouncementTag.announcement_id)
+        .where(AnnouncementTag.announcement_id.in_(announcement_ids))
+        .group_by(Announcement.stream_id, AnnouncementTag.tag_id)
+    )
+    await _upsert_tag_counts(
+        session,
+        [
+            {"stream_id": stream_id, "tag_id": tag_id, "count": -count}
+            for stream_id, tag_id, count in removed.all()
+        ],
+    )
+    await session.execute(
+        delete(AnnouncementTag).where(
+            AnnouncementTag.announcement_id.in_(announcement_ids)
+        )
+    )
+
+
+async def load_tag_facets(
+    session, stream_id: str, prefix: Optional[str] = None, limit: int = 50
+) -> List[dict]:
+    """ストリームのタグ別件数（件数の多い順）"""
+    statement = (
+        select(Tag.name, StreamTagCount.count)
+        .join(Tag, Tag.id == StreamTagCount.tag_id)
+        .where(StreamTagCount.stream_id == stream_id, StreamTagCount.count > 0)
+    )
+    if prefix:
+        statement = statement.where(
+            Tag.name.startswith(normalize_tag(prefix), autoescape=True)
+        )
+    statement = statement.order_by(StreamTagCount.count.desc(), Tag.name).limit(limit)
+    result = await session.execute(statement)
+    return [{"tag": name, "count": count} for name, count in result.all()]
+
+
+async def rebuild_announcement_tags(conn):
+    """JSON 列からタグ・対応・件数を作り直す"""
+    await conn.execute(delete(StreamTagCount))
+    await conn.execute(delete(AnnouncementTag))
+
+    result = await conn.execute(
+        select(Announcement.id, Announcement.tags).where(Announcement.tags.is_not(None))
+    )
+    pairs = []
+    for announcement_id, tags in result.all():
+        try:
+            names = normalize_tags(json.loads(tags))
+        except (TypeError, ValueError):
+            print(f"お知らせ {announcement_id} のタグを読み込めませんでした")
+            continue
+        pairs.extend((announcement_id, name) for name in names)
+
+    if not pairs:
+        return
+    tag_ids = await ensure_tags(conn, sorted({name for _, name in pairs}))
+    await conn.execute(
+        insert(AnnouncementTag),
+        [
+            {"announcement_id": announcement_id, "tag_id": tag_ids[name]}
+            for announcement_id, name in pairs
+        ],
+    )
+
+    counts = (
+        select(
+            Announcement.stream_id,
+            AnnouncementTag.tag_id,
+            func.count(),
+        )
+        .join(Announcement, Announcement.id == AnnouncementTag.announcement_id)
+        .group_by(Announcement.stream_id, AnnouncementTag.tag_id)
+    )
+    await conn.execute(
+        insert(StreamTagCount).from_select(["stream_id", "tag_id", "count"], counts)
+    )
+
+
+async def init_announcement_tags():
+    """タグの対応が未作成で、タグ付きのお知らせが存在する場合は移行"""
+    async with async_engine.begin() as conn:
+        has_rows = await conn.execute(select(AnnouncementTag.announcement_id).limit(1))
+        if has_rows.first() is not None:
+            return
+        has_tags = await conn.execute(
+            select(Announcement.id).where(Announcement.tags.is_not(None)).limit(1)
+        )
+        if has_tags.first() is not None:
+            await rebuild_announcement_tags(conn)
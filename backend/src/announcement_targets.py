@@ -0,0 +1,251 @@
+"""
+お知らせの対象学年・クラス
+
+対象は announcement_target_grades / announcement_target_classes に正規化して保持し、
+フィード・検索・未読数の集計で閲覧者の学年・クラスによる絞り込みを SQL 側で行う。
+
+- 対象学年の行がなければ全学年、あれば閲覧者の学年が含まれる場合のみ表示
+- 対象クラスも同様で、両方指定された場合は両方を満たすときに表示
+- 教員・管理者と、ストリームの管理者は対象に関わらずすべて表示
+"""
+import json
+from dataclasses import dataclass
+from typing import Iterable, List, Mapping, Optional, Sequence, Tuple
+
+from sqlalchemy import and_, delete, exists, insert, or_, select, update
+
+from .database import async_engine
+from .models import (
+    Announcement,
+    AnnouncementTargetClass,
+    AnnouncementTargetGrade,
+    StreamMembership,
+    StreamRole,
+    User,
+    UserRole,
+)
+
+UNRESTRICTED_USER_ROLES = {UserRole.TEACHER, UserRole.ADMIN, UserRole.SUPER_ADMIN}
+UNRESTRICTED_STREAM_ROLES = {StreamRole.STREAM_ADMIN, StreamRole.ADMIN}
+
+
+@dataclass(frozen=True)
+class Audience:
+    """絞り込みが必要な閲覧者の学年・クラス"""
+
+    grade: Optional[int]
+    class_name: Optional[str]
+    # 管理者として参加しているストリーム（そのストリームでは絞り込まない）
+    unrestricted_stream_ids: Tuple[str, ...] = ()
+
+    def cache_key(self) -> list:
+        return [self.grade, self.class_name, sorted(self.unrestricted_stream_ids)]
+
+
+def audience_for(
+    user: User, memberships: Sequence[StreamMembership]
+) -> Optional[Audience]:
+    """閲覧者の絞り込み条件。すべて表示してよい場合は None"""
+    return audience_for_roles(user, {m.stream_id: m.role for m in memberships})
+
+
+def audience_for_roles(
+    user: User, roles: Mapping[str, StreamRole]
+) -> Optional[Audience]:
+    """audience_for の {stream_id: role} 版"""
+    if user.role in UNRESTRICTED_USER_ROLES:
+        return None
+    unrestricted = tuple(
+        stream_id
+        for stream_id, role in roles.items()
+        if role in UNRESTRICTED_STREAM_ROLES
+    )
+    if roles and len(unrestricted) == len(roles):
+        return None
+    return Audience(user.grade, user.class_name, unrestricted)
+
+
+def audience_condition(
+    audience: Audience,
+    announcement_id=Announcement.id,
+    stream_id=Announcement.stream_id,
+    grade_table=AnnouncementTargetGrade,
+    class_table=AnnouncementTargetClass,
+):
+    """閲覧者に表示するお知らせの条件（相関サブクエリ）
+
+    grade_table / class_table にアーカイブ側のテーブルを渡すと、
+    アーカイブ済みのお知らせにも同じ条件を適用できる。
+    """
+    grade_targets = grade_table.announcement_id == announcement_id
+    class_targets = class_table.announcement_id == announcement_id
+
+    condition = and_(
+        or_(
+            ~exists().where(grade_targets),
+            exists().where(grade_targets, grade_table.grade == audience.grade),
+        ),
+        or_(
+            ~exists().where(class_targets),
+            exists().where(
+                class_targets, class_table.class_name == audience.class_name
+            ),
+        ),
+    )
+    if audience.unrestricted_stream_ids:
+        condition = or_(stream_id.in_(audience.unrestricted_stream_ids), condition)
+    return condition
+
+
+def announcement_targets(announcement: Announcement) -> dict:
+    """お知らせの対象学年・クラス（リアルタイム配信の絞り込み用）"""
+    return {
+        "grades": json.loads(announcement.target_grades or "[]"),
+        "classes": json.loads(announcement.target_classes or "[]"),
+    }
+
+
+def is_visible_to(audience: Optional[Audience], stream_id: str, targets: dict) -> bool:
+    """audience_condition と同じ判定を announcement_targets の値に対して行う"""
+    if audience is None or stream_id in audience.unrestricted_stream_ids:
+        return True
+    grades = targets.get("grades") or []
+    classes = targets.get("classes") or []
+    return (not grades or audience.grade in grades) and (
+        not classes or audience.class_name in classes
+    )
+
+
+def membership_visibility_condition(user: User):
+    """StreamMembership と相関させる表示条件（ストリーム一覧の未読数用）"""
+    if user.role in UNRESTRICTED_USER_ROLES:
+        return None
+    return or_(
+        StreamMembership.role.in_(UNRESTRICTED_STREAM_ROLES),
+        audience_condition(Audience(user.grade, user.class_name)),
+    )
+
+
+def _normalize_grades(grades: Iterable) -> List[int]:
+    return sorted({int(grade) for grade in grades})
+
+
+def _normalize_classes(classes: Iterable) -> List[str]:
+    return sorted({str(class_name) for class_name in classes if class_name})
+
+
+async def set_announcement_targets(
+    session,
+    announcement: Announcement,
+    grades: Optional[Iterable[int]] = None,
+    classes: Optional[Iterable[str]] = None,
+):
+    """対象学年・クラスを置き換える（None の項目は変更しない）
+
+    お知らせは flush 済みであること。
+    """
+    if grades is not None:
+        grades = _normalize_grades(grades)
+        announcement.target_grades = json.dumps(grades) if grades else None
+        await session.execute(
+            delete(AnnouncementTargetGrade).where(
+                AnnouncementTargetGrade.announcement_id == announcement.id
+            )
+        )
+        if grades:
+            await session.execute(
+                insert(AnnouncementTargetGrade),
+                [{"announcement_id": announcement.id, "grade": g} for g in grades],
+            )
+
+    if classes is not None:
+        classes = _normalize_classes(classes)
+        announcement.target_classes = (
+            json.dumps(classes, ensure_ascii=False) if classes else None
+        )
+        await session.execute(
+            delete(AnnouncementTargetClass).where(
+                AnnouncementTargetClass.announcement_id == announcement.id
+            )
+        )
+        if classes:
+            await session.execute(
+                insert(AnnouncementTargetClass),
+                [
+                    {"announcement_id": announcement.id, "class_name": c}
+                    for c in classes
+                ],
+            )
+
+
+async def delete_announcement_targets(session, announcement_ids: Sequence[str]):
+    for table in (AnnouncementTargetGrade, AnnouncementTargetClass):
+        await session.execute(
+            delete(table).where(table.announcement_id.in_(announcement_ids))
+        )
+
+
+async def rebuild_announcement_targets(conn):
+    """JSON 列から対象学年・クラスの行を作り直す"""
+    await conn.execute(delete(AnnouncementTargetGrade))
+    await conn.execute(delete(AnnouncementTargetClass))
+
+    result = await conn.execute(
+        select(
+            Announcement.id, Announcement.target_grades, Announcement.target_classes
+        ).where(
+            or_(
+                Announcement.target_grades.is_not(None),
+                Announcement.target_classes.is_not(None),
+            )
+        )
+    )
+    grade_rows, class_rows, untargeted = [], [], []
+    for announcement_id, target_grades, target_classes in result.all():
+        try:
+            grades = _normalize_grades(json.loads(target_grades or "[]"))
+            classes = _normalize_classes(json.loads(target_classes or "[]"))
+        except (TypeError, ValueError):
+            print(f"お知らせ {announcement_id} の対象を読み込めませんでした")
+            continue
+        grade_rows.extend(
+            {"announcement_id": announcement_id, "grade": g} for g in grades
+        )
+        class_rows.extend(
+            {"announcement_id": announcement_id, "class_name": c} for c in classes
+        )
+        if not grades and not classes:
+            untargeted.append(announcement_id)
+
+    if grade_rows:
+        await conn.execute(insert(AnnouncementTargetGrade), grade_rows)
+    if class_rows:
+        await conn.execute(insert(AnnouncementTargetClass), class_rows)
+    if untargeted:
+        # 空配列 "[]" は対象なしとして揃える
+        await conn.execute(
+            update(Announcement)
+            .where(Announcement.id.in_(untargeted))
+            .values(target_grades=None, target_classes=None)
+        )
+
+
+async def init_announcement_targets():
+    """対象の行が未作成で、JSON 列に対象が保存されている場合は移行"""
+    async with async_engine.begin() as conn:
+        for table in (AnnouncementTargetGrade, AnnouncementTargetClass):
+            has_rows = await conn.execute(select(table.announcement_id).limit(1))
+            if has_rows.first() is not None:
+                return
+        has_targets = await conn.execute(
+            select(Announcement.id)
+            .where(
+                or_(
+                    Announcement.target_grades.is_not(None),
+                    Announcement.target_classes.is_not(None),
+                )
+            )
+            .limit(1)
+        )
+        if has_targets.first() is not None:
+            await rebuild_announcement_targets(conn)
@@ -0,0 +1,142 @@
+"""
+添付ファイルの保存先
+
+ファイルは内容の SHA-256 をキーに保存し、同じ PDF を複数のストリームに
+投稿しても実体は1つだけにする。アップロードはリクエスト本文を一定サイズごとに
+一時ファイルへ書き出しながらハッシュを計算し、ファイル全体をメモリに載せない。
+"""
+import hashlib
+import os
+import re
+import tempfile
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+ATTACHMENT_STORE_BACKEND = os.getenv("ATTACHMENT_STORE_BACKEND", "local")
+ATTACHMENT_STORAGE_DIR = os.getenv("ATTACHMENT_STORAGE_DIR", "./data/attachments")
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(50 * 1024 * 1024)))
+# 一時ファイルへ書き出す単位（受信したチャンクをこのサイズまでまとめる）
+ATTACHMENT_WRITE_CHUNK_SIZE = 1024 * 1024
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class AttachmentTooLarge(Exception):
+    """アップロードが上限サイズを超えた"""
+
+
+@dataclass(frozen=True)
+class StoredBlob:
+    sha256: str
+    size: int
+
+
+class AttachmentStore(ABC):
+    """添付ファイルの保存先の共通インターフェース"""
+
+    @abstractmethod
+    async def save(
+        self, chunks: AsyncIterator[bytes], max_bytes: int = ATTACHMENT_MAX_BYTES
+    ) -> StoredBlob:
+        """チャンクを順に保存し、内容の SHA-256 とサイズを返す"""
+
+    @abstractmethod
+    async def exists(self, sha256: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def delete(self, sha256: str):
+        pass
+
+    def local_path(self, sha256: str) -> Optional[Path]:
+        """ローカルに実体がある場合はそのパス（sendfile での配信に使う）"""
+        return None
+
+
+class _HashingWriter:
+    """一時ファイルへの書き込みとハッシュ計算（スレッドプールで実行）"""
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def write(self, data: bytes):
+        self.digest.update(data)
+        self.file.write(data)
+
+
+class LocalAttachmentStore(AttachmentStore):
+    """ローカルファイルシステムの保存先
+
+    <root>/ab/cd/<sha256> に保存する。一時ファイルを同じファイルシステム上に
+    作成して os.replace で配置するため、同じ内容の同時アップロードがあっても
+    途中の状態のファイルが見えることはない。
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.tmp_dir = self.root / "tmp"
+
+    def path_for(self, sha256: str) -> Path:
+        if not SHA256_PATTERN.match(sha256):
+            raise ValueError("Invalid sha256")
+        return self.root / sha256[:2] / sha256[2:4] / sha256
+
+    async def save(
+        self, chunks: AsyncIterator[bytes], max_bytes: int = ATTACHMENT_MAX_BYTES
+    ) -> StoredBlob:
+        await run_in_threadpool(self.tmp_dir.mkdir, parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                writer = _HashingWriter(file)
+                size = 0
+                buffer = bytearray()
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise AttachmentTooLarge()
+                    buffer += chunk
+                    if len(buffer) >= ATTACHMENT_WRITE_CHUNK_SIZE:
+                        await run_in_threadpool(writer.write, bytes(buffer))
+                        buffer.clear()
+                if buffer:
+                    await run_in_threadpool(writer.write, bytes(buffer))
+
+            sha256 = writer.digest.hexdigest()
+            await run_in_threadpool(self._place, tmp_name, self.path_for(sha256))
+            return StoredBlob(sha256=sha256, size=size)
+        finally:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+    @staticmethod
+    def _place(tmp_name: str, path: Path):
+        if path.exists():
+            # 同じ内容がすでに保存されている
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_name, path)
+
+    async def exists(self, sha256: str) -> bool:
+        return await run_in_threadpool(self.path_for(sha256).exists)
+
+    async def delete(self, sha256: str):
+        path = self.path_for(sha256)
+        await run_in_threadpool(path.unlink, missing_ok=True)
+
+    def local_path(self, sha256: str) -> Optional[Path]:
+        return self.path_for(sha256)
+
+
+def create_attachment_store(backend: str) -> AttachmentStore:
+    if backend == "local":
+        return LocalAttachmentStore(ATTACHMENT_STORAGE_DIR)
+    raise ValueError(f"Unknown attachment store backend: {backend}")
+
+
+attachment_store = create_attachment_store(ATTACHMENT_STORE_BACKEND)
@@ -1,17 +1,26 @@
 import os
+import time
 from datetime import datetime, timedelta
 from typing import Optional
 
-from authlib.integrations.httpx_client import AsyncOAuth2Client
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from jose import JWTError, jwt
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import Session, select
 
+from . import server_timing
 from .database import get_async_session
-from .models import StreamMembership, StreamRole, User
+from .google_oauth import GoogleOAuthClient
+from .jwt_backend import InvalidTokenError, jwt_backend, verified_token_cache
+from .membership_resolver import (
+    STREAM_ROLE_CLAIMS,
+    StreamRoles,
+    resolve_stream_roles,
+    roles_from_claims,
+)
+from .models import StreamRole, User
+from .user_cache import user_cache
 
 # .envファイルを読み込み
 load_dotenv()
@@ -30,12 +39,15 @@ GOOGLE_REDIRECT_URI = os.getenv(
 )
 
 security = HTTPBearer()
+# get_current_user を差し替えた場合でも失敗しないよう、トークンは任意で受け取る
+optional_security = HTTPBearer(auto_error=False)
 
 
 class AuthManager:
     def __init__(self):
-        self.google_client = AsyncOAuth2Client(
-            GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, scope="openid email profile"
+        # リクエストごとの状態を持たないため、全リクエストで共有できる
+        self.google = GoogleOAuthClient(
+            GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REDIRECT_URI
         )
 
     def create_access_token(
@@ -47,46 +59,45 @@ class AuthManager:
         else:
             expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         to_encode.update({"exp": expire})
-        encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+        encoded_jwt = jwt_backend.encode(to_encode, JWT_SECRET_KEY, JWT_ALGORITHM)
         return encoded_jwt
 
     def create_refresh_token(self, data: dict):
         to_encode = data.copy()
         expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
         to_encode.update({"exp": expire})
-        encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+        encoded_jwt = jwt_backend.encode(to_encode, JWT_SECRET_KEY, JWT_ALGORITHM)
         return encoded_jwt
 
     def verify_token(self, token: str):
+        """検証済みのペイロードを返す（キャッシュにあれば署名の検証を省略）
+
+        処理時間は Server-Timing の jwt 項目に記録する。
+        """
+        started = time.perf_counter()
         try:
-            payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-            return payload
-        except JWTError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token"
-            )
+            payload = verified_token_cache.get(token)
+            if payload is None:
+                try:
+                    payload = jwt_backend.decode(token, JWT_SECRET_KEY, JWT_ALGORITHM)
+                except InvalidTokenError:
+                    raise HTTPException(
+                        status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token"
+                    )
+                verified_token_cache.set(token, payload)
+            return dict(payload)
+        finally:
+            server_timing.record("jwt", time.perf_counter() - started)
 
     def get_google_auth_url(self):
-        authorization_url, state = self.google_client.create_authorization_url(
-            "https://accounts.google.com/o/oauth2/auth",
-            redirect_uri=GOOGLE_REDIRECT_URI,
-        )
-        return authorization_url
+        return self.google.authorization_url()
 
     async def exchange_code_for_token(self, code: str):
-        token = await self.google_client.fetch_token(
-            "https://oauth2.googleapis.com/token",
-            code=code,
-            redirect_uri=GOOGLE_REDIRECT_URI,
-        )
-        return token
+        return await self.google.exchange_code(code)
 
-    async def get_user_info(self, access_token: str):
-        self.google_client.token = {"access_token": access_token}
-        resp = await self.google_client.get(
-            "https://www.googleapis.com/oauth2/v2/userinfo"
-        )
-        return resp.json()
+    async def get_user_info(self, token: dict):
+        """id_token をローカルで検証してユーザー情報を取り出す（/userinfo は呼ばない）"""
+        return await self.google.get_user_info(token)
 
 
 auth_manager = AuthManager()
@@ -96,7 +107,15 @@ async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     session: AsyncSession = Depends(get_async_session),
 ) -> User:
-    token = credentials.credentials
+    """トークンの検証からユーザーの取得までを Server-Timing の auth 項目に記録する"""
+    started = time.perf_counter()
+    try:
+        return await _load_current_user(credentials.credentials, session)
+    finally:
+        server_timing.record("auth", time.perf_counter() - started)
+
+
+async def _load_current_user(token: str, session: AsyncSession) -> User:
     payload = auth_manager.verify_token(token)
     user_id = payload.get("sub")
 
@@ -106,6 +125,11 @@ async def get_current_user(
             detail="Invalid authentication credentials",
         )
 
+    cached = await user_cache.get(user_id)
+    if cached is not None:
+        # SELECT を発行せずにセッションに結び付け、そのまま更新もできるようにする
+        return await session.merge(cached, load=False)
+
     statement = select(User).where(User.id == user_id)
     result = await session.execute(statement)
     user = result.scalars().first()
@@ -115,6 +139,7 @@ async def get_current_user(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found"
         )
 
+    await user_cache.set(user)
     return user
 
 
@@ -146,20 +171,32 @@ async def get_current_super_admin(
     return current_user
 
 
+async def get_stream_roles(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+) -> StreamRoles:
+    """現在のユーザーのストリームごとのロール
+
+    依存関係はリクエスト内でキャッシュされるため、require_stream_role と
+    ルーターの両方で使っても解決は1回だけ行われる。
+    トークンに最新のロールのクレームがあれば、データベースを参照しない。
+    """
+    if STREAM_ROLE_CLAIMS and credentials is not None:
+        payload = auth_manager.verify_token(credentials.credentials)
+        if payload.get("sub") == current_user.id:
+            roles = await roles_from_claims(current_user.id, payload)
+            if roles is not None:
+                return roles
+    return await resolve_stream_roles(session, current_user.id)
+
+
 async def get_stream_role(
     user_id: str, stream_id: str, session: AsyncSession = Depends(get_async_session)
 ) -> Optional[StreamRole]:
     """Get user's role in a specific stream"""
-    statement = select(StreamMembership).where(
-        (StreamMembership.user_id == user_id)
-        & (StreamMembership.stream_id == stream_id)
-    )
-    result = await session.execute(statement)
-    membership = result.scalars().first()
-
-    if membership:
-        return membership.role
-    return None
+    roles = await resolve_stream_roles(session, user_id)
+    return roles.role_in(stream_id)
 
 
 def require_stream_role(allowed_roles: set[str]):
@@ -168,17 +205,12 @@ def require_stream_role(allowed_roles: set[str]):
     async def check_stream_role(
         stream_id: str,
         current_user: User = Depends(get_current_user),
-        session: AsyncSession = Depends(get_async_session),
+        stream_roles: StreamRoles = Depends(get_stream_roles),
     ):
         # Get user's stream role
-        user_role = await get_stream_role(current_user.id, stream_id, session)
+        user_role = stream_roles.require_member(stream_id)
 
         # Check if user has required role
-        if user_role is None:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN, detail="このストリームへのアクセス権限がありません"
-            )
-
         if user_role not in allowed_roles:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN, detail="この操作を実行する権限がありません"
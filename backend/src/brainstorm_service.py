@@ -81,16 +81,6 @@ class BrainstormSession:
         if state != "open":
             raise HTTPException(status_code=400, detail="Session not in open state")
 
-        # Rate limiting check
-        rate_key = f"session:{session_id}:rate:{user_id}"
-        current_rate = await self.redis.get(rate_key) or 0
-        if int(current_rate) >= 3:
-            raise HTTPException(status_code=429, detail="Rate limit exceeded")
-
-        # Increment rate counter
-        await self.redis.incr(rate_key)
-        await self.redis.expire(rate_key, 30)
-
         # Get anonymous ID
         anon_id = await self._get_redis_value(f"session:{session_id}:anon:{user_id}")
         if not anon_id:
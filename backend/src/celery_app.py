@@ -19,6 +19,10 @@ app.conf.update(
             "task": "src.tasks.send_assignment_reminders",
             "schedule": crontab(hour=7, minute=0),  # Every day at 07:00
         },
+        "archive-old-announcements": {
+            "task": "src.tasks.archive_old_announcements",
+            "schedule": crontab(hour=3, minute=30),  # Every day at 03:30
+        },
     },
 )
 
@@ -1,7 +1,12 @@
 import os
+from contextlib import asynccontextmanager
 
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from sqlmodel import Session, SQLModel, create_engine
 
 DATABASE_URL = os.getenv(
@@ -19,6 +24,18 @@ else:
     sync_database_url = DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://")
 sync_engine = create_engine(sync_database_url, echo=True)
 
+
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite は接続ごとに外部キー制約 (ON DELETE CASCADE を含む) を有効化する"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+if DATABASE_URL.startswith("sqlite"):
+    event.listen(async_engine.sync_engine, "connect", _enable_sqlite_foreign_keys)
+    event.listen(sync_engine, "connect", _enable_sqlite_foreign_keys)
+
 # Session makers
 AsyncSessionLocal = sessionmaker(
     bind=async_engine, class_=AsyncSession, expire_on_commit=False
@@ -27,6 +44,31 @@ AsyncSessionLocal = sessionmaker(
 SessionLocal = sessionmaker(bind=sync_engine, autocommit=False, autoflush=False)
 
 
+@asynccontextmanager
+async def task_sessions():
+    """Celery のタスク用のセッションファクトリ
+
+    タスクは asyncio.run で実行ごとに新しいイベントループを使うため、
+    async_engine のプールの接続（前のループに結び付いている）は使わない。
+    タスクごとに NullPool のエンジンを作り、終了時に破棄する。
+    """
+    engine = create_async_engine(DATABASE_URL, poolclass=NullPool)
+    if DATABASE_URL.startswith("sqlite"):
+        event.listen(engine.sync_engine, "connect", _enable_sqlite_foreign_keys)
+    try:
+        yield sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    finally:
+        await engine.dispose()
+
+
+def dialect_insert(executor, table):
+    """ON CONFLICT 句が使えるデータベース方言別の INSERT を返す"""
+    dialect = getattr(executor, "dialect", None) or executor.bind.dialect
+    if dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
 async def get_async_session():
     async with AsyncSessionLocal() as session:
         try:
@@ -43,6 +85,68 @@ def get_sync_session():
             session.close()
 
 
+# 既存のテーブルに後から追加した列（create_all は既存のテーブルに列を追加しない）
+ADDED_COLUMNS = {
+    "attachments": ["stream_id"],
+    "stream_memberships": ["last_read_at", "last_read_id", "ordinal"],
+    "streams": ["next_member_ordinal"],
+    "users": ["sample_data_seeded_at"],
+}
+
+
+def add_missing_columns(connection):
+    """ADDED_COLUMNS のうち既存のテーブルにない列を ALTER TABLE で追加
+
+    追加する列はすべて NULL を許し、既定値を持たない。何度実行してもよい。
+    """
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    for table_name, column_names in ADDED_COLUMNS.items():
+        if not inspector.has_table(table_name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table_name)}
+        table = SQLModel.metadata.tables[table_name]
+        for name in column_names:
+            if name in existing:
+                continue
+            column = table.c[name]
+            definition = (
+                f"{preparer.quote(name)} "
+                f"{column.type.compile(dialect=connection.dialect)}"
+            )
+            for foreign_key in column.foreign_keys:
+                definition += (
+                    f" REFERENCES {preparer.quote(foreign_key.column.table.name)}"
+                    f" ({preparer.quote(foreign_key.column.name)})"
+                )
+            connection.exec_driver_sql(
+                f"ALTER TABLE {preparer.quote(table_name)} ADD COLUMN {definition}"
+            )
+            print(f"{table_name}.{name} 列を追加しました")
+
+
+def create_missing_indexes(connection):
+    """既存テーブルに後から追加されたインデックスを作成
+
+    既存の重複データのために一意インデックスを作成できない場合は、
+    起動は続けて python -m src.deduplicate での整理を促す
+    （起動時にデータを削除することはしない）。それ以外の失敗はそのまま送出する。
+    """
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                with connection.begin_nested():
+                    index.create(connection, checkfirst=True)
+            except IntegrityError as e:
+                print(
+                    f"インデックス {index.name} を作成できませんでした"
+                    f"（python -m src.deduplicate で重複を整理してください）: {e}"
+                )
+
+
 async def init_db():
     async with async_engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
+        # インデックスやデータの移行より先に、後から追加した列を揃える
+        await conn.run_sync(add_missing_columns)
+        await conn.run_sync(create_missing_indexes)
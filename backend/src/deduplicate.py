@@ -0,0 +1,55 @@
+"""
+重複したメンバーシップ・リアクションの整理
+
+(user_id, stream_id) と (announcement_id, user_id, reaction_type) の
+一意インデックスを作成する前に、既存のデータベースで手動で1回実行する。
+起動時には実行しない（init_db は重複があるとインデックスの作成を見送る）。
+
+    python -m src.deduplicate          # 重複の件数を表示するだけ
+    python -m src.deduplicate --apply  # 整理してインデックスを作成
+"""
+import asyncio
+import sys
+
+from sqlalchemy import func, select
+
+from .database import async_engine, create_missing_indexes
+from .models import AnnouncementReaction, StreamMembership
+from .reactions import remove_duplicate_reactions
+from .stream_members import merge_duplicate_memberships
+
+
+async def count_duplicates(conn, *columns) -> int:
+    groups = (
+        select((func.count() - 1).label("extra"))
+        .group_by(*columns)
+        .having(func.count() > 1)
+        .subquery()
+    )
+    result = await conn.execute(select(func.coalesce(func.sum(groups.c.extra), 0)))
+    return result.scalar_one()
+
+
+async def main(apply: bool):
+    async with async_engine.begin() as conn:
+        memberships = await count_duplicates(
+            conn, StreamMembership.user_id, StreamMembership.stream_id
+        )
+        reactions = await count_duplicates(
+            conn,
+            AnnouncementReaction.announcement_id,
+            AnnouncementReaction.user_id,
+            AnnouncementReaction.reaction_type,
+        )
+        print(f"重複したメンバーシップ: {memberships} 件 / リアクション: {reactions} 件")
+        if not apply:
+            return
+
+        await merge_duplicate_memberships(conn)
+        await remove_duplicate_reactions(conn)
+        await conn.run_sync(create_missing_indexes)
+        print("重複を整理し、インデックスを作成しました")
+
+
+if __name__ == "__main__":
+    asyncio.run(main("--apply" in sys.argv[1:]))
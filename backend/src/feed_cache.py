@@ -0,0 +1,174 @@
+"""
+ストリームフィードのレスポンスキャッシュ
+
+フィードのページはユーザー自身のリアクション・既読状態以外は全メンバーで同じなので、
+共通部分をシリアライズ済みの JSON として (stream_id, カーソル・ページング条件) ごとに
+キャッシュし、ユーザーごとの部分はリクエストのたびに重ねる。
+
+キャッシュキーにはストリームのバージョン番号を含め、お知らせの作成・更新・削除や
+リアクションのたびにバージョンを上げることで古いページを一括で無効化する。
+古いバージョンのページは TTL で消える。
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from .metrics import metrics
+from .redis_client import get_redis
+
+FEED_CACHE_BACKEND = os.getenv("FEED_CACHE_BACKEND", "redis")
+FEED_CACHE_TTL_SECONDS = int(os.getenv("FEED_CACHE_TTL_SECONDS", "60"))
+LOCAL_FEED_CACHE_MAX_PAGES = 1000
+
+
+def version_key(stream_id: str) -> str:
+    return f"feed:version:{stream_id}"
+
+
+def page_key(stream_id: str, version: int, params: dict) -> str:
+    digest = hashlib.sha1(
+        json.dumps(params, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+    return f"feed:page:{stream_id}:{version}:{digest}"
+
+
+class FeedCacheStore:
+    """バージョン番号とページ本体の保存先"""
+
+    async def get_version(self, stream_id: str) -> int:
+        raise NotImplementedError
+
+    async def bump_version(self, stream_id: str):
+        raise NotImplementedError
+
+    async def get_page(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set_page(self, key: str, body: str):
+        raise NotImplementedError
+
+
+class RedisFeedCacheStore(FeedCacheStore):
+    """全ワーカーで共有する Redis のキャッシュ
+
+    client を渡さなければ API プロセスの共有クライアントを使う。
+    """
+
+    def __init__(self, client=None):
+        self.client = client
+
+    def _redis(self):
+        return self.client if self.client is not None else get_redis()
+
+    async def get_version(self, stream_id: str) -> int:
+        version = await self._redis().get(version_key(stream_id))
+        return int(version) if version is not None else 0
+
+    async def bump_version(self, stream_id: str):
+        await self._redis().incr(version_key(stream_id))
+
+    async def get_page(self, key: str) -> Optional[str]:
+        body = await self._redis().get(key)
+        return body.decode() if isinstance(body, bytes) else body
+
+    async def set_page(self, key: str, body: str):
+        await self._redis().set(key, body, ex=FEED_CACHE_TTL_SECONDS)
+
+
+class LocalFeedCacheStore(FeedCacheStore):
+    """Redis なしで動かす開発・テスト用のプロセス内キャッシュ"""
+
+    def __init__(self, max_pages: int = LOCAL_FEED_CACHE_MAX_PAGES):
+        self.max_pages = max_pages
+        self.versions: Dict[str, int] = {}
+        self.pages: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    async def get_version(self, stream_id: str) -> int:
+        return self.versions.get(stream_id, 0)
+
+    async def bump_version(self, stream_id: str):
+        self.versions[stream_id] = self.versions.get(stream_id, 0) + 1
+
+    async def get_page(self, key: str) -> Optional[str]:
+        entry = self.pages.get(key)
+        if entry is None:
+            return None
+        expires_at, body = entry
+        if expires_at < time.monotonic():
+            del self.pages[key]
+            return None
+        self.pages.move_to_end(key)
+        return body
+
+    async def set_page(self, key: str, body: str):
+        self.pages[key] = (time.monotonic() + FEED_CACHE_TTL_SECONDS, body)
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+
+
+class FeedCache:
+    """フィードページのキャッシュ。保存先の障害時はキャッシュなしで動作する"""
+
+    def __init__(self, store: Optional[FeedCacheStore]):
+        self.store = store
+
+    async def get_page(
+        self, stream_id: str, params: dict
+    ) -> Tuple[Optional[int], Optional[dict]]:
+        """(バージョン, ページ) を返す。バージョンが None の場合は保存しない"""
+        if self.store is None:
+            return None, None
+        try:
+            version = await self.store.get_version(stream_id)
+            body = await self.store.get_page(page_key(stream_id, version, params))
+        except Exception as e:
+            metrics.incr("feed_cache.error")
+            print(f"フィードキャッシュの取得に失敗しました: {e}")
+            return None, None
+
+        if body is None:
+            metrics.incr("feed_cache.miss")
+            return version, None
+        metrics.incr("feed_cache.hit")
+        return version, json.loads(body)
+
+    async def set_page(
+        self, stream_id: str, version: Optional[int], params: dict, page: dict
+    ):
+        """page は jsonable_encoder 済みの辞書"""
+        if self.store is None or version is None:
+            return
+        try:
+            await self.store.set_page(
+                page_key(stream_id, version, params),
+                json.dumps(page, ensure_ascii=False, separators=(",", ":")),
+            )
+        except Exception as e:
+            metrics.incr("feed_cache.error")
+            print(f"フィードキャッシュの保存に失敗しました: {e}")
+
+    async def invalidate_stream(self, stream_id: str):
+        """コミット後に呼び出し、ストリームのキャッシュ済みページを無効化する"""
+        if self.store is None:
+            return
+        try:
+            await self.store.bump_version(stream_id)
+            metrics.incr("feed_cache.invalidate")
+        except Exception as e:
+            metrics.incr("feed_cache.error")
+            print(f"フィードキャッシュの無効化に失敗しました: {e}")
+
+
+def create_feed_cache(backend: str) -> FeedCache:
+    if backend == "redis":
+        return FeedCache(RedisFeedCacheStore())
+    if backend == "local":
+        return FeedCache(LocalFeedCacheStore())
+    return FeedCache(None)
+
+
+feed_cache = create_feed_cache(FEED_CACHE_BACKEND)
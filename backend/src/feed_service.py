@@ -0,0 +1,296 @@
+"""
+ストリームフィードの組み立て
+
+お知らせ1ページ分の作成者・ユーザーのリアクション・リアクション集計を
+ページ単位でまとめて取得し、お知らせ件数に依存しない固定回数のクエリで
+レスポンスを組み立てる。
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import tuple_, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import and_, select
+
+from .models import Announcement, AnnouncementReaction, StreamMembership, User
+from .reaction_counters import load_reaction_counts
+from .read_state import READ_REACTION, load_read_map_for
+
+
+class FeedKey(NamedTuple):
+    """既読判定に必要なお知らせのキー（キャッシュ済みのページからも復元できる）"""
+
+    id: str
+    created_at: datetime
+
+
+FEED_ORDER = (
+    Announcement.is_pinned.desc(),  # ピン留め優先
+    Announcement.created_at.desc(),
+    Announcement.id.desc(),
+)
+
+
+def encode_cursor(key: list) -> str:
+    """並び順のキーから不透明なカーソル（base64url の JSON）を生成"""
+    raw = json.dumps(key, separators=(",", ":"), ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    """カーソルを並び順のキーに復元。不正な場合は ValueError"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(key, list) or len(key) != size:
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def encode_feed_cursor(announcement: Announcement) -> str:
+    """フィードの並び順 (is_pinned, created_at, id) から不透明なカーソルを生成"""
+    return encode_cursor(
+        [
+            int(announcement.is_pinned),
+            announcement.created_at.isoformat(),
+            announcement.id,
+        ]
+    )
+
+
+def decode_feed_cursor(cursor: str) -> Tuple[bool, datetime, str]:
+    """カーソルを (is_pinned, created_at, id) に復元。不正な場合は ValueError"""
+    is_pinned, created_at, announcement_id = decode_cursor(cursor, 3)
+    try:
+        return bool(is_pinned), datetime.fromisoformat(created_at), str(announcement_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+TIMELINE_ORDER = (Announcement.created_at.desc(), Announcement.id.desc())
+
+
+def encode_timeline_cursor(announcement: Announcement) -> str:
+    """タイムラインの並び順 (created_at, id) から不透明なカーソルを生成"""
+    return encode_cursor([announcement.created_at.isoformat(), announcement.id])
+
+
+def timeline_keyset_condition(cursor: str):
+    """カーソル位置より古いお知らせを絞り込む条件。不正な場合は ValueError"""
+    created_at, announcement_id = decode_cursor(cursor, 2)
+    try:
+        created_at = datetime.fromisoformat(created_at)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+    return tuple_(Announcement.created_at, Announcement.id) < tuple_(
+        created_at, str(announcement_id)
+    )
+
+
+def timeline_statement(stream_ids: Sequence[str], conditions: list, limit: int):
+    """複数ストリームのお知らせを新しい順に limit 件取得するクエリ
+
+    ストリームごとに (stream_id, created_at, id) のインデックスを逆順に走査して
+    先頭 limit 件ずつを取り出し、それらを UNION ALL でまとめて並べ替える
+    （k-way マージ）。1回のクエリで、読む行数はストリーム数 × limit に収まる。
+    """
+    branches = [
+        select(Announcement.id, Announcement.created_at)
+        .where(Announcement.stream_id == stream_id, *conditions)
+        .order_by(*TIMELINE_ORDER)
+        .limit(limit)
+        .subquery()
+        for stream_id in stream_ids
+    ]
+    merged = union_all(*[select(b.c.id, b.c.created_at) for b in branches]).subquery()
+    return (
+        select(Announcement)
+        .join(merged, merged.c.id == Announcement.id)
+        .order_by(merged.c.created_at.desc(), merged.c.id.desc())
+        .limit(limit)
+    )
+
+
+def feed_keyset_condition(cursor: str):
+    """カーソル位置より後ろのお知らせを絞り込む条件 (キーセットページネーション)"""
+    is_pinned, created_at, announcement_id = decode_feed_cursor(cursor)
+    return tuple_(
+        Announcement.is_pinned, Announcement.created_at, Announcement.id
+    ) < tuple_(is_pinned, created_at, announcement_id)
+
+
+async def load_creators(
+    session: AsyncSession, announcements: Sequence[Announcement]
+) -> Dict[str, User]:
+    """ページ内の作成者をまとめて取得"""
+    creator_ids = {a.created_by for a in announcements}
+    if not creator_ids:
+        return {}
+
+    statement = select(User).where(User.id.in_(creator_ids))
+    result = await session.execute(statement)
+    return {user.id: user for user in result.scalars().all()}
+
+
+async def load_user_reactions(
+    session: AsyncSession, announcement_ids: Sequence[str], user_id: str
+) -> Dict[str, List[str]]:
+    """ページ内のお知らせに対するユーザー自身のリアクションを取得"""
+    if not announcement_ids:
+        return {}
+
+    statement = select(
+        AnnouncementReaction.announcement_id, AnnouncementReaction.reaction_type
+    ).where(
+        and_(
+            AnnouncementReaction.announcement_id.in_(announcement_ids),
+            AnnouncementReaction.user_id == user_id,
+        )
+    )
+    result = await session.execute(statement)
+
+    user_reactions: Dict[str, List[str]] = {}
+    for announcement_id, reaction_type in result.all():
+        user_reactions.setdefault(announcement_id, []).append(reaction_type)
+    return user_reactions
+
+
+def serialize_announcement(
+    announcement: Announcement,
+    creator: Optional[User] = None,
+    user_reactions: Optional[List[str]] = None,
+    reaction_counts: Optional[Dict[str, int]] = None,
+) -> dict:
+    """お知らせをフィード用の辞書に変換"""
+    return {
+        "id": announcement.id,
+        "title": announcement.title,
+        "content": announcement.content,
+        "announcement_type": announcement.announcement_type,
+        "is_urgent": announcement.is_urgent,
+        "is_pinned": announcement.is_pinned,
+        "tags": json.loads(announcement.tags) if announcement.tags else [],
+        "attachments": json.loads(announcement.attachments)
+        if announcement.attachments
+        else [],
+        "creator": {
+            "id": creator.id,
+            "name": creator.name,
+            "picture_url": creator.picture_url,
+        }
+        if creator
+        else None,
+        "user_reactions": user_reactions or [],
+        "reaction_counts": reaction_counts or {},
+        "created_at": announcement.created_at,
+        "updated_at": announcement.updated_at,
+    }
+
+
+async def build_shared_feed(
+    session: AsyncSession, announcements: Sequence[Announcement]
+) -> List[dict]:
+    """全メンバー共通の部分（作成者・リアクション数）だけでページを組み立てる"""
+    announcement_ids = [a.id for a in announcements]
+
+    creators = await load_creators(session, announcements)
+    reaction_counts = await load_reaction_counts(session, announcement_ids)
+
+    return [
+        serialize_announcement(
+            announcement,
+            creator=creators.get(announcement.created_by),
+            reaction_counts=reaction_counts.get(announcement.id),
+        )
+        for announcement in announcements
+    ]
+
+
+def feed_keys(feed: Sequence[dict]) -> List[FeedKey]:
+    keys = []
+    for item in feed:
+        created_at = item["created_at"]
+        if isinstance(created_at, str):
+            created_at = datetime.fromisoformat(created_at)
+        keys.append(FeedKey(item["id"], created_at))
+    return keys
+
+
+async def apply_user_overlay(
+    session: AsyncSession,
+    feed: List[dict],
+    user_id: str,
+    membership: Optional[StreamMembership] = None,
+) -> List[dict]:
+    """共通部分のページにユーザー自身のリアクションと既読状態を重ねる
+
+    ユーザーのリアクションの1回と、membership を渡した場合の既読状態の1回のみ。
+    """
+    keys = feed_keys(feed)
+    read_items = [(membership, key) for key in keys] if membership else []
+    return await _overlay(session, feed, keys, user_id, read_items)
+
+
+async def apply_timeline_overlay(
+    session: AsyncSession,
+    feed: List[dict],
+    user_id: str,
+    memberships: Dict[str, StreamMembership],
+) -> List[dict]:
+    """ストリームをまたぐページに、各ストリームのメンバーシップで既読状態を重ねる
+
+    フィードの各要素は "stream_id" を持つこと。クエリ数は apply_user_overlay と同じ。
+    """
+    keys = feed_keys(feed)
+    read_items = [
+        (memberships[item["stream_id"]], key)
+        for item, key in zip(feed, keys)
+        if item["stream_id"] in memberships
+    ]
+    return await _overlay(session, feed, keys, user_id, read_items)
+
+
+async def _overlay(
+    session: AsyncSession,
+    feed: List[dict],
+    keys: List[FeedKey],
+    user_id: str,
+    read_items: list,
+) -> List[dict]:
+    if not feed:
+        return feed
+
+    user_reactions = await load_user_reactions(session, [k.id for k in keys], user_id)
+
+    read_map = await load_read_map_for(session, read_items)
+    for announcement_id, is_read in read_map.items():
+        if is_read:
+            user_reactions.setdefault(announcement_id, []).append(READ_REACTION)
+
+    for item in feed:
+        item["user_reactions"] = user_reactions.get(item["id"], [])
+    return feed
+
+
+async def build_announcement_feed(
+    session: AsyncSession,
+    announcements: Sequence[Announcement],
+    user_id: str,
+    membership: Optional[StreamMembership] = None,
+) -> List[dict]:
+    """お知らせ1ページ分のフィードを組み立てる
+
+    ページサイズやリアクション数に関わらず、発行するクエリは
+    作成者・ユーザーのリアクション・リアクション数カウンターの3回と、
+    membership を渡した場合の既読状態の1回のみ。
+    """
+    if not announcements:
+        return []
+
+    feed = await build_shared_feed(session, announcements)
+    return await apply_user_overlay(session, feed, user_id, membership)
@@ -0,0 +1,259 @@
+"""
+Google の OAuth ログイン
+
+ワーカー内で1つの httpx クライアント（コネクションプール）を共有し、
+トークンなどのリクエストごとの状態はクライアントに持たせない。
+同時に複数のユーザーがログインしても互いのトークンは混ざらない。
+
+ユーザー情報は /userinfo を呼ばずに、トークンエンドポイントが返す
+id_token を JWKS の公開鍵でローカルに検証して取り出す。JWKS は
+Cache-Control の max-age（なければ GOOGLE_JWKS_CACHE_SECONDS）の間
+キャッシュし、未知の kid が来たら鍵のローテーションとみなして取り直す。
+
+Google への呼び出しにはタイムアウトを設け、タイムアウト・接続エラー・5xx が
+GOOGLE_OAUTH_BREAKER_FAILURES 回続いたらサーキットブレーカーを開いて
+GOOGLE_OAUTH_BREAKER_RESET_SECONDS の間は呼び出さずに失敗させる。
+"""
+import asyncio
+import os
+import re
+import secrets
+import time
+from typing import Dict, Optional
+from urllib.parse import urlencode
+
+import httpx
+from jose import JWTError, jwt
+
+from .metrics import metrics
+
+GOOGLE_AUTH_URL = os.getenv(
+    "GOOGLE_AUTH_URL", "https://accounts.google.com/o/oauth2/auth"
+)
+GOOGLE_TOKEN_URL = os.getenv("GOOGLE_TOKEN_URL", "https://oauth2.googleapis.com/token")
+GOOGLE_JWKS_URL = os.getenv(
+    "GOOGLE_JWKS_URL", "https://www.googleapis.com/oauth2/v3/certs"
+)
+GOOGLE_ISSUERS = os.getenv(
+    "GOOGLE_ISSUERS", "https://accounts.google.com,accounts.google.com"
+).split(",")
+
+GOOGLE_OAUTH_TIMEOUT_SECONDS = float(os.getenv("GOOGLE_OAUTH_TIMEOUT_SECONDS", "5"))
+GOOGLE_OAUTH_MAX_CONNECTIONS = int(os.getenv("GOOGLE_OAUTH_MAX_CONNECTIONS", "20"))
+GOOGLE_OAUTH_BREAKER_FAILURES = int(os.getenv("GOOGLE_OAUTH_BREAKER_FAILURES", "5"))
+GOOGLE_OAUTH_BREAKER_RESET_SECONDS = float(
+    os.getenv("GOOGLE_OAUTH_BREAKER_RESET_SECONDS", "30")
+)
+GOOGLE_JWKS_CACHE_SECONDS = int(os.getenv("GOOGLE_JWKS_CACHE_SECONDS", "3600"))
+# 未知の kid による JWKS の取り直しの最短間隔
+GOOGLE_JWKS_MIN_REFRESH_SECONDS = 60
+
+SCOPE = "openid email profile"
+ID_TOKEN_ALGORITHMS = ["RS256"]
+
+
+class GoogleOAuthError(Exception):
+    """認可コード・id_token が不正（ユーザー側の失敗）"""
+
+
+class GoogleOAuthUnavailableError(GoogleOAuthError):
+    """Google に接続できない、またはサーキットブレーカーが開いている"""
+
+
+class CircuitBreaker:
+    """連続した失敗で開き、一定時間後に1回だけ試行を許可する（半開）"""
+
+    def __init__(
+        self,
+        failure_threshold: int = GOOGLE_OAUTH_BREAKER_FAILURES,
+        reset_seconds: float = GOOGLE_OAUTH_BREAKER_RESET_SECONDS,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return False
+        # 半開: この試行の結果が出るまで他の呼び出しは止めておく
+        self.opened_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                metrics.incr("google_oauth.breaker_open")
+            self.opened_at = time.monotonic()
+
+
+def _max_age(response: httpx.Response) -> Optional[int]:
+    match = re.search(r"max-age=(\d+)", response.headers.get("cache-control", ""))
+    return int(match.group(1)) if match else None
+
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(GOOGLE_OAUTH_TIMEOUT_SECONDS),
+        limits=httpx.Limits(
+            max_connections=GOOGLE_OAUTH_MAX_CONNECTIONS,
+            max_keepalive_connections=GOOGLE_OAUTH_MAX_CONNECTIONS,
+        ),
+    )
+
+
+class GoogleOAuthClient:
+    """認可 URL の作成・認可コードの交換・id_token の検証"""
+
+    def __init__(
+        self,
+        client_id: Optional[str],
+        client_secret: Optional[str],
+        redirect_uri: str,
+        http_client: Optional[httpx.AsyncClient] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self._http_client = http_client
+        self.breaker = breaker or CircuitBreaker()
+        self._jwks: Dict[str, Dict] = {}
+        self._jwks_expires_at = 0.0
+        self._jwks_fetched_at: Optional[float] = None
+        self._jwks_lock = asyncio.Lock()
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        # イベントループの開始後に作るため、最初の呼び出しで生成する
+        if self._http_client is None:
+            self._http_client = create_http_client()
+        return self._http_client
+
+    async def aclose(self):
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+    def authorization_url(self) -> str:
+        params = {
+            "response_type": "code",
+            "client_id": self.client_id,
+            "redirect_uri": self.redirect_uri,
+            "scope": SCOPE,
+            "state": secrets.token_urlsafe(24),
+        }
+        return f"{GOOGLE_AUTH_URL}?{urlencode(params)}"
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """ブレーカーを通して呼び出す。4xx はそのまま返す"""
+        if not self.breaker.allow():
+            raise GoogleOAuthUnavailableError("Google の認証サービスに一時的に接続できません")
+        try:
+            response = await self.http_client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            self.breaker.record_failure()
+            metrics.incr("google_oauth.error")
+            raise GoogleOAuthUnavailableError(f"Google への接続に失敗しました: {e}") from e
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            metrics.incr("google_oauth.error")
+            raise GoogleOAuthUnavailableError(
+                f"Google がエラーを返しました: {response.status_code}"
+            )
+        self.breaker.record_success()
+        return response
+
+    async def exchange_code(self, code: str) -> Dict:
+        response = await self._request(
+            "POST",
+            GOOGLE_TOKEN_URL,
+            data={
+                "grant_type": "authorization_code",
+                "code": code,
+                "redirect_uri": self.redirect_uri,
+            },
+            auth=(self.client_id or "", self.client_secret or ""),
+        )
+        if response.status_code != 200:
+            raise GoogleOAuthError(f"認可コードを交換できませんでした: {response.text}")
+        token = response.json()
+        if "id_token" not in token:
+            raise GoogleOAuthError("id_token が含まれていません")
+        return token
+
+    async def _refresh_jwks(self, force: bool):
+        async with self._jwks_lock:
+            now = time.monotonic()
+            if not force and now < self._jwks_expires_at:
+                return
+            # 同時に未知の kid が来ても取り直しは1回にする
+            if (
+                force
+                and self._jwks_fetched_at is not None
+                and now - self._jwks_fetched_at < GOOGLE_JWKS_MIN_REFRESH_SECONDS
+            ):
+                return
+            response = await self._request("GET", GOOGLE_JWKS_URL)
+            if response.status_code != 200:
+                raise GoogleOAuthUnavailableError("JWKS を取得できませんでした")
+            metrics.incr("google_oauth.jwks_fetch")
+            self._jwks = {key["kid"]: key for key in response.json()["keys"]}
+            self._jwks_fetched_at = now
+            self._jwks_expires_at = now + (
+                _max_age(response) or GOOGLE_JWKS_CACHE_SECONDS
+            )
+
+    async def _signing_key(self, kid: Optional[str]) -> Dict:
+        await self._refresh_jwks(force=False)
+        if kid not in self._jwks:
+            await self._refresh_jwks(force=True)
+        key = self._jwks.get(kid)
+        if key is None:
+            raise GoogleOAuthError("id_token の署名鍵が見つかりません")
+        return key
+
+    async def verify_id_token(
+        self, id_token: str, access_token: Optional[str] = None
+    ) -> Dict:
+        """id_token の署名・aud・iss・exp（at_hash があれば access_token）を検証"""
+        try:
+            header = jwt.get_unverified_header(id_token)
+        except JWTError as e:
+            raise GoogleOAuthError(f"id_token が不正です: {e}") from e
+        key = await self._signing_key(header.get("kid"))
+        try:
+            return jwt.decode(
+                id_token,
+                key,
+                algorithms=ID_TOKEN_ALGORITHMS,
+                audience=self.client_id,
+                issuer=GOOGLE_ISSUERS,
+                access_token=access_token,
+            )
+        except JWTError as e:
+            raise GoogleOAuthError(f"id_token が不正です: {e}") from e
+
+    async def get_user_info(self, token: Dict) -> Dict:
+        """トークンエンドポイントの応答からユーザー情報（email・name・picture）を返す"""
+        claims = await self.verify_id_token(
+            token["id_token"], token.get("access_token")
+        )
+        if not claims.get("email") or not claims.get("email_verified"):
+            raise GoogleOAuthError("メールアドレスが確認されていません")
+        return {
+            "email": claims["email"],
+            "name": claims.get("name") or claims["email"],
+            "picture": claims.get("picture"),
+        }
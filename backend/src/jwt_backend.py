@@ -0,0 +1,133 @@
+"""
+JWT の署名・検証
+
+python-jose と PyJWT のどちらでも同じインターフェースで使えるようにし、
+JWT_BACKEND で切り替える（benchmarks/jwt_benchmark.py で比較できる）。
+
+検証済みのペイロードはトークンの SHA-256 をキーに、exp までプロセス内に
+キャッシュする（件数の上限を超えたら最も古く使われたものから捨てる）。
+同じトークンでの2回目以降のリクエストは署名の検証を省略できる。
+"""
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from .metrics import metrics
+
+JWT_BACKEND = os.getenv("JWT_BACKEND", "jose")
+JWT_CACHE_MAX_ENTRIES = int(os.getenv("JWT_CACHE_MAX_ENTRIES", "10000"))
+
+
+class InvalidTokenError(Exception):
+    """署名・形式・有効期限のいずれかが不正なトークン"""
+
+
+class JWTBackend:
+    """JWT ライブラリの共通インターフェース"""
+
+    name = ""
+
+    def encode(self, payload: dict, key: str, algorithm: str) -> str:
+        raise NotImplementedError
+
+    def decode(self, token: str, key: str, algorithm: str) -> dict:
+        """検証済みのペイロードを返す。不正なら InvalidTokenError"""
+        raise NotImplementedError
+
+
+class JoseBackend(JWTBackend):
+    name = "jose"
+
+    def __init__(self):
+        from jose import JWTError, jwt
+
+        self.jwt = jwt
+        self.error = JWTError
+
+    def encode(self, payload: dict, key: str, algorithm: str) -> str:
+        return self.jwt.encode(payload, key, algorithm=algorithm)
+
+    def decode(self, token: str, key: str, algorithm: str) -> dict:
+        try:
+            return self.jwt.decode(token, key, algorithms=[algorithm])
+        except self.error as e:
+            raise InvalidTokenError(str(e)) from e
+
+
+class PyJWTBackend(JWTBackend):
+    name = "pyjwt"
+
+    def __init__(self):
+        import jwt
+
+        self.jwt = jwt
+        self.error = jwt.PyJWTError
+
+    def encode(self, payload: dict, key: str, algorithm: str) -> str:
+        return self.jwt.encode(payload, key, algorithm=algorithm)
+
+    def decode(self, token: str, key: str, algorithm: str) -> dict:
+        try:
+            # python-jose と同じく sub の型は検証しない
+            return self.jwt.decode(
+                token, key, algorithms=[algorithm], options={"verify_sub": False}
+            )
+        except self.error as e:
+            raise InvalidTokenError(str(e)) from e
+
+
+def create_jwt_backend(backend: str) -> JWTBackend:
+    if backend == "jose":
+        return JoseBackend()
+    if backend == "pyjwt":
+        return PyJWTBackend()
+    raise ValueError(f"Unknown JWT backend: {backend}")
+
+
+class VerifiedTokenCache:
+    """検証済みペイロードのキャッシュ（exp を過ぎたものは使わない）"""
+
+    def __init__(self, max_entries: int = JWT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[bytes, Tuple[float, Dict]]" = OrderedDict()
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[Dict]:
+        if self.max_entries <= 0:
+            return None
+        key = self.digest(token)
+        entry = self.entries.get(key)
+        if entry is None:
+            metrics.incr("jwt_cache.miss")
+            return None
+        expires_at, payload = entry
+        if expires_at <= time.time():
+            del self.entries[key]
+            metrics.incr("jwt_cache.miss")
+            return None
+        self.entries.move_to_end(key)
+        metrics.incr("jwt_cache.hit")
+        return payload
+
+    def set(self, token: str, payload: Dict):
+        # exp のないトークンはいつまでも有効になるためキャッシュしない
+        exp = payload.get("exp")
+        if self.max_entries <= 0 or not isinstance(exp, (int, float)):
+            return
+        key = self.digest(token)
+        self.entries[key] = (float(exp), payload)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+jwt_backend = create_jwt_backend(JWT_BACKEND)
+verified_token_cache = VerifiedTokenCache()
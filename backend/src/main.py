@@ -5,8 +5,25 @@ from dotenv import load_dotenv
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from .announcement_tags import init_announcement_tags
+from .announcement_targets import init_announcement_targets
+from .auth import auth_manager
 from .database import init_db
-from .routers import assignments, auth, brainstorm, events, lost_items, profile, streams
+from .metrics import metrics
+from .reaction_counters import init_reaction_counts
+from .read_state import init_read_state
+from .routers import (
+    assignments,
+    attachments,
+    auth,
+    brainstorm,
+    events,
+    lost_items,
+    profile,
+    streams,
+)
+from .search_service import init_search_index
+from .server_timing import ServerTimingMiddleware
 
 # .envファイルを読み込み
 load_dotenv()
@@ -18,9 +35,14 @@ load_dotenv("/workspaces/CampusFlow/.env")
 async def lifespan(app: FastAPI):
     # Startup
     await init_db()
+    await init_search_index()
+    await init_reaction_counts()
+    await init_read_state()
+    await init_announcement_targets()
+    await init_announcement_tags()
     yield
     # Shutdown
-    pass
+    await auth_manager.google.aclose()
 
 
 app = FastAPI(
@@ -44,8 +66,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=[
+        "X-Next-Cursor",
+        "ETag",
+        "Content-Range",
+        "Accept-Ranges",
+        "Server-Timing",
+    ],
 )
 
+# トークンの検証などの処理時間を Server-Timing ヘッダーで返す
+app.add_middleware(ServerTimingMiddleware)
+
 # Include routers
 app.include_router(auth.router)
 app.include_router(assignments.router)
@@ -54,6 +86,7 @@ app.include_router(events.router)
 app.include_router(streams.router)
 app.include_router(profile.router)
 app.include_router(lost_items.router)
+app.include_router(attachments.router)
 
 
 @app.get("/")
@@ -64,3 +97,9 @@ async def root():
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """ワーカーごとのキャッシュヒット率などのメトリクス"""
+    return metrics.snapshot()
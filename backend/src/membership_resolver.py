@@ -0,0 +1,239 @@
+"""
+ユーザーのストリームごとのロールの解決
+
+認可に必要な {stream_id: role} をリクエストごとに1回だけ求め
+（auth.get_stream_roles を依存関係として共有する）、リクエストをまたいで
+Redis にキャッシュする。
+
+キャッシュキーにはユーザーごとのバージョン番号を含め、招待・一括登録・
+昇格などでメンバーシップが変わったらバージョンを上げて無効化する。
+バージョンはデータベースを読む前に取得するため、読み込み中に無効化されても
+古いロールが新しいバージョンで保存されることはない。
+
+STREAM_ROLE_CLAIMS を有効にすると、アクセストークンにロールをまとめた
+sr クレームと、発行時のバージョン mv クレームを含める。リクエスト時は
+Redis のバージョンと mv が一致すればクレームのロールをそのまま使い、
+招待や昇格でバージョンが上がったトークンのクレームは直ちに使われなくなる
+（その場合はキャッシュ・データベースから解決する）。
+
+バージョンのキーが Redis のフラッシュや退避で消えた場合は 0 から数え直さず、
+ランダムな値で作り直す。0 や小さい値に戻すと、以前のバージョンを持つ
+トークンのクレームやキャッシュが再び一致してしまうため。
+"""
+import base64
+import json
+import os
+import secrets
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import select
+
+from .metrics import metrics
+from .models import StreamMembership, StreamRole
+from .redis_client import get_redis
+
+STREAM_ROLES_CACHE_TTL_SECONDS = int(os.getenv("STREAM_ROLES_CACHE_TTL_SECONDS", "600"))
+
+STREAM_ROLE_CLAIMS = os.getenv("STREAM_ROLE_CLAIMS", "false").lower() == "true"
+# これより多くのストリームに参加している場合はクレームを含めない
+STREAM_ROLE_CLAIMS_MAX_STREAMS = int(os.getenv("STREAM_ROLE_CLAIMS_MAX_STREAMS", "64"))
+
+ADMIN_STREAM_ROLES = {StreamRole.STREAM_ADMIN, StreamRole.ADMIN}
+
+# sr クレームのロールの1バイト表現
+ROLE_CODES = {StreamRole.STUDENT: 0, StreamRole.STREAM_ADMIN: 1, StreamRole.ADMIN: 2}
+CODE_ROLES = {code: role for role, code in ROLE_CODES.items()}
+
+
+def version_key(user_id: str) -> str:
+    return f"stream-roles:version:{user_id}"
+
+
+def roles_key(user_id: str, version: int) -> str:
+    return f"stream-roles:{user_id}:{version}"
+
+
+def fresh_version() -> int:
+    """キーを作り直すときのバージョン（以前の値と重ならないようランダム）"""
+    return secrets.randbelow(2**48) + 1
+
+
+async def read_version(client, user_id: str) -> int:
+    """バージョンを返す。キーがなければ新しい値で作る"""
+    key = version_key(user_id)
+    version = await client.get(key)
+    if version is None:
+        # 同時に作られた場合は先に保存された値を使う
+        await client.set(key, fresh_version(), nx=True)
+        version = await client.get(key)
+    return int(version)
+
+
+@dataclass(frozen=True)
+class StreamRoles:
+    """ユーザーが参加しているストリームとロール"""
+
+    user_id: str
+    roles: Dict[str, StreamRole]
+
+    @property
+    def stream_ids(self) -> List[str]:
+        return list(self.roles)
+
+    def role_in(self, stream_id: str) -> Optional[StreamRole]:
+        return self.roles.get(stream_id)
+
+    def is_admin_of(self, stream_id: str) -> bool:
+        return self.roles.get(stream_id) in ADMIN_STREAM_ROLES
+
+    def require_member(self, stream_id: str) -> StreamRole:
+        """ロールを返す。メンバーでなければ 403"""
+        role = self.roles.get(stream_id)
+        if role is None:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="このストリームへのアクセス権限がありません",
+            )
+        return role
+
+
+async def load_stream_roles(session, user_id: str) -> Dict[str, StreamRole]:
+    result = await session.execute(
+        select(StreamMembership.stream_id, StreamMembership.role).where(
+            StreamMembership.user_id == user_id
+        )
+    )
+    return {stream_id: StreamRole(role) for stream_id, role in result.all()}
+
+
+async def _get_cached(user_id: str) -> Tuple[Optional[int], Optional[Dict]]:
+    """(バージョン, ロール) を返す。バージョンが None の場合は保存しない"""
+    try:
+        version = await read_version(get_redis(), user_id)
+        body = await get_redis().get(roles_key(user_id, version))
+    except Exception as e:
+        metrics.incr("stream_roles.error")
+        print(f"ロールのキャッシュの取得に失敗しました: {e}")
+        return None, None
+    return version, json.loads(body) if body is not None else None
+
+
+async def resolve_stream_roles(session, user_id: str) -> StreamRoles:
+    """キャッシュ（なければデータベース）からユーザーのロールを取得"""
+    version, cached = await _get_cached(user_id)
+    if cached is not None:
+        metrics.incr("stream_roles.hit")
+        return StreamRoles(
+            user_id, {stream_id: StreamRole(r) for stream_id, r in cached.items()}
+        )
+
+    metrics.incr("stream_roles.miss")
+    roles = await load_stream_roles(session, user_id)
+    if version is not None:
+        try:
+            await get_redis().set(
+                roles_key(user_id, version),
+                json.dumps(
+                    {stream_id: role.value for stream_id, role in roles.items()}
+                ),
+                ex=STREAM_ROLES_CACHE_TTL_SECONDS,
+            )
+        except Exception as e:
+            metrics.incr("stream_roles.error")
+            print(f"ロールのキャッシュの保存に失敗しました: {e}")
+    return StreamRoles(user_id, roles)
+
+
+async def invalidate_stream_roles(user_ids: Iterable[str], client=None):
+    """コミット後に呼び出し、ユーザーのロールのキャッシュを無効化する
+
+    Celery のタスクからは create_task_redis() のクライアントを渡す。
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return
+    try:
+        pipeline = (client or get_redis()).pipeline(transaction=False)
+        for user_id in user_ids:
+            # キーが消えていれば 1 からではなく新しい値から数える
+            pipeline.set(version_key(user_id), fresh_version(), nx=True)
+            pipeline.incr(version_key(user_id))
+        await pipeline.execute()
+        metrics.incr("stream_roles.invalidate", len(user_ids))
+    except Exception as e:
+        metrics.incr("stream_roles.error")
+        print(f"ロールのキャッシュの無効化に失敗しました: {e}")
+
+
+def encode_role_claim(roles: Dict[str, StreamRole]) -> Optional[str]:
+    """{stream_id: role} を「UUID 16 バイト + ロール 1 バイト」の並びの base64url にする
+
+    UUID 以外のストリーム ID が含まれる場合や件数が多すぎる場合は None。
+    """
+    if len(roles) > STREAM_ROLE_CLAIMS_MAX_STREAMS:
+        return None
+    packed = bytearray()
+    for stream_id, role in sorted(roles.items()):
+        try:
+            stream_uuid = uuid.UUID(stream_id)
+        except ValueError:
+            return None
+        if str(stream_uuid) != stream_id:
+            return None
+        packed += stream_uuid.bytes
+        packed.append(ROLE_CODES[role])
+    return base64.urlsafe_b64encode(bytes(packed)).rstrip(b"=").decode()
+
+
+def decode_role_claim(claim: str) -> Dict[str, StreamRole]:
+    packed = base64.urlsafe_b64decode(claim + "=" * (-len(claim) % 4))
+    if len(packed) % 17:
+        raise ValueError("Invalid stream role claim")
+    return {
+        str(uuid.UUID(bytes=packed[i : i + 16])): CODE_ROLES[packed[i + 16]]
+        for i in range(0, len(packed), 17)
+    }
+
+
+async def get_membership_version(user_id: str) -> Optional[int]:
+    """ユーザーのメンバーシップのバージョン。Redis が使えなければ None"""
+    try:
+        return await read_version(get_redis(), user_id)
+    except Exception as e:
+        metrics.incr("stream_roles.error")
+        print(f"メンバーシップのバージョンの取得に失敗しました: {e}")
+        return None
+
+
+async def stream_role_claims(session, user_id: str) -> Dict:
+    """アクセストークンに含める sr / mv クレーム（無効な場合は空）"""
+    if not STREAM_ROLE_CLAIMS:
+        return {}
+    # ロールより先にバージョンを読む（発行中に無効化されたら古いクレームになる）
+    version = await get_membership_version(user_id)
+    if version is None:
+        return {}
+    claim = encode_role_claim(await load_stream_roles(session, user_id))
+    if claim is None:
+        return {}
+    return {"sr": claim, "mv": version}
+
+
+async def roles_from_claims(user_id: str, payload: Dict) -> Optional[StreamRoles]:
+    """トークンのクレームが最新のバージョンならロールを返す。使えなければ None"""
+    claim, claimed_version = payload.get("sr"), payload.get("mv")
+    if claim is None or not isinstance(claimed_version, int):
+        return None
+    version = await get_membership_version(user_id)
+    if version != claimed_version:
+        metrics.incr("stream_roles.claims_stale")
+        return None
+    try:
+        roles = decode_role_claim(claim)
+    except (ValueError, KeyError):
+        return None
+    metrics.incr("stream_roles.claims_hit")
+    return StreamRoles(user_id, roles)
@@ -0,0 +1,27 @@
+"""
+プロセス内のメトリクス
+
+キャッシュのヒット・ミスなどをワーカーごとに数え、/metrics で公開する。
+"""
+from collections import defaultdict
+from typing import Dict
+
+
+class Metrics:
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def get(self, name: str) -> int:
+        return self.counters.get(name, 0)
+
+    def reset(self):
+        self.counters.clear()
+
+    def snapshot(self) -> dict:
+        return {"counters": dict(sorted(self.counters.items()))}
+
+
+metrics = Metrics()
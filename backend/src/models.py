@@ -3,9 +3,22 @@ from enum import Enum
 from typing import Optional
 from uuid import UUID, uuid4
 
+from sqlalchemy import Column, ForeignKey, Index, String
 from sqlmodel import Field, Relationship, SQLModel
 
 
+def cascade_foreign_key(target: str, **column_kwargs):
+    """親行の削除に合わせてデータベース側で削除される外部キー列"""
+    return Field(
+        sa_column=Column(
+            String,
+            ForeignKey(target, ondelete="CASCADE"),
+            nullable=False,
+            **column_kwargs,
+        )
+    )
+
+
 class UserRole(str, Enum):
     STUDENT = "student"
     TEACHER = "teacher"
@@ -68,6 +81,9 @@ class User(SQLModel, table=True):
     grade: Optional[int] = None  # 1, 2, 3年
     student_number: Optional[str] = None  # 学籍番号
 
+    # サンプルデータの作成ジョブが確保した日時（NULL なら未作成）
+    sample_data_seeded_at: Optional[datetime] = None
+
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -151,6 +167,9 @@ class Stream(SQLModel, table=True):
     is_public: bool = Field(default=True)  # 公開/非公開
     allow_student_posts: bool = Field(default=False)  # 生徒投稿許可
 
+    # 次にメンバーへ割り当てる連番（既読レシート用。抜けたメンバーの番号は再利用しない）
+    next_member_ordinal: Optional[int] = None
+
     created_by: str = Field(foreign_key="users.id")
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
@@ -165,6 +184,16 @@ class StreamMembership(SQLModel, table=True):
     """ストリームのメンバーシップ"""
 
     __tablename__ = "stream_memberships"
+    __table_args__ = (
+        # 同じユーザーの重複登録を防ぎ、一括登録の ON CONFLICT の対象にする
+        Index("ux_stream_memberships_user_stream", "user_id", "stream_id", unique=True),
+        # メンバー一覧のストリーム・ロール別の絞り込み用
+        Index("ix_stream_memberships_stream_role", "stream_id", "role"),
+        # 既読レシートのビットマップ上の位置（ストリーム内で一意）
+        Index(
+            "ux_stream_memberships_stream_ordinal", "stream_id", "ordinal", unique=True
+        ),
+    )
 
     id: str = Field(default_factory=lambda: str(uuid4()), primary_key=True)
     user_id: str = Field(foreign_key="users.id")
@@ -175,15 +204,20 @@ class StreamMembership(SQLModel, table=True):
 
     joined_at: datetime = Field(default_factory=datetime.utcnow)
 
+    # 既読位置 (created_at, id)。これより後に投稿されたお知らせを未読として数える
+    last_read_at: Optional[datetime] = None
+    last_read_id: Optional[str] = None
+
+    # ストリーム内の連番。既読レシートのビットマップのビット位置に使う（未割り当ては None）
+    ordinal: Optional[int] = None
+
     # Relationships
     user: User = Relationship(back_populates="stream_memberships")
     stream: Stream = Relationship(back_populates="memberships")
 
 
-class Announcement(SQLModel, table=True):
-    """お知らせ・投稿"""
-
-    __tablename__ = "announcements"
+class AnnouncementBase(SQLModel):
+    """お知らせの列（announcements と announcements_archive で共通）"""
 
     id: str = Field(default_factory=lambda: str(uuid4()), primary_key=True)
     title: str
@@ -195,11 +229,12 @@ class Announcement(SQLModel, table=True):
     is_pinned: bool = Field(default=False)  # ピン留め
 
     # メタデータ
-    tags: Optional[str] = None  # JSON形式でタグ保存
+    tags: Optional[str] = None  # JSON形式でタグ保存（絞り込みは announcement_tags で行う）
     attachments: Optional[str] = None  # JSON形式で添付ファイル情報
 
     # 配信先
     stream_id: str = Field(foreign_key="streams.id")
+    # 表示用の JSON 配列。絞り込みは announcement_target_grades / classes で行う
     target_grades: Optional[str] = None  # JSON配列 [1,2,3]
     target_classes: Optional[str] = None  # JSON配列 ["1年A組", "2年B組"]
 
@@ -207,11 +242,31 @@ class Announcement(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
+
+class Announcement(AnnouncementBase, table=True):
+    """お知らせ・投稿"""
+
+    __tablename__ = "announcements"
+    __table_args__ = (
+        # フィードの並び順 (is_pinned DESC, created_at DESC, id DESC) に対応
+        Index(
+            "ix_announcements_stream_feed",
+            "stream_id",
+            "is_pinned",
+            "created_at",
+            "id",
+        ),
+        # 未読数の集計・ストリーム横断タイムライン用
+        Index("ix_announcements_stream_created", "stream_id", "created_at", "id"),
+    )
+
     # Relationships
     creator: User = Relationship(back_populates="created_announcements")
     stream: Stream = Relationship(back_populates="announcements")
     reactions: list["AnnouncementReaction"] = Relationship(
-        back_populates="announcement"
+        back_populates="announcement",
+        # 子行はデータベースの ON DELETE CASCADE で削除する
+        sa_relationship_kwargs={"passive_deletes": True},
     )
 
 
@@ -219,9 +274,19 @@ class AnnouncementReaction(SQLModel, table=True):
     """お知らせへのリアクション（いいね、確認済みなど）"""
 
     __tablename__ = "announcement_reactions"
+    __table_args__ = (
+        # 同じユーザーの同じ種類のリアクションは1件だけ（二重タップ対策）
+        Index(
+            "ux_announcement_reactions_announcement_user_type",
+            "announcement_id",
+            "user_id",
+            "reaction_type",
+            unique=True,
+        ),
+    )
 
     id: str = Field(default_factory=lambda: str(uuid4()), primary_key=True)
-    announcement_id: str = Field(foreign_key="announcements.id")
+    announcement_id: str = cascade_foreign_key("announcements.id", index=True)
     user_id: str = Field(foreign_key="users.id")
 
     reaction_type: str  # "like", "read", "important" など
@@ -231,6 +296,168 @@ class AnnouncementReaction(SQLModel, table=True):
     announcement: Announcement = Relationship(back_populates="reactions")
 
 
+class AnnouncementReactionCount(SQLModel, table=True):
+    """お知らせのリアクション数（種類・シャード別の集計）
+
+    人気のお知らせへの同時書き込みが1行に集中しないよう、
+    ユーザーごとに決まるシャード行に分散して加算する。
+    """
+
+    __tablename__ = "announcement_reaction_counts"
+
+    announcement_id: str = cascade_foreign_key("announcements.id", primary_key=True)
+    reaction_type: str = Field(primary_key=True)
+    shard: int = Field(default=0, primary_key=True)
+    count: int = Field(default=0)
+
+
+class AnnouncementReadMark(SQLModel, table=True):
+    """既読位置に対する例外
+
+    既読位置より新しいが個別に既読にしたもの (is_read=True) と、
+    既読位置以前だが未読に戻したもの (is_read=False) だけを保持する。
+    """
+
+    __tablename__ = "announcement_read_marks"
+
+    membership_id: str = cascade_foreign_key("stream_memberships.id", primary_key=True)
+    announcement_id: str = cascade_foreign_key("announcements.id", primary_key=True)
+    is_read: bool = Field(default=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class AnnouncementTargetGrade(SQLModel, table=True):
+    """お知らせの対象学年（行がなければ全学年が対象）"""
+
+    __tablename__ = "announcement_target_grades"
+    __table_args__ = (
+        Index("ix_announcement_target_grades_grade", "grade", "announcement_id"),
+    )
+
+    announcement_id: str = cascade_foreign_key("announcements.id", primary_key=True)
+    grade: int = Field(primary_key=True)
+
+
+class AnnouncementTargetClass(SQLModel, table=True):
+    """お知らせの対象クラス（行がなければ全クラスが対象）"""
+
+    __tablename__ = "announcement_target_classes"
+    __table_args__ = (
+        Index("ix_announcement_target_classes_class", "class_name", "announcement_id"),
+    )
+
+    announcement_id: str = cascade_foreign_key("announcements.id", primary_key=True)
+    class_name: str = Field(primary_key=True)
+
+
+class Tag(SQLModel, table=True):
+    """タグ（名前は NFKC 正規化済み）"""
+
+    __tablename__ = "tags"
+
+    id: str = Field(default_factory=lambda: str(uuid4()), primary_key=True)
+    name: str = Field(index=True, sa_column_kwargs={"unique": True})
+
+
+class AnnouncementTag(SQLModel, table=True):
+    """お知らせとタグの対応"""
+
+    __tablename__ = "announcement_tags"
+    __table_args__ = (
+        # タグからお知らせを引く転置インデックス
+        Index("ix_announcement_tags_tag", "tag_id", "announcement_id"),
+    )
+
+    announcement_id: str = cascade_foreign_key("announcements.id", primary_key=True)
+    tag_id: str = Field(foreign_key="tags.id", primary_key=True)
+
+
+class StreamTagCount(SQLModel, table=True):
+    """ストリームごとのタグ別お知らせ件数（ファセット用に書き込み時に更新）"""
+
+    __tablename__ = "stream_tag_counts"
+
+    stream_id: str = Field(foreign_key="streams.id", primary_key=True)
+    tag_id: str = Field(foreign_key="tags.id", primary_key=True)
+    count: int = Field(default=0)
+
+
+class ArchivedAnnouncement(AnnouncementBase, table=True):
+    """過去の年度のお知らせ（フィードの索引を小さく保つため announcements から移動）"""
+
+    __tablename__ = "announcements_archive"
+    __table_args__ = (
+        Index("ix_announcements_archive_stream_created", "stream_id", "created_at"),
+    )
+
+    archived_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class ArchivedAnnouncementReaction(SQLModel, table=True):
+    __tablename__ = "announcement_reactions_archive"
+
+    id: str = Field(primary_key=True)
+    announcement_id: str = cascade_foreign_key("announcements_archive.id", index=True)
+    user_id: str = Field(foreign_key="users.id")
+    reaction_type: str
+    created_at: datetime
+
+
+class ArchivedAnnouncementTargetGrade(SQLModel, table=True):
+    __tablename__ = "announcement_target_grades_archive"
+
+    announcement_id: str = cascade_foreign_key(
+        "announcements_archive.id", primary_key=True
+    )
+    grade: int = Field(primary_key=True)
+
+
+class ArchivedAnnouncementTargetClass(SQLModel, table=True):
+    __tablename__ = "announcement_target_classes_archive"
+
+    announcement_id: str = cascade_foreign_key(
+        "announcements_archive.id", primary_key=True
+    )
+    class_name: str = Field(primary_key=True)
+
+
+class ArchivedAnnouncementTag(SQLModel, table=True):
+    __tablename__ = "announcement_tags_archive"
+    __table_args__ = (
+        Index("ix_announcement_tags_archive_tag", "tag_id", "announcement_id"),
+    )
+
+    announcement_id: str = cascade_foreign_key(
+        "announcements_archive.id", primary_key=True
+    )
+    tag_id: str = Field(foreign_key="tags.id", primary_key=True)
+
+
+class AttachmentBlob(SQLModel, table=True):
+    """添付ファイルの実体（内容の SHA-256 で一意。同じ内容は1回だけ保存）"""
+
+    __tablename__ = "attachment_blobs"
+
+    sha256: str = Field(primary_key=True)
+    size: int
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class Attachment(SQLModel, table=True):
+    """アップロードされた添付ファイル（ファイル名・種類はアップロードごと）"""
+
+    __tablename__ = "attachments"
+
+    id: str = Field(default_factory=lambda: str(uuid4()), primary_key=True)
+    sha256: str = Field(foreign_key="attachment_blobs.sha256", index=True)
+    filename: str
+    content_type: str
+    uploaded_by: str = Field(foreign_key="users.id")
+    # 投稿先のストリーム（メンバーだけがダウンロードできる）
+    stream_id: Optional[str] = Field(default=None, foreign_key="streams.id", index=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
 class LostItem(SQLModel, table=True):
     """忘れ物・落とし物掲示板"""
 
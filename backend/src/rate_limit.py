@@ -0,0 +1,219 @@
+"""
+レート制限
+
+ルートに依存関係 rate_limit("search") を付けると、そのルートのポリシー
+（RATE_LIMIT_POLICIES）をユーザーごとのトークンバケットで適用する。
+per にパスパラメータ名を渡すと、その値ごとに別のバケットになる。
+バケットは Redis にあり、補充と消費を Lua スクリプトの1回の呼び出しで
+原子的に行うため、複数のワーカーから同時に呼ばれても上限を超えない。
+
+リースしても容量の半分以上が残るときは、容量の RATE_LIMIT_LEASE_FRACTION 分の
+トークンをまとめて確保（リース）し、RATE_LIMIT_LEASE_SECONDS の間は
+ワーカー内で消費する。上限から遠いクライアントのリクエストの大半は
+Redis を呼ばずに済む。リースしたトークンはバケットから差し引き済みなので
+上限は超えない（期限までに使われなかった分は失われる）。
+半分を下回ったら1つずつ確保するため、あるワーカーにリースが残っていても、
+別のワーカーで拒否されるのはリースの期限内に容量の半分以上を使った場合に限られる。
+
+上限を超えたら 429 と Retry-After を返す。Redis に接続できない場合は制限しない。
+"""
+import math
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence, Tuple
+
+from fastapi import Depends, HTTPException, Request, status
+
+from .auth import get_current_user
+from .metrics import metrics
+from .models import User
+from .redis_client import get_redis
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_LEASE_FRACTION = float(os.getenv("RATE_LIMIT_LEASE_FRACTION", "0.1"))
+RATE_LIMIT_LEASE_SECONDS = float(os.getenv("RATE_LIMIT_LEASE_SECONDS", "1"))
+RATE_LIMIT_LOCAL_MAX_ENTRIES = int(os.getenv("RATE_LIMIT_LOCAL_MAX_ENTRIES", "10000"))
+
+RATE_LIMIT_KEY_PREFIX = "ratelimit:"
+
+# KEYS[1]: バケット / ARGV: 容量, 1秒あたりの補充量, 確保したい最大のトークン数
+# ARGV[3] を確保しても容量の半分以上残るならその分、1以上なら1つ確保する。
+# 返り値: {確保したトークン数, 拒否した場合の Retry-After 秒}
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local lease = tonumber(ARGV[3])
+-- Redis 5 未満では TIME の後に書き込むため効果の複製が必要
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+local ts = tonumber(bucket[2])
+if tokens == nil or ts == nil then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local granted = 0
+local retry_after = 0
+if lease > 1 and tokens - lease >= capacity / 2 then
+    granted = lease
+elseif tokens >= 1 then
+    granted = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+tokens = tokens - granted
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {granted, tostring(retry_after)}
+"""
+
+
+@dataclass(frozen=True)
+class RateLimitPolicy:
+    """period_seconds で capacity 回まで（バースト capacity、一定の速度で補充）"""
+
+    name: str
+    capacity: int
+    period_seconds: float
+    lease: int = 1
+
+    @property
+    def refill_per_second(self) -> float:
+        return self.capacity / self.period_seconds
+
+
+def parse_policy(name: str, spec: str) -> RateLimitPolicy:
+    """ "回数/秒数" の形式（例: "30/60"）からポリシーを作る"""
+    capacity, period_seconds = spec.split("/")
+    capacity = int(capacity)
+    return RateLimitPolicy(
+        name,
+        capacity,
+        float(period_seconds),
+        lease=max(1, int(capacity * RATE_LIMIT_LEASE_FRACTION)),
+    )
+
+
+RATE_LIMIT_POLICIES: Dict[str, RateLimitPolicy] = {
+    name: parse_policy(name, os.getenv(f"RATE_LIMIT_{name.upper()}", default))
+    for name, default in [
+        ("brainstorm_idea", "3/30"),
+        ("search", "30/60"),
+        ("feed", "120/60"),
+    ]
+}
+
+
+def bucket_key(policy_name: str, identity: str) -> str:
+    return f"{RATE_LIMIT_KEY_PREFIX}{policy_name}:{identity}"
+
+
+class LocalLeases:
+    """ワーカー内でリースしたトークンの残り（期限付き、件数の上限あり）"""
+
+    def __init__(self, max_entries: int = RATE_LIMIT_LOCAL_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Tuple[float, int]]" = OrderedDict()
+
+    def take(self, key: str) -> bool:
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        expires_at, remaining = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return False
+        if remaining <= 1:
+            del self.entries[key]
+        else:
+            self.entries[key] = (expires_at, remaining - 1)
+        return True
+
+    def put(self, key: str, tokens: int, ttl_seconds: float):
+        if tokens <= 0:
+            return
+        self.entries[key] = (time.monotonic() + ttl_seconds, tokens)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class RateLimiter:
+    def __init__(self, leases: Optional[LocalLeases]):
+        self.leases = leases
+        self._script = None
+
+    def _token_bucket(self):
+        # スクリプトはクライアントごとに登録する（EVALSHA を使い、なければ EVAL）
+        client = get_redis()
+        if self._script is None or self._script[0] is not client:
+            self._script = (client, client.register_script(TOKEN_BUCKET_SCRIPT))
+        return self._script[1]
+
+    async def acquire(
+        self, policy: RateLimitPolicy, identity: str
+    ) -> Tuple[bool, float]:
+        """1回分のトークンを確保し、(許可, Retry-After 秒) を返す"""
+        key = bucket_key(policy.name, identity)
+        if self.leases is not None and self.leases.take(key):
+            metrics.incr("rate_limit.local_hit")
+            return True, 0.0
+
+        lease = policy.lease if self.leases is not None else 1
+        try:
+            granted, retry_after = await self._token_bucket()(
+                keys=[key], args=[policy.capacity, policy.refill_per_second, lease]
+            )
+        except Exception as e:
+            metrics.incr("rate_limit.error")
+            print(f"レート制限の確認に失敗しました: {e}")
+            return True, 0.0
+
+        metrics.incr("rate_limit.redis")
+        granted = int(granted)
+        if granted == 0:
+            metrics.incr("rate_limit.rejected")
+            return False, float(retry_after)
+        if granted > 1:
+            self.leases.put(key, granted - 1, RATE_LIMIT_LEASE_SECONDS)
+        return True, 0.0
+
+
+rate_limiter = RateLimiter(LocalLeases())
+
+
+def rate_limit(policy_name: str, per: Sequence[str] = ()):
+    """ルートの dependencies に指定する依存関係（ユーザーごとにポリシーを適用）
+
+    per にはバケットを分けるパスパラメータの名前を指定する（例: ("session_id",)）。
+    """
+
+    async def check_rate_limit(
+        request: Request, current_user: User = Depends(get_current_user)
+    ):
+        if not RATE_LIMIT_ENABLED:
+            return
+        policy = RATE_LIMIT_POLICIES[policy_name]
+        identity = ":".join([current_user.id, *(request.path_params[p] for p in per)])
+        allowed, retry_after = await rate_limiter.acquire(policy, identity)
+        if not allowed:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="リクエストが多すぎます。しばらくしてから再度お試しください",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+
+    return check_rate_limit
@@ -0,0 +1,151 @@
+"""
+お知らせのリアクション数カウンター
+
+リアクションの追加・削除時に announcement_reaction_counts を原子的に加減算し、
+フィードや検索ではリアクション行を数え直さずに集計値を読むだけにする。
+"""
+import os
+import zlib
+from typing import Dict, Sequence
+
+from sqlalchemy import delete, func, literal, select
+
+from .database import async_engine, dialect_insert
+from .models import Announcement, AnnouncementReaction, AnnouncementReactionCount
+
+REACTION_COUNTER_SHARDS = int(os.getenv("REACTION_COUNTER_SHARDS", "8"))
+
+
+def shard_for(user_id: str) -> int:
+    """ユーザーごとに固定のシャード番号（追加と取り消しが同じ行に当たる）"""
+    return zlib.crc32(user_id.encode()) % REACTION_COUNTER_SHARDS
+
+
+async def apply_reaction_delta(
+    session, announcement_id: str, reaction_type: str, user_id: str, delta: int
+):
+    """リアクション数を1文の UPSERT で加減算"""
+    await apply_reaction_deltas(
+        session, [announcement_id], reaction_type, user_id, delta
+    )
+
+
+async def apply_reaction_deltas(
+    session,
+    announcement_ids: Sequence[str],
+    reaction_type: str,
+    user_id: str,
+    delta: int,
+):
+    """複数のお知らせのリアクション数を1文の複数行 UPSERT で加減算"""
+    if not announcement_ids:
+        return
+    shard = shard_for(user_id)
+    statement = dialect_insert(session, AnnouncementReactionCount).values(
+        [
+            {
+                "announcement_id": announcement_id,
+                "reaction_type": reaction_type,
+                "shard": shard,
+                "count": delta,
+            }
+            for announcement_id in announcement_ids
+        ]
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["announcement_id", "reaction_type", "shard"],
+        set_={"count": AnnouncementReactionCount.count + statement.excluded.count},
+    )
+    await session.execute(statement)
+
+
+async def load_reaction_counts(
+    session, announcement_ids: Sequence[str]
+) -> Dict[str, Dict[str, int]]:
+    """お知らせごとのリアクション数を種類別に取得
+
+    読み取る行数はお知らせ1件あたり最大で (種類数 × シャード数) で、
+    リアクションの総数には依存しない。
+    """
+    if not announcement_ids:
+        return {}
+
+    statement = (
+        select(
+            AnnouncementReactionCount.announcement_id,
+            AnnouncementReactionCount.reaction_type,
+            func.sum(AnnouncementReactionCount.count),
+        )
+        .where(AnnouncementReactionCount.announcement_id.in_(announcement_ids))
+        .group_by(
+            AnnouncementReactionCount.announcement_id,
+            AnnouncementReactionCount.reaction_type,
+        )
+    )
+    result = await session.execute(statement)
+
+    reaction_counts: Dict[str, Dict[str, int]] = {}
+    for announcement_id, reaction_type, count in result.all():
+        if count:
+            reaction_counts.setdefault(announcement_id, {})[reaction_type] = count
+    return reaction_counts
+
+
+async def delete_reaction_counts(session, announcement_ids: Sequence[str]):
+    await session.execute(
+        delete(AnnouncementReactionCount).where(
+            AnnouncementReactionCount.announcement_id.in_(announcement_ids)
+        )
+    )
+
+
+async def rebuild_reaction_counts(conn):
+    """リアクション行から集計を作り直す"""
+    await conn.execute(delete(AnnouncementReactionCount))
+    await conn.execute(
+        AnnouncementReactionCount.__table__.insert().from_select(
+            ["announcement_id", "reaction_type", "shard", "count"],
+            select(
+                AnnouncementReaction.announcement_id,
+                AnnouncementReaction.reaction_type,
+                literal(0),
+                func.count(),
+            ).group_by(
+                AnnouncementReaction.announcement_id,
+                AnnouncementReaction.reaction_type,
+            ),
+        )
+    )
+
+
+async def init_reaction_counts():
+    """集計テーブルが空で、リアクションが既に存在する場合は集計を構築"""
+    async with async_engine.begin() as conn:
+        has_counts = await conn.execute(
+            select(AnnouncementReactionCount.announcement_id).limit(1)
+        )
+        if has_counts.first() is not None:
+            return
+        has_reactions = await conn.execute(select(AnnouncementReaction.id).limit(1))
+        if has_reactions.first() is not None:
+            await rebuild_reaction_counts(conn)
+
+
+async def apply_bulk_reaction_delta(
+    session, condition, reaction_type: str, user_id: str, delta: int
+):
+    """条件に一致するお知らせのリアクション数を1文でまとめて加減算"""
+    rows = select(
+        Announcement.id,
+        literal(reaction_type),
+        literal(shard_for(user_id)),
+        literal(delta),
+    ).where(condition)
+    statement = dialect_insert(session, AnnouncementReactionCount).from_select(
+        ["announcement_id", "reaction_type", "shard", "count"], rows
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["announcement_id", "reaction_type", "shard"],
+        set_={"count": AnnouncementReactionCount.count + statement.excluded.count},
+    )
+    await session.execute(statement)
@@ -0,0 +1,126 @@
+"""
+お知らせへのリアクション（既読以外）
+
+(announcement_id, user_id, reaction_type) の一意制約を前提に、追加は
+INSERT ... ON CONFLICT DO NOTHING、取り消しは DELETE の各1文で行い、
+RETURNING で実際に変化した行だけを集計に反映する。
+二重タップなどの同時リクエストでも行が重複せず、集計もずれない。
+"""
+from typing import List, Sequence
+
+from sqlalchemy import delete, func, literal, select
+
+from .database import dialect_insert
+from .models import AnnouncementReaction, AnnouncementReactionCount
+from .reaction_counters import apply_reaction_deltas
+
+
+async def add_reactions(
+    session, announcement_ids: Sequence[str], user_id: str, reaction_type: str
+) -> List[str]:
+    """リアクションをまとめて追加し、新たに追加されたお知らせ ID を返す"""
+    if not announcement_ids:
+        return []
+    statement = (
+        dialect_insert(session, AnnouncementReaction)
+        .values(
+            [
+                AnnouncementReaction(
+                    announcement_id=announcement_id,
+                    user_id=user_id,
+                    reaction_type=reaction_type,
+                ).model_dump()
+                for announcement_id in announcement_ids
+            ]
+        )
+        .on_conflict_do_nothing(
+            index_elements=["announcement_id", "user_id", "reaction_type"]
+        )
+        .returning(AnnouncementReaction.announcement_id)
+    )
+    result = await session.execute(statement)
+    added = list(result.scalars().all())
+    await apply_reaction_deltas(session, added, reaction_type, user_id, 1)
+    return added
+
+
+async def remove_reactions(
+    session, announcement_ids: Sequence[str], user_id: str, reaction_type: str
+) -> List[str]:
+    """リアクションをまとめて取り消し、実際に取り消されたお知らせ ID を返す"""
+    if not announcement_ids:
+        return []
+    statement = (
+        delete(AnnouncementReaction)
+        .where(
+            AnnouncementReaction.announcement_id.in_(announcement_ids),
+            AnnouncementReaction.user_id == user_id,
+            AnnouncementReaction.reaction_type == reaction_type,
+        )
+        .returning(AnnouncementReaction.announcement_id)
+    )
+    result = await session.execute(statement)
+    removed = list(result.scalars().all())
+    await apply_reaction_deltas(session, removed, reaction_type, user_id, -1)
+    return removed
+
+
+async def toggle_reaction(
+    session, announcement_id: str, user_id: str, reaction_type: str
+) -> int:
+    """リアクションを切り替え、集計の増減 (+1 / -1 / 0) を返す
+
+    まず DELETE ... RETURNING を試し、消えなければ追加する（SELECT は発行しない）。
+    """
+    if await remove_reactions(session, [announcement_id], user_id, reaction_type):
+        return -1
+    if await add_reactions(session, [announcement_id], user_id, reaction_type):
+        return 1
+    # 同時に届いた同じ追加リクエストが先に反映された
+    return 0
+
+
+async def remove_duplicate_reactions(conn):
+    """重複したリアクションを整理し、集計から差し引く
+
+    一意インデックスを作成する前に src.deduplicate から手動で実行する。
+    重複した行はどれも同じリアクションなので、残す行は id で決める。
+    """
+    keep = select(func.min(AnnouncementReaction.id)).group_by(
+        AnnouncementReaction.announcement_id,
+        AnnouncementReaction.user_id,
+        AnnouncementReaction.reaction_type,
+    )
+    duplicate = AnnouncementReaction.id.not_in(keep)
+
+    # 集計が未構築なら init_reaction_counts が重複を除いた行から作る
+    has_counts = await conn.execute(
+        select(AnnouncementReactionCount.announcement_id).limit(1)
+    )
+    if has_counts.first() is not None:
+        await _subtract_duplicates(conn, duplicate)
+    await conn.execute(delete(AnnouncementReaction).where(duplicate))
+
+
+async def _subtract_duplicates(conn, duplicate):
+    # 集計はシャードの合計なので、差し引く分はシャード 0 にまとめて加算する
+    removed = (
+        select(
+            AnnouncementReaction.announcement_id,
+            AnnouncementReaction.reaction_type,
+            literal(0),
+            -func.count(),
+        )
+        .where(duplicate)
+        .group_by(
+            AnnouncementReaction.announcement_id, AnnouncementReaction.reaction_type
+        )
+    )
+    statement = dialect_insert(conn, AnnouncementReactionCount).from_select(
+        ["announcement_id", "reaction_type", "shard", "count"], removed
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["announcement_id", "reaction_type", "shard"],
+        set_={"count": AnnouncementReactionCount.count + statement.excluded.count},
+    )
+    await conn.execute(statement)
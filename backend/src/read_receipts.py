@@ -0,0 +1,370 @@
+"""
+緊急のお知らせの既読レシート
+
+メンバーシップにストリーム内の連番 (ordinal) を割り当て、お知らせごとの既読を
+Redis のビット列 (ordinal 番目のビット = 既読) として保持する。
+「未読のメンバー」「既読率」は対象メンバーのビットマスクとのビット演算で求める。
+
+ビット列はデータベースの既読状態（既読位置と例外）から作るキャッシュで、
+既読状態が変わったときに SETBIT で更新する。Redis にない、または使えない
+場合はデータベースから作り直す。作り直している間の更新はジャーナル（ハッシュ）に
+記録しておき、ビット列を保存するときに重ねるため失われない。
+"""
+from typing import Dict, List, Sequence
+
+from sqlalchemy import and_, bindparam, false, func, or_, select, true, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .announcement_targets import Audience, audience_condition
+from .models import (
+    Announcement,
+    AnnouncementReadMark,
+    Stream,
+    StreamMembership,
+    StreamRole,
+    User,
+)
+from .redis_client import get_redis
+
+READ_RECEIPT_KEY_PREFIX = "read-receipts:"
+READ_RECEIPT_TTL_SECONDS = 30 * 24 * 60 * 60
+# 作り直しが途中で失敗した場合に残ったジャーナルを消すまでの秒数
+READ_RECEIPT_JOURNAL_TTL_SECONDS = 60
+
+# Redis のビット列は先頭バイトの最上位ビットが 0 番なので、バイトごとに反転する
+_REVERSED_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+# KEYS: ビット列とジャーナルの組を並べたもの / ARGV: ordinal, 既読なら 1
+# ビット列がある場合だけ更新し（部分的なビット列を作らない）、
+# 作り直し中（ジャーナルがある）なら更新を記録する
+_SET_BITS_IF_EXISTS = """
+for i = 1, #KEYS, 2 do
+  if redis.call('EXISTS', KEYS[i]) == 1 then
+    redis.call('SETBIT', KEYS[i], ARGV[1], ARGV[2])
+  end
+  if redis.call('EXISTS', KEYS[i + 1]) == 1 then
+    redis.call('HSET', KEYS[i + 1], ARGV[1], ARGV[2])
+  end
+end
+"""
+
+# KEYS[1]: ビット列, KEYS[2]: ジャーナル / ARGV: データベースから作ったビット列, TTL
+# ビット列がまだなければ保存し、作り直しの間に記録された更新を重ねる
+_STORE_REBUILT_BITMAP = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+  local journal = redis.call('HGETALL', KEYS[2])
+  for i = 1, #journal, 2 do
+    if journal[i] ~= '' then
+      redis.call('SETBIT', KEYS[1], journal[i], journal[i + 1])
+    end
+  end
+end
+redis.call('DEL', KEYS[2])
+return redis.call('GET', KEYS[1])
+"""
+
+
+def receipt_key(announcement_id: str) -> str:
+    return f"{READ_RECEIPT_KEY_PREFIX}{announcement_id}"
+
+
+def journal_key(announcement_id: str) -> str:
+    return f"{READ_RECEIPT_KEY_PREFIX}{announcement_id}:journal"
+
+
+def bitmap_to_int(data: bytes) -> int:
+    """Redis のビット列を、i 番目のビットが ordinal i を表す整数に変換"""
+    return int.from_bytes(data.translate(_REVERSED_BITS), "little")
+
+
+def int_to_bitmap(value: int) -> bytes:
+    """bitmap_to_int の逆変換（少なくとも1バイトを返す）"""
+    length = max(1, (value.bit_length() + 7) // 8)
+    return value.to_bytes(length, "little").translate(_REVERSED_BITS)
+
+
+def ordinals_in(mask: int) -> List[int]:
+    ordinals = []
+    while mask:
+        low = mask & -mask
+        ordinals.append(low.bit_length() - 1)
+        mask ^= low
+    return ordinals
+
+
+def _mask(ordinals: Sequence[int]) -> int:
+    mask = 0
+    for ordinal in ordinals:
+        mask |= 1 << ordinal
+    return mask
+
+
+async def ensure_member_ordinals(session, stream_id: str):
+    """ordinal が未割り当てのメンバーシップに、ストリームの連番を割り当てる
+
+    連番は streams.next_member_ordinal から払い出し、抜けたメンバーの番号を
+    再利用しない（再利用すると前のメンバーの既読ビットを引き継いでしまう）。
+    渡されたセッションのトランザクションには触れず、同じエンジンの別のセッションで
+    コミットする。
+    """
+    async with AsyncSession(session.bind) as own_session:
+        await _assign_member_ordinals(own_session, stream_id)
+
+
+async def _assign_member_ordinals(session, stream_id: str):
+    missing = await session.execute(
+        select(StreamMembership.id)
+        .where(
+            StreamMembership.stream_id == stream_id,
+            StreamMembership.ordinal.is_(None),
+        )
+        .order_by(StreamMembership.joined_at, StreamMembership.id)
+    )
+    membership_ids = missing.scalars().all()
+    if not membership_ids:
+        return
+
+    # 払い出しはストリームの行の更新で直列化される。未設定の既存ストリームは
+    # 割り当て済みの最大値の次から始める
+    assigned_max = (
+        select(func.coalesce(func.max(StreamMembership.ordinal), -1) + 1)
+        .where(StreamMembership.stream_id == stream_id)
+        .scalar_subquery()
+    )
+    reserved = await session.execute(
+        update(Stream)
+        .where(Stream.id == stream_id)
+        .values(
+            next_member_ordinal=func.coalesce(Stream.next_member_ordinal, assigned_max)
+            + len(membership_ids)
+        )
+        .returning(Stream.next_member_ordinal)
+    )
+    start = reserved.scalar_one() - len(membership_ids)
+
+    # 同時に割り当てた別のリクエストが先に設定した行はそのままにする（番号は欠番になる）
+    memberships = StreamMembership.__table__
+    await session.execute(
+        update(memberships)
+        .where(
+            memberships.c.id == bindparam("membership_id"),
+            memberships.c.ordinal.is_(None),
+        )
+        .values(ordinal=bindparam("new_ordinal")),
+        [
+            {"membership_id": membership_id, "new_ordinal": start + i}
+            for i, membership_id in enumerate(membership_ids)
+        ],
+    )
+    await session.commit()
+
+
+def _recipient_condition(announcement: Announcement):
+    """既読を確認する対象（お知らせが表示される生徒メンバー）"""
+    return and_(
+        StreamMembership.stream_id == announcement.stream_id,
+        StreamMembership.role == StreamRole.STUDENT,
+        StreamMembership.ordinal.is_not(None),
+        audience_condition(
+            Audience(User.grade, User.class_name),
+            announcement.id,
+            announcement.stream_id,
+        ),
+    )
+
+
+async def load_recipient_mask(session, announcement: Announcement) -> int:
+    result = await session.execute(
+        select(StreamMembership.ordinal)
+        .join(User, User.id == StreamMembership.user_id)
+        .where(_recipient_condition(announcement))
+    )
+    return _mask(result.scalars().all())
+
+
+async def load_reader_mask(session, announcement: Announcement) -> int:
+    """データベースの既読状態から、既読のメンバーのビットマスクを作る"""
+    below_watermark = and_(
+        StreamMembership.last_read_at.is_not(None),
+        tuple_(
+            StreamMembership.last_read_at,
+            func.coalesce(StreamMembership.last_read_id, ""),
+        )
+        >= tuple_(announcement.created_at, announcement.id),
+    )
+    result = await session.execute(
+        select(StreamMembership.ordinal)
+        .outerjoin(
+            AnnouncementReadMark,
+            and_(
+                AnnouncementReadMark.membership_id == StreamMembership.id,
+                AnnouncementReadMark.announcement_id == announcement.id,
+            ),
+        )
+        .where(
+            StreamMembership.stream_id == announcement.stream_id,
+            StreamMembership.ordinal.is_not(None),
+            or_(
+                AnnouncementReadMark.is_read == true(),
+                and_(AnnouncementReadMark.is_read.is_(None), below_watermark),
+            ),
+        )
+    )
+    return _mask(result.scalars().all())
+
+
+async def load_read_bitmap(session, announcement: Announcement) -> int:
+    """既読のビットマスクを Redis から取得（なければデータベースから作って保存）"""
+    key = receipt_key(announcement.id)
+    try:
+        cached = await get_redis().get(key)
+        if cached is not None:
+            return bitmap_to_int(cached)
+    except Exception as e:
+        print(f"既読レシートの取得に失敗しました: {e}")
+        return await load_reader_mask(session, announcement)
+
+    # データベースを読む前にジャーナルを作り、それ以降の更新を記録させる
+    journal = journal_key(announcement.id)
+    try:
+        redis = get_redis()
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.hsetnx(journal, "", "")
+            pipe.expire(journal, READ_RECEIPT_JOURNAL_TTL_SECONDS)
+            await pipe.execute()
+    except Exception as e:
+        print(f"既読レシートの保存に失敗しました: {e}")
+        return await load_reader_mask(session, announcement)
+
+    readers = await load_reader_mask(session, announcement)
+    try:
+        stored = await redis.eval(
+            _STORE_REBUILT_BITMAP,
+            2,
+            key,
+            journal,
+            int_to_bitmap(readers),
+            READ_RECEIPT_TTL_SECONDS,
+        )
+        return bitmap_to_int(stored)
+    except Exception as e:
+        print(f"既読レシートの保存に失敗しました: {e}")
+    return readers
+
+
+async def record_read_receipts(
+    session,
+    membership: StreamMembership,
+    announcement_ids: Sequence[str],
+    is_read: bool,
+):
+    """既読状態の変更をビット列に反映（コミット後に呼ぶ）"""
+    if not announcement_ids:
+        return
+    if membership.ordinal is None:
+        await ensure_member_ordinals(session, membership.stream_id)
+        await session.refresh(membership)
+    try:
+        keys = []
+        for announcement_id in announcement_ids:
+            keys += [receipt_key(announcement_id), journal_key(announcement_id)]
+        await get_redis().eval(
+            _SET_BITS_IF_EXISTS,
+            len(keys),
+            *keys,
+            membership.ordinal,
+            int(is_read),
+        )
+    except Exception as e:
+        print(f"既読レシートの更新に失敗しました: {e}")
+
+
+async def record_urgent_reads(
+    session,
+    membership: StreamMembership,
+    announcements: Sequence[Announcement],
+    changed_ids: Sequence[str],
+    is_read: bool,
+):
+    """既読状態が変わったお知らせのうち、緊急のものだけビット列に反映"""
+    changed = set(changed_ids)
+    urgent_ids = [a.id for a in announcements if a.is_urgent and a.id in changed]
+    await record_read_receipts(session, membership, urgent_ids, is_read)
+
+
+async def urgent_ids_newly_read(
+    session, membership: StreamMembership, announcement: Announcement
+):
+    """announcement までの一括既読で既読になる緊急のお知らせ（ビットを立てる対象）
+
+    mark_read_up_to の前に呼ぶ。今の既読位置より後の範囲と、既読位置以前で
+    未読に戻したもの（例外）だけを調べるため、ストリームの履歴の長さによらない。
+    """
+    up_to = tuple_(Announcement.created_at, Announcement.id) <= tuple_(
+        announcement.created_at, announcement.id
+    )
+    newer = (
+        true()
+        if membership.last_read_at is None
+        else tuple_(Announcement.created_at, Announcement.id)
+        > tuple_(membership.last_read_at, membership.last_read_id or "")
+    )
+    marked_unread = (
+        select(AnnouncementReadMark.announcement_id)
+        .where(
+            AnnouncementReadMark.membership_id == membership.id,
+            AnnouncementReadMark.is_read == false(),
+        )
+        .scalar_subquery()
+    )
+    result = await session.execute(
+        select(Announcement.id).where(
+            Announcement.stream_id == membership.stream_id,
+            Announcement.is_urgent == true(),
+            up_to,
+            or_(newer, Announcement.id.in_(marked_unread)),
+        )
+    )
+    return result.scalars().all()
+
+
+async def summarize_read_receipts(
+    session, announcement: Announcement, unread_limit: int = 200
+) -> Dict:
+    """対象メンバー数・既読数・既読率と、未読のメンバー（最大 unread_limit 件）"""
+    await ensure_member_ordinals(session, announcement.stream_id)
+
+    recipients = await load_recipient_mask(session, announcement)
+    readers = await load_read_bitmap(session, announcement)
+
+    recipient_count = recipients.bit_count()
+    read_count = (recipients & readers).bit_count()
+    unread_ordinals = ordinals_in(recipients & ~readers)
+
+    unread_members = []
+    if unread_ordinals:
+        result = await session.execute(
+            select(User, StreamMembership.ordinal)
+            .join(StreamMembership, StreamMembership.user_id == User.id)
+            .where(
+                StreamMembership.stream_id == announcement.stream_id,
+                StreamMembership.ordinal.in_(unread_ordinals[:unread_limit]),
+            )
+            .order_by(User.name, User.id)
+        )
+        unread_members = [
+            {"id": user.id, "name": user.name, "class_name": user.class_name}
+            for user, _ in result.all()
+        ]
+
+    return {
+        "announcement_id": announcement.id,
+        "recipient_count": recipient_count,
+        "read_count": read_count,
+        "unread_count": recipient_count - read_count,
+        "read_percentage": round(read_count * 100 / recipient_count, 1)
+        if recipient_count
+        else 0.0,
+        "unread_members": unread_members,
+    }
@@ -0,0 +1,400 @@
+"""
+お知らせの既読管理
+
+既読状態をお知らせごとのリアクション行ではなく、メンバーシップごとの
+既読位置 (last_read_at, last_read_id) と、その例外だけを保持する
+announcement_read_marks で表す。
+
+- 既読位置以前のお知らせ: 未読の例外がなければ既読
+- 既読位置より新しいお知らせ: 既読の例外があれば既読
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import (
+    and_,
+    delete,
+    exists,
+    false,
+    func,
+    not_,
+    or_,
+    select,
+    true,
+    tuple_,
+)
+
+from .database import async_engine, dialect_insert
+from .models import (
+    Announcement,
+    AnnouncementReaction,
+    AnnouncementReadMark,
+    StreamMembership,
+    User,
+)
+from .reaction_counters import (
+    apply_bulk_reaction_delta,
+    apply_reaction_delta,
+    apply_reaction_deltas,
+)
+
+READ_REACTION = "read"
+
+
+def _announcement_key():
+    return tuple_(Announcement.created_at, Announcement.id)
+
+
+def _watermark_key(membership):
+    return tuple_(membership.last_read_at, func.coalesce(membership.last_read_id, ""))
+
+
+def is_below_watermark(
+    membership: StreamMembership, announcement: Announcement
+) -> bool:
+    """お知らせが既読位置以前に投稿されたものか"""
+    if membership.last_read_at is None:
+        return False
+    return (announcement.created_at, announcement.id) <= (
+        membership.last_read_at,
+        membership.last_read_id or "",
+    )
+
+
+def above_watermark_condition(membership):
+    """既読位置より新しいお知らせの条件（相関サブクエリでも使用可能）"""
+    return or_(
+        membership.last_read_at.is_(None),
+        _announcement_key() > _watermark_key(membership),
+    )
+
+
+def _mark_count(is_read, visible=None):
+    """メンバーシップの例外の件数（visible を指定すると、その条件に合うお知らせだけ）"""
+    statement = select(func.count()).select_from(AnnouncementReadMark)
+    if visible is not None:
+        statement = statement.join(
+            Announcement, Announcement.id == AnnouncementReadMark.announcement_id
+        ).where(visible)
+    return (
+        statement.where(
+            AnnouncementReadMark.membership_id == StreamMembership.id,
+            AnnouncementReadMark.is_read == is_read,
+        )
+        .correlate(StreamMembership)
+        .scalar_subquery()
+    )
+
+
+def unread_count_expression(visible=None):
+    """メンバーシップごとの未読数を求める相関スカラー式
+
+    既読位置より新しい件数 - 既読の例外 + 未読の例外
+    visible を指定すると、3つの項ともその条件に合うお知らせだけを数える。
+    """
+    above = (
+        select(func.count(Announcement.id))
+        .where(
+            Announcement.stream_id == StreamMembership.stream_id,
+            above_watermark_condition(StreamMembership),
+            true() if visible is None else visible,
+        )
+        .correlate(StreamMembership)
+        .scalar_subquery()
+    )
+    read_marks = _mark_count(true(), visible)
+    unread_marks = _mark_count(false(), visible)
+    return above - read_marks + unread_marks
+
+
+async def load_read_map(
+    session, membership: StreamMembership, announcements: Sequence[Announcement]
+) -> Dict[str, bool]:
+    """ページ内のお知らせの既読状態を1クエリで取得
+
+    announcements は id と created_at を持つもの（Announcement または FeedKey）。
+    """
+    return await load_read_map_for(session, [(membership, a) for a in announcements])
+
+
+async def load_read_map_for(
+    session, items: Sequence[Tuple[StreamMembership, Announcement]]
+) -> Dict[str, bool]:
+    """(メンバーシップ, お知らせ) の組ごとの既読状態を1クエリで取得
+
+    複数のストリームにまたがるページ（タイムライン）でも使える。
+    例外の行は同じストリームのお知らせにしか作られないため、
+    お知らせ ID だけで対応付けられる。
+    """
+    if not items:
+        return {}
+
+    statement = select(
+        AnnouncementReadMark.announcement_id, AnnouncementReadMark.is_read
+    ).where(
+        AnnouncementReadMark.membership_id.in_({m.id for m, _ in items}),
+        AnnouncementReadMark.announcement_id.in_([a.id for _, a in items]),
+    )
+    result = await session.execute(statement)
+    marks = dict(result.all())
+
+    return {a.id: marks.get(a.id, is_below_watermark(m, a)) for m, a in items}
+
+
+async def set_read(
+    session,
+    membership: StreamMembership,
+    announcement: Announcement,
+    is_read: bool,
+) -> bool:
+    """1件の既読状態を設定。状態が変わった場合は True"""
+    below = is_below_watermark(membership, announcement)
+    mark_statement = select(AnnouncementReadMark.is_read).where(
+        AnnouncementReadMark.membership_id == membership.id,
+        AnnouncementReadMark.announcement_id == announcement.id,
+    )
+    mark = (await session.execute(mark_statement)).first()
+    currently_read = mark.is_read if mark else below
+
+    if currently_read == is_read:
+        return False
+
+    if is_read == below:
+        # 既読位置どおりの状態に戻るので例外を削除
+        await session.execute(
+            delete(AnnouncementReadMark).where(
+                AnnouncementReadMark.membership_id == membership.id,
+                AnnouncementReadMark.announcement_id == announcement.id,
+            )
+        )
+    else:
+        statement = dialect_insert(session, AnnouncementReadMark).values(
+            membership_id=membership.id,
+            announcement_id=announcement.id,
+            is_read=is_read,
+            created_at=datetime.utcnow(),
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=["membership_id", "announcement_id"],
+            set_={"is_read": statement.excluded.is_read},
+        )
+        await session.execute(statement)
+
+    await apply_reaction_delta(
+        session,
+        announcement.id,
+        READ_REACTION,
+        membership.user_id,
+        1 if is_read else -1,
+    )
+    return True
+
+
+async def set_read_many(
+    session,
+    membership: StreamMembership,
+    announcements: Sequence[Announcement],
+    is_read: bool,
+) -> List[str]:
+    """複数のお知らせの既読状態をまとめて設定し、状態が変わったお知らせ ID を返す
+
+    お知らせの件数に関わらず、既読状態の取得・例外の削除・例外の追加・
+    既読数の加減算の最大4文で済ませる。
+    """
+    read_map = await load_read_map(session, membership, announcements)
+    changed = [a for a in announcements if read_map[a.id] != is_read]
+    if not changed:
+        return []
+
+    # 既読位置どおりの状態に戻るものは例外を削除し、それ以外は例外を作る
+    revert_ids = [a.id for a in changed if is_below_watermark(membership, a) == is_read]
+    mark_ids = [a.id for a in changed if is_below_watermark(membership, a) != is_read]
+    if revert_ids:
+        await session.execute(
+            delete(AnnouncementReadMark).where(
+                AnnouncementReadMark.membership_id == membership.id,
+                AnnouncementReadMark.announcement_id.in_(revert_ids),
+            )
+        )
+    if mark_ids:
+        now = datetime.utcnow()
+        statement = dialect_insert(session, AnnouncementReadMark).values(
+            [
+                {
+                    "membership_id": membership.id,
+                    "announcement_id": announcement_id,
+                    "is_read": is_read,
+                    "created_at": now,
+                }
+                for announcement_id in mark_ids
+            ]
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=["membership_id", "announcement_id"],
+            set_={"is_read": statement.excluded.is_read},
+        )
+        await session.execute(statement)
+
+    changed_ids = [a.id for a in changed]
+    await apply_reaction_deltas(
+        session, changed_ids, READ_REACTION, membership.user_id, 1 if is_read else -1
+    )
+    return changed_ids
+
+
+async def mark_read_up_to(
+    session, membership: StreamMembership, announcement: Announcement, visible=None
+) -> int:
+    """指定したお知らせまでを一括で既読にし、新たに既読になった件数を返す
+
+    既読位置を進め、新しい既読位置以前の例外はすべて削除する。
+    visible を指定すると、既読数の加算はその条件に合うお知らせに限る。
+    """
+    if is_below_watermark(membership, announcement):
+        # 既読位置は後退させない（それ以前の未読の例外だけ解消する）
+        target_created_at = membership.last_read_at
+        target_id = membership.last_read_id or ""
+    else:
+        target_created_at = announcement.created_at
+        target_id = announcement.id
+
+    has_mark = exists().where(
+        AnnouncementReadMark.membership_id == membership.id,
+        AnnouncementReadMark.announcement_id == Announcement.id,
+    )
+    above_old = (
+        true()
+        if membership.last_read_at is None
+        else _announcement_key()
+        > tuple_(membership.last_read_at, membership.last_read_id or "")
+    )
+    # 現在未読のもの = (既読位置より新しく例外なし) または (既読位置以前で例外あり)
+    newly_read = and_(
+        Announcement.stream_id == membership.stream_id,
+        _announcement_key() <= tuple_(target_created_at, target_id),
+        or_(and_(above_old, not_(has_mark)), and_(not_(above_old), has_mark)),
+        true() if visible is None else visible,
+    )
+
+    count_result = await session.execute(
+        select(func.count(Announcement.id)).where(newly_read)
+    )
+    newly_read_count = count_result.scalar_one()
+
+    if newly_read_count:
+        await apply_bulk_reaction_delta(
+            session, newly_read, READ_REACTION, membership.user_id, 1
+        )
+
+    await session.execute(
+        delete(AnnouncementReadMark).where(
+            AnnouncementReadMark.membership_id == membership.id,
+            AnnouncementReadMark.announcement_id.in_(
+                select(Announcement.id).where(
+                    Announcement.stream_id == membership.stream_id,
+                    _announcement_key() <= tuple_(target_created_at, target_id),
+                )
+            ),
+        )
+    )
+
+    membership.last_read_at = target_created_at
+    membership.last_read_id = target_id
+    session.add(membership)
+    return newly_read_count
+
+
+async def load_readers(
+    session, stream_id: str, announcement: Announcement
+) -> Dict[str, list]:
+    """お知らせを読んだメンバー・まだ読んでいないメンバーを1クエリで取得"""
+    statement = (
+        select(StreamMembership, User, AnnouncementReadMark.is_read)
+        .join(User, User.id == StreamMembership.user_id)
+        .outerjoin(
+            AnnouncementReadMark,
+            and_(
+                AnnouncementReadMark.membership_id == StreamMembership.id,
+                AnnouncementReadMark.announcement_id == announcement.id,
+            ),
+        )
+        .where(StreamMembership.stream_id == stream_id)
+        .order_by(User.name)
+    )
+    result = await session.execute(statement)
+
+    readers = {"read": [], "unread": []}
+    for membership, user, mark in result.all():
+        is_read = (
+            mark if mark is not None else is_below_watermark(membership, announcement)
+        )
+        readers["read" if is_read else "unread"].append(
+            {
+                "id": user.id,
+                "name": user.name,
+                "class_name": user.class_name,
+                "role": membership.role,
+            }
+        )
+    return readers
+
+
+async def delete_read_marks(session, announcement_ids: Sequence[str]):
+    await session.execute(
+        delete(AnnouncementReadMark).where(
+            AnnouncementReadMark.announcement_id.in_(announcement_ids)
+        )
+    )
+
+
+async def migrate_read_reactions(conn):
+    """旧方式の "read" リアクション行を既読の例外に移行
+
+    既読位置が未設定のメンバーシップでは全お知らせが既読位置より新しいため、
+    既読リアクション1行がそのまま既読の例外1行に対応し、集計値は変わらない。
+    """
+    rows = (
+        select(
+            StreamMembership.id,
+            AnnouncementReaction.announcement_id,
+            true(),
+            func.min(AnnouncementReaction.created_at),
+        )
+        .join(Announcement, Announcement.id == AnnouncementReaction.announcement_id)
+        .join(
+            StreamMembership,
+            and_(
+                StreamMembership.user_id == AnnouncementReaction.user_id,
+                StreamMembership.stream_id == Announcement.stream_id,
+            ),
+        )
+        .where(
+            AnnouncementReaction.reaction_type == READ_REACTION,
+            StreamMembership.last_read_at.is_(None),
+        )
+        .group_by(StreamMembership.id, AnnouncementReaction.announcement_id)
+    )
+    statement = (
+        dialect_insert(conn, AnnouncementReadMark)
+        .from_select(
+            ["membership_id", "announcement_id", "is_read", "created_at"], rows
+        )
+        .on_conflict_do_nothing()
+    )
+    await conn.execute(statement)
+    await conn.execute(
+        delete(AnnouncementReaction).where(
+            AnnouncementReaction.reaction_type == READ_REACTION
+        )
+    )
+
+
+async def init_read_state():
+    async with async_engine.begin() as conn:
+        legacy = await conn.execute(
+            select(AnnouncementReaction.id)
+            .where(AnnouncementReaction.reaction_type == READ_REACTION)
+            .limit(1)
+        )
+        if legacy.first() is not None:
+            await migrate_read_reactions(conn)
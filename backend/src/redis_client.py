@@ -0,0 +1,23 @@
+import os
+
+import redis.asyncio as redis
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+_redis_client = None
+
+
+def get_redis() -> redis.Redis:
+    """API ワーカー内で共有する Redis クライアント"""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.from_url(REDIS_URL)
+    return _redis_client
+
+
+def create_task_redis() -> redis.Redis:
+    """Celery のタスク用の Redis クライアント
+
+    タスクは実行ごとにイベントループが変わるため、共有クライアントは使わない。
+    """
+    return redis.from_url(REDIS_URL)
@@ -0,0 +1,163 @@
+import mimetypes
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import FileResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+
+from ..attachment_store import (
+    ATTACHMENT_MAX_BYTES,
+    AttachmentTooLarge,
+    attachment_store,
+)
+from ..auth import get_current_teacher, get_current_user, get_stream_roles
+from ..database import dialect_insert, get_async_session
+from ..membership_resolver import StreamRoles
+from ..models import Attachment, AttachmentBlob, User
+
+router = APIRouter(prefix="/api/attachments", tags=["attachments"])
+
+# 内容が変わらない（SHA-256 で識別する）ためブラウザに長期間キャッシュさせる
+CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def serialize_attachment(attachment: Attachment, size: int) -> dict:
+    """お知らせの attachments (JSON) にそのまま入れられる形式"""
+    return {
+        "id": attachment.id,
+        "filename": attachment.filename,
+        "content_type": attachment.content_type,
+        "size": size,
+        "sha256": attachment.sha256,
+        "url": f"/api/attachments/{attachment.id}",
+    }
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match に ETag が含まれるか（弱い比較）"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def _content_length(request: Request) -> Optional[int]:
+    value = request.headers.get("content-length")
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Content-Length が不正です"
+        )
+
+
+@router.post("", status_code=status.HTTP_201_CREATED)
+async def upload_attachment(
+    request: Request,
+    filename: str = Query(..., min_length=1, max_length=255),
+    stream_id: str = Query(..., description="投稿先のストリーム"),
+    current_user: User = Depends(get_current_teacher),
+    stream_roles: StreamRoles = Depends(get_stream_roles),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """添付ファイルをアップロード (教員・管理者のみ)
+
+    リクエスト本文にファイルの内容をそのまま送る（multipart ではない）。
+    Content-Type ヘッダーがファイルの種類になる。同じ内容のファイルは
+    保存済みの実体を共有する。ダウンロードは stream_id のメンバーに限られる。
+    """
+    stream_roles.require_member(stream_id)
+    content_length = _content_length(request)
+    if content_length is not None and content_length > ATTACHMENT_MAX_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="ファイルサイズが上限を超えています",
+        )
+
+    try:
+        blob = await attachment_store.save(request.stream())
+    except AttachmentTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="ファイルサイズが上限を超えています",
+        )
+
+    content_type = (
+        request.headers.get("content-type")
+        or mimetypes.guess_type(filename)[0]
+        or "application/octet-stream"
+    )
+
+    statement = (
+        dialect_insert(session, AttachmentBlob)
+        .values(sha256=blob.sha256, size=blob.size)
+        .on_conflict_do_nothing(index_elements=["sha256"])
+    )
+    await session.execute(statement)
+
+    attachment = Attachment(
+        sha256=blob.sha256,
+        filename=os.path.basename(filename),
+        content_type=content_type,
+        uploaded_by=current_user.id,
+        stream_id=stream_id,
+    )
+    session.add(attachment)
+    await session.commit()
+
+    return serialize_attachment(attachment, blob.size)
+
+
+@router.get("/{attachment_id}")
+async def download_attachment(
+    attachment_id: str,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    stream_roles: StreamRoles = Depends(get_stream_roles),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """添付ファイルをダウンロード (アップロードした本人と投稿先ストリームのメンバー)
+
+    ETag は内容の SHA-256（強い ETag）。Range / If-Range による部分取得に対応し、
+    If-None-Match が一致すれば 304 を返す。
+    """
+    result = await session.execute(
+        select(Attachment).where(Attachment.id == attachment_id)
+    )
+    attachment = result.scalars().first()
+    if not attachment:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="添付ファイルが見つかりません"
+        )
+    if attachment.uploaded_by != current_user.id:
+        if attachment.stream_id is None:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="この添付ファイルへのアクセス権限がありません",
+            )
+        stream_roles.require_member(attachment.stream_id)
+
+    etag = f'"{attachment.sha256}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    path = attachment_store.local_path(attachment.sha256)
+    if path is None or not path.exists():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="添付ファイルが見つかりません"
+        )
+
+    # ASGI サーバーが http.response.pathsend に対応していれば、
+    # 本文はサーバー側のゼロコピー送信で返される
+    return FileResponse(
+        path,
+        media_type=attachment.content_type,
+        filename=attachment.filename,
+        headers=headers,
+    )
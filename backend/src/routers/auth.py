@@ -1,14 +1,17 @@
 from datetime import datetime
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
 from fastapi.responses import RedirectResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import select
 
 from ..auth import auth_manager, get_current_user
 from ..database import get_async_session
+from ..google_oauth import GoogleOAuthUnavailableError
+from ..membership_resolver import stream_role_claims
 from ..models import User
-from ..sample_data import ensure_user_has_sample_data
+from ..sample_data import join_default_streams, schedule_sample_data
+from ..user_cache import user_cache
 
 router = APIRouter(prefix="/api/auth", tags=["authentication"])
 
@@ -21,14 +24,16 @@ async def google_login():
 
 @router.get("/google/callback")
 async def google_callback(
-    code: str, session: AsyncSession = Depends(get_async_session)
+    code: str,
+    background_tasks: BackgroundTasks,
+    session: AsyncSession = Depends(get_async_session),
 ):
     try:
         # Exchange code for token
         token = await auth_manager.exchange_code_for_token(code)
 
-        # Get user info from Google
-        user_info = await auth_manager.get_user_info(token["access_token"])
+        # Get user info from the verified id_token
+        user_info = await auth_manager.get_user_info(token)
 
         # Check if user exists
         statement = select(User).where(User.email == user_info["email"])
@@ -55,17 +60,21 @@ async def google_callback(
             user.updated_at = datetime.utcnow()
             session.add(user)
             await session.commit()
+            await user_cache.invalidate(user.id)
 
-        # 全ユーザーに対してサンプルデータを保証（新規・既存問わず）
-        try:
-            await ensure_user_has_sample_data(session, user)
-        except Exception as e:
-            # サンプルデータ作成に失敗してもログインは継続
-            print(f"サンプルデータ作成エラー: {e}")
+        # 既定のストリームへの参加はトークンに含めるためここで行い、
+        # 課題・イベントのサンプルはレスポンス後に作成する（ログインは待たない）
+        await join_default_streams(session, user)
+        schedule_sample_data(background_tasks, user)
 
         # Create tokens
         access_token = auth_manager.create_access_token(
-            data={"sub": user.id, "email": user.email, "role": user.role.value}
+            data={
+                "sub": user.id,
+                "email": user.email,
+                "role": user.role.value,
+                **await stream_role_claims(session, user.id),
+            }
         )
         refresh_token = auth_manager.create_refresh_token(data={"sub": user.id})
 
@@ -83,6 +92,11 @@ async def google_callback(
             },
         }
 
+    except GoogleOAuthUnavailableError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Authentication unavailable: {str(e)}",
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -108,9 +122,17 @@ async def refresh_token(
                 status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
             )
 
+        # ログインの更新時はキャッシュ済みのユーザー情報を読み直させる
+        await user_cache.invalidate(user.id)
+
         # Create new access token
         access_token = auth_manager.create_access_token(
-            data={"sub": user.id, "email": user.email, "role": user.role.value}
+            data={
+                "sub": user.id,
+                "email": user.email,
+                "role": user.role.value,
+                **await stream_role_claims(session, user.id),
+            }
         )
 
         return {"access_token": access_token, "token_type": "bearer"}
@@ -151,7 +173,12 @@ async def dev_login(session: AsyncSession = Depends(get_async_session)):
 
     # JWTトークンを作成
     access_token = auth_manager.create_access_token(
-        data={"sub": user.id, "email": user.email, "role": user.role.value}
+        data={
+            "sub": user.id,
+            "email": user.email,
+            "role": user.role.value,
+            **await stream_role_claims(session, user.id),
+        }
     )
 
     return {
@@ -168,7 +195,10 @@ async def dev_login(session: AsyncSession = Depends(get_async_session)):
 
 
 @router.post("/super_admin/login")
-async def super_admin_login(session: AsyncSession = Depends(get_async_session)):
+async def super_admin_login(
+    background_tasks: BackgroundTasks,
+    session: AsyncSession = Depends(get_async_session),
+):
     """super_admin用ログイン：固定のsuper_adminユーザーでログイン"""
     # super_adminユーザーを取得または作成
     statement = select(User).where(User.email == "super_admin@campusflow.com")
@@ -189,15 +219,19 @@ async def super_admin_login(session: AsyncSession = Depends(get_async_session)):
         await session.commit()
         await session.refresh(user)
 
-        # サンプルデータを作成
-        try:
-            await ensure_user_has_sample_data(session, user)
-        except Exception as e:
-            print(f"サンプルデータ作成エラー: {e}")
+    # 既定のストリームへの参加はトークンに含めるためここで行い、
+    # 課題・イベントのサンプルはレスポンス後に作成する
+    await join_default_streams(session, user)
+    schedule_sample_data(background_tasks, user)
 
     # JWTトークンを作成
     access_token = auth_manager.create_access_token(
-        data={"sub": user.id, "email": user.email, "role": user.role.value}
+        data={
+            "sub": user.id,
+            "email": user.email,
+            "role": user.role.value,
+            **await stream_role_claims(session, user.id),
+        }
     )
 
     return {
@@ -7,7 +7,13 @@ from pydantic import BaseModel
 from ..auth import get_current_user
 from ..brainstorm_service import BrainstormSession, get_brainstorm_service
 from ..database import get_async_session
+from ..feed_cache import feed_cache
+from ..feed_service import serialize_announcement
+from ..membership_resolver import resolve_stream_roles
 from ..models import StreamMembership, StreamRole, User
+from ..rate_limit import rate_limit
+from ..search_service import search_backend
+from ..stream_events import publish_stream_event
 
 router = APIRouter(prefix="/api/brainstorm", tags=["brainstorm"])
 
@@ -70,28 +76,16 @@ manager = ConnectionManager()
 
 # Helper function to check stream admin permission
 async def verify_stream_admin(user: User, stream_id: str, db):
-    from sqlmodel import or_, select
-
     from ..models import UserRole
 
     # Super admins have access to everything
     if user.role == UserRole.SUPER_ADMIN:
-        return None  # No need to return membership for super admins
-
-    statement = select(StreamMembership).where(
-        StreamMembership.user_id == user.id,
-        StreamMembership.stream_id == stream_id,
-        or_(
-            StreamMembership.role == StreamRole.STREAM_ADMIN,
-            StreamMembership.role == StreamRole.ADMIN,
-        ),
-    )
-    result = await db.execute(statement)
-    membership = result.scalars().first()
+        return None  # No need to return a role for super admins
 
-    if not membership:
+    stream_roles = await resolve_stream_roles(db, user.id)
+    if not stream_roles.is_admin_of(stream_id):
         raise HTTPException(status_code=403, detail="User is not admin of this stream")
-    return membership
+    return stream_roles.role_in(stream_id)
 
 
 @router.post("/sessions")
@@ -138,7 +132,10 @@ async def get_session(
     return session_data
 
 
-@router.post("/sessions/{session_id}/ideas")
+@router.post(
+    "/sessions/{session_id}/ideas",
+    dependencies=[Depends(rate_limit("brainstorm_idea", per=("session_id",)))],
+)
 async def submit_idea(
     session_id: str,
     request: IdeaSubmitRequest,
@@ -387,9 +384,17 @@ async def save_summary(
     )
 
     db.add(new_announcement)
+    await search_backend.index_announcement(db, new_announcement)
     await db.commit()
     await db.refresh(new_announcement)
 
+    await feed_cache.invalidate_stream(new_announcement.stream_id)
+    await publish_stream_event(
+        new_announcement.stream_id,
+        "announcement:new",
+        serialize_announcement(new_announcement, creator=current_user),
+    )
+
     # Delete the brainstorm session after saving
     await service.delete_session(session_id, current_user.id)
 
@@ -419,18 +424,16 @@ async def websocket_endpoint(
 ):
     """WebSocket endpoint for real-time updates"""
     try:
-        # Verify token
-        from jose import JWTError, jwt
-
-        from ..auth import JWT_ALGORITHM, JWT_SECRET_KEY
+        # Verify token (verified payloads are cached until exp)
+        from ..auth import auth_manager
 
         try:
-            payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+            payload = auth_manager.verify_token(token)
             user_id = payload.get("sub")
             if not user_id:
                 await websocket.close(code=1008, reason="Invalid token")
                 return
-        except JWTError:
+        except HTTPException:
             await websocket.close(code=1008, reason="Invalid token")
             return
 
@@ -9,7 +9,9 @@ from sqlmodel import select, update
 
 from ..auth import get_current_user
 from ..database import get_async_session
+from ..membership_resolver import invalidate_stream_roles
 from ..models import Stream, StreamMembership, StreamRole, User
+from ..user_cache import user_cache
 
 router = APIRouter(prefix="/api/profile", tags=["profile"])
 
@@ -61,6 +63,8 @@ async def elevate_to_stream_admin(
 
     result = await session.execute(statement)
     await session.commit()
+    await user_cache.invalidate(current_user.id)
+    await invalidate_stream_roles([current_user.id])
 
     # Check if any rows were affected
     if result.rowcount == 0:
@@ -135,6 +139,8 @@ async def elevate_to_stream_admin_for_specific_stream(
     membership.role = StreamRole.STREAM_ADMIN
     session.add(membership)
     await session.commit()
+    await user_cache.invalidate(current_user.id)
+    await invalidate_stream_roles([current_user.id])
 
     return {
         "status": "ok",
@@ -252,6 +258,7 @@ async def update_profile(
 
     session.add(current_user)
     await session.commit()
+    await user_cache.invalidate(current_user.id)
     await session.refresh(current_user)
 
     # 更新されたユーザー情報を返す
@@ -1,16 +1,65 @@
+import asyncio
 import json
 from datetime import datetime
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, Form, HTTPException, Query, status
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    Form,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlmodel import and_, or_, select
-
-from ..auth import get_current_teacher, get_current_user, require_stream_role
+from sqlmodel import and_, func, select
+
+from ..announcement_archive import delete_announcements
+from ..announcement_tags import TagFilter, load_tag_facets, set_announcement_tags
+from ..announcement_targets import (
+    announcement_targets,
+    audience_condition,
+    audience_for,
+    audience_for_roles,
+    membership_visibility_condition,
+    set_announcement_targets,
+)
+from ..auth import (
+    auth_manager,
+    get_current_teacher,
+    get_current_user,
+    get_stream_roles,
+    require_stream_role,
+)
 from ..database import get_async_session
+from ..feed_cache import feed_cache
+from ..feed_service import (
+    FEED_ORDER,
+    apply_timeline_overlay,
+    apply_user_overlay,
+    build_announcement_feed,
+    build_shared_feed,
+    encode_feed_cursor,
+    encode_timeline_cursor,
+    feed_keyset_condition,
+    load_creators,
+    serialize_announcement,
+    timeline_keyset_condition,
+    timeline_statement,
+)
+from ..membership_resolver import (
+    StreamRoles,
+    invalidate_stream_roles,
+    resolve_stream_roles,
+)
 from ..models import (
     Announcement,
-    AnnouncementReaction,
     AnnouncementType,
     Stream,
     StreamMembership,
@@ -18,176 +67,270 @@ from ..models import (
     StreamType,
     User,
 )
+from ..rate_limit import rate_limit
+from ..reaction_counters import load_reaction_counts
+from ..reactions import add_reactions, remove_reactions, toggle_reaction
+from ..read_receipts import (
+    record_read_receipts,
+    record_urgent_reads,
+    summarize_read_receipts,
+    urgent_ids_newly_read,
+)
+from ..read_state import (
+    READ_REACTION,
+    load_read_map,
+    load_readers,
+    mark_read_up_to,
+    set_read,
+    set_read_many,
+    unread_count_expression,
+)
+from ..search_service import load_ranked_announcements, search_backend, snippet_fields
+from ..stream_events import (
+    event_for_audience,
+    format_sse,
+    publish_stream_event,
+    stream_event_hub,
+)
+from ..stream_members import (
+    MEMBER_ORDER,
+    MemberRow,
+    encode_member_cursor,
+    import_memberships,
+    iter_csv_members,
+    iter_upload_chunks,
+    member_filter_condition,
+    member_keyset_condition,
+)
+from ..urgent_notifications import enqueue_urgent_notification
 
 router = APIRouter(prefix="/api/streams", tags=["streams"])
 
+optional_security = HTTPBearer(auto_error=False)
+
+# SSE 接続を維持するためのコメント送信間隔（秒）
+EVENT_KEEPALIVE_SECONDS = 15
+
 
 @router.get("", response_model=List[dict])
 async def get_my_streams(
     current_user: User = Depends(get_current_user),
     session: AsyncSession = Depends(get_async_session),
 ):
-    """ユーザーが参加しているストリーム一覧を取得"""
+    """ユーザーが参加しているストリーム一覧を取得
+
+    メンバーシップ・ストリームの結合と未読数の集計サブクエリを1回で取得する。
+    """
+
+    # 既読位置と例外から求めた未読数（対象外のお知らせは数えない）
+    unread_count = unread_count_expression(
+        membership_visibility_condition(current_user)
+    )
 
-    # ユーザーのストリームメンバーシップを取得
-    statement = select(StreamMembership).where(
-        StreamMembership.user_id == current_user.id
+    statement = (
+        select(StreamMembership, Stream, unread_count)
+        .join(Stream, Stream.id == StreamMembership.stream_id)
+        .where(StreamMembership.user_id == current_user.id)
     )
     result = await session.execute(statement)
-    memberships = result.scalars().all()
 
     streams = []
-    for membership in memberships:
-        # 各ストリーム情報を取得
-        stream_statement = select(Stream).where(Stream.id == membership.stream_id)
-        stream_result = await session.execute(stream_statement)
-        stream = stream_result.scalars().first()
-
-        if stream:
-            # 最新のお知らせ数を取得
-            announcement_statement = (
-                select(Announcement)
-                .where(Announcement.stream_id == stream.id)
-                .order_by(Announcement.created_at.desc())
-                .limit(5)
-            )
-            announcement_result = await session.execute(announcement_statement)
-            recent_announcements = announcement_result.scalars().all()
+    for membership, stream, unread in result.all():
+        streams.append(
+            {
+                "id": stream.id,
+                "name": stream.name,
+                "description": stream.description,
+                "stream_type": stream.stream_type,
+                "class_name": stream.class_name,
+                "subject_name": stream.subject_name,
+                "grade": stream.grade,
+                "is_public": stream.is_public,
+                "allow_student_posts": stream.allow_student_posts,
+                "membership": {
+                    "role": membership.role,
+                    "joined_at": membership.joined_at,
+                    "last_read_at": membership.last_read_at,
+                },
+                "recent_announcements_count": unread,
+                "unread_count": unread,
+                "created_at": stream.created_at,
+            }
+        )
 
-            streams.append(
-                {
-                    "id": stream.id,
-                    "name": stream.name,
-                    "description": stream.description,
-                    "stream_type": stream.stream_type,
-                    "class_name": stream.class_name,
-                    "subject_name": stream.subject_name,
-                    "grade": stream.grade,
-                    "is_public": stream.is_public,
-                    "allow_student_posts": stream.allow_student_posts,
-                    "membership": {
-                        "role": membership.role,
-                        "joined_at": membership.joined_at,
-                    },
-                    "recent_announcements_count": len(recent_announcements),
-                    "created_at": stream.created_at,
-                }
+    return streams
+
+
+@router.get("/timeline", dependencies=[Depends(rate_limit("feed"))])
+async def get_timeline(
+    response: Response,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    is_urgent: Optional[bool] = None,
+    announcement_type: Optional[AnnouncementType] = None,
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """参加しているすべてのストリームのお知らせを新しい順に取得
+
+    次ページのカーソルは X-Next-Cursor ヘッダーで返す。ピン留めは考慮しない。
+    """
+    membership_result = await session.execute(
+        select(StreamMembership, Stream)
+        .join(Stream, Stream.id == StreamMembership.stream_id)
+        .where(StreamMembership.user_id == current_user.id)
+    )
+    rows = membership_result.all()
+    if not rows:
+        return []
+    memberships = {membership.stream_id: membership for membership, _ in rows}
+    streams = {stream.id: stream for _, stream in rows}
+
+    conditions = []
+    audience = audience_for(current_user, list(memberships.values()))
+    if audience is not None:
+        conditions.append(audience_condition(audience))
+    if is_urgent is not None:
+        conditions.append(Announcement.is_urgent == is_urgent)
+    if announcement_type is not None:
+        conditions.append(Announcement.announcement_type == announcement_type)
+    if cursor:
+        try:
+            conditions.append(timeline_keyset_condition(cursor))
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="カーソルが不正です"
             )
 
-    return streams
+    result = await session.execute(
+        timeline_statement(list(memberships), conditions, limit)
+    )
+    announcements = result.scalars().all()
+    if len(announcements) == limit:
+        response.headers["X-Next-Cursor"] = encode_timeline_cursor(announcements[-1])
+
+    feed = await build_shared_feed(session, announcements)
+    for item, announcement in zip(feed, announcements):
+        stream = streams[announcement.stream_id]
+        item["stream_id"] = stream.id
+        item["stream"] = {
+            "id": stream.id,
+            "name": stream.name,
+            "stream_type": stream.stream_type,
+            "class_name": stream.class_name,
+            "subject_name": stream.subject_name,
+        }
+    return await apply_timeline_overlay(session, feed, current_user.id, memberships)
 
 
-@router.get("/{stream_id}/announcements")
+@router.get("/{stream_id}/announcements", dependencies=[Depends(rate_limit("feed"))])
 async def get_stream_announcements(
     stream_id: str,
+    response: Response,
     skip: int = Query(0, ge=0),
     limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
     search: Optional[str] = None,
+    tag: Optional[str] = Query(None, description="タグの完全一致"),
+    tag_prefix: Optional[str] = Query(None, description="タグの前方一致"),
+    include_archive: bool = Query(False, description="検索でアーカイブ済みも対象にする"),
     current_user: User = Depends(get_current_user),
     session: AsyncSession = Depends(get_async_session),
 ):
-    """ストリームのお知らせ一覧を取得（全文検索対応）"""
+    """ストリームのお知らせ一覧を取得（全文検索対応）
 
-    # ユーザーがストリームのメンバーかチェック
-    membership_statement = select(StreamMembership).where(
-        and_(
-            StreamMembership.user_id == current_user.id,
-            StreamMembership.stream_id == stream_id,
-        )
-    )
-    membership_result = await session.execute(membership_statement)
-    membership = membership_result.scalars().first()
+    cursor を指定するとキーセットページネーションで次のページを返す
+    （skip は無視される）。次ページのカーソルは X-Next-Cursor ヘッダーで返す。
+    include_archive は全文検索の場合のみ有効で、フィードは現在のお知らせだけを返す。
+    """
 
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN, detail="このストリームへのアクセス権限がありません"
-        )
+    # ユーザーがストリームのメンバーかチェック
+    membership = await get_membership_or_403(session, current_user.id, stream_id)
 
     # お知らせを検索
     statement = select(Announcement).where(Announcement.stream_id == stream_id)
 
-    # 全文検索
+    # 対象学年・クラスによる絞り込み（教員・ストリーム管理者は全件）
+    audience = audience_for(current_user, [membership])
+    if audience is not None:
+        statement = statement.where(audience_condition(audience))
+
+    # タグによる絞り込み（転置インデックスを使用）
+    tag_filter = TagFilter.from_params(tag, tag_prefix)
+    if tag_filter is not None:
+        statement = statement.where(tag_filter.condition())
+
+    # 全文検索（関連度順、カーソルは使わず skip/limit でページング）
     if search:
-        search_condition = or_(
-            Announcement.title.ilike(f"%{search}%"),
-            Announcement.content.ilike(f"%{search}%"),
-            Announcement.tags.ilike(f"%{search}%"),
+        hits = await search_backend.search(
+            session,
+            search,
+            [stream_id],
+            limit=limit,
+            offset=skip,
+            audience=audience,
+            tag_filter=tag_filter,
+            include_archive=include_archive,
         )
-        statement = statement.where(search_condition)
-
-    statement = (
-        statement.order_by(
-            Announcement.is_pinned.desc(), Announcement.created_at.desc()  # ピン留め優先
+        ranked = await load_ranked_announcements(session, hits, include_archive)
+        announcements = [announcement for _, announcement in ranked]
+        feed = await build_announcement_feed(
+            session, announcements, current_user.id, membership
         )
-        .offset(skip)
-        .limit(limit)
-    )
+        for item, (hit, announcement) in zip(feed, ranked):
+            item.update(snippet_fields(announcement, search))
+            item["score"] = hit.score
+        return feed
+
+    # 共通部分はキャッシュから取得し、ユーザーごとの部分だけ毎回重ねる
+    cache_params = {
+        "cursor": cursor,
+        "skip": 0 if cursor else skip,
+        "limit": limit,
+        "audience": audience.cache_key() if audience else None,
+        "tags": tag_filter.cache_key() if tag_filter else None,
+    }
+    version, page = await feed_cache.get_page(stream_id, cache_params)
 
-    result = await session.execute(statement)
-    announcements = result.scalars().all()
+    if page is None:
+        page = await load_feed_page(session, statement, cursor, skip, limit)
+        await feed_cache.set_page(stream_id, version, cache_params, page)
 
-    # 各お知らせの作成者とリアクション情報を取得
-    response_data = []
-    for announcement in announcements:
-        # 作成者情報を取得
-        creator_statement = select(User).where(User.id == announcement.created_by)
-        creator_result = await session.execute(creator_statement)
-        creator = creator_result.scalars().first()
-
-        # ユーザーのリアクション情報を取得
-        reaction_statement = select(AnnouncementReaction).where(
-            and_(
-                AnnouncementReaction.announcement_id == announcement.id,
-                AnnouncementReaction.user_id == current_user.id,
-            )
-        )
-        reaction_result = await session.execute(reaction_statement)
-        user_reactions = reaction_result.scalars().all()
+    if page["next_cursor"]:
+        response.headers["X-Next-Cursor"] = page["next_cursor"]
 
-        # 全体のリアクション数を取得
-        total_reactions_statement = select(AnnouncementReaction).where(
-            AnnouncementReaction.announcement_id == announcement.id
-        )
-        total_reactions_result = await session.execute(total_reactions_statement)
-        total_reactions = total_reactions_result.scalars().all()
-
-        # リアクション集計
-        reaction_counts = {}
-        for reaction in total_reactions:
-            reaction_counts[reaction.reaction_type] = (
-                reaction_counts.get(reaction.reaction_type, 0) + 1
+    # ユーザーのリアクション・既読状態をページ単位でまとめて取得
+    return await apply_user_overlay(session, page["items"], current_user.id, membership)
+
+
+async def load_feed_page(
+    session: AsyncSession, statement, cursor: Optional[str], skip: int, limit: int
+) -> dict:
+    """フィード1ページ分の共通部分（キャッシュ可能な JSON）を組み立てる"""
+    if cursor:
+        try:
+            statement = statement.where(feed_keyset_condition(cursor))
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="カーソルが不正です"
             )
+    elif skip:
+        statement = statement.offset(skip)
 
-        response_data.append(
-            {
-                "id": announcement.id,
-                "title": announcement.title,
-                "content": announcement.content,
-                "announcement_type": announcement.announcement_type,
-                "is_urgent": announcement.is_urgent,
-                "is_pinned": announcement.is_pinned,
-                "tags": json.loads(announcement.tags) if announcement.tags else [],
-                "attachments": json.loads(announcement.attachments)
-                if announcement.attachments
-                else [],
-                "creator": {
-                    "id": creator.id,
-                    "name": creator.name,
-                    "picture_url": creator.picture_url,
-                }
-                if creator
-                else None,
-                "user_reactions": [r.reaction_type for r in user_reactions],
-                "reaction_counts": reaction_counts,
-                "created_at": announcement.created_at,
-                "updated_at": announcement.updated_at,
-            }
-        )
+    statement = statement.order_by(*FEED_ORDER).limit(limit)
 
-    return response_data
+    result = await session.execute(statement)
+    announcements = result.scalars().all()
+
+    return {
+        "items": jsonable_encoder(await build_shared_feed(session, announcements)),
+        "next_cursor": encode_feed_cursor(announcements[-1])
+        if len(announcements) == limit
+        else None,
+    }
 
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class AnnouncementCreateRequest(BaseModel):
@@ -205,23 +348,15 @@ class AnnouncementCreateRequest(BaseModel):
 async def create_announcement(
     stream_id: str,
     request: AnnouncementCreateRequest,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(require_stream_role({"stream_admin", "admin"})),
+    stream_roles: StreamRoles = Depends(get_stream_roles),
     session: AsyncSession = Depends(get_async_session),
 ):
     """お知らせを作成"""
 
-    # Get user's role to check for pinning permission
-    membership_statement = select(StreamMembership).where(
-        and_(
-            StreamMembership.user_id == current_user.id,
-            StreamMembership.stream_id == stream_id,
-        )
-    )
-    membership_result = await session.execute(membership_statement)
-    membership = membership_result.scalars().first()
-
     # ピン留めは管理者のみ
-    if request.is_pinned and membership and membership.role != StreamRole.ADMIN:
+    if request.is_pinned and stream_roles.role_in(stream_id) != StreamRole.ADMIN:
         request.is_pinned = False
 
     # AnnouncementTypeエナムに変換
@@ -237,21 +372,30 @@ async def create_announcement(
         announcement_type=announcement_type_enum,
         is_urgent=request.is_urgent,
         is_pinned=request.is_pinned,
-        tags=json.dumps(request.tags) if request.tags else None,
         stream_id=stream_id,
-        target_grades=json.dumps(request.target_grades)
-        if request.target_grades
-        else None,
-        target_classes=json.dumps(request.target_classes)
-        if request.target_classes
-        else None,
         created_by=current_user.id,
     )
 
     session.add(announcement)
+    await session.flush()
+    await set_announcement_targets(
+        session, announcement, request.target_grades, request.target_classes
+    )
+    await set_announcement_tags(session, announcement, request.tags)
+    await search_backend.index_announcement(session, announcement)
     await session.commit()
+    await feed_cache.invalidate_stream(stream_id)
     await session.refresh(announcement)
 
+    await publish_stream_event(
+        stream_id,
+        "announcement:new",
+        serialize_announcement(announcement, creator=current_user),
+        targets=announcement_targets(announcement),
+    )
+    if announcement.is_urgent:
+        background_tasks.add_task(enqueue_urgent_notification, announcement.id)
+
     return {
         "id": announcement.id,
         "title": announcement.title,
@@ -277,6 +421,7 @@ async def update_announcement(
     target_grades: Optional[List[int]] = None,
     target_classes: Optional[List[str]] = None,
     current_user: User = Depends(get_current_user),
+    stream_roles: StreamRoles = Depends(get_stream_roles),
     session: AsyncSession = Depends(get_async_session),
 ):
     """お知らせを編集 (作成者または管理者のみ)"""
@@ -293,22 +438,9 @@ async def update_announcement(
             status_code=status.HTTP_404_NOT_FOUND, detail="お知らせが見つかりません"
         )
 
-    # ユーザーのロールを取得
-    membership_statement = select(StreamMembership).where(
-        and_(
-            StreamMembership.user_id == current_user.id,
-            StreamMembership.stream_id == stream_id,
-        )
-    )
-    membership_result = await session.execute(membership_statement)
-    membership = membership_result.scalars().first()
-
     # 作成者または管理者のみ編集可能
     is_creator = announcement.created_by == current_user.id
-    is_admin = membership and membership.role in [
-        StreamRole.STREAM_ADMIN,
-        StreamRole.ADMIN,
-    ]
+    is_admin = stream_roles.is_admin_of(stream_id)
 
     if not (is_creator or is_admin):
         raise HTTPException(
@@ -316,11 +448,7 @@ async def update_announcement(
         )
 
     # ピン留めは管理者のみ
-    if (
-        is_pinned is not None
-        and is_pinned
-        and not (membership and membership.role == StreamRole.ADMIN)
-    ):
+    if is_pinned and stream_roles.role_in(stream_id) != StreamRole.ADMIN:
         is_pinned = False
 
     # 更新
@@ -332,18 +460,26 @@ async def update_announcement(
         announcement.is_urgent = is_urgent
     if is_pinned is not None:
         announcement.is_pinned = is_pinned
-    if tags is not None:
-        announcement.tags = json.dumps(tags)
-    if target_grades is not None:
-        announcement.target_grades = json.dumps(target_grades)
-    if target_classes is not None:
-        announcement.target_classes = json.dumps(target_classes)
+    await set_announcement_tags(session, announcement, tags)
+    await set_announcement_targets(session, announcement, target_grades, target_classes)
     announcement.updated_at = datetime.now()
 
     session.add(announcement)
+    await search_backend.index_announcement(session, announcement)
     await session.commit()
+    await feed_cache.invalidate_stream(stream_id)
     await session.refresh(announcement)
 
+    creators = await load_creators(session, [announcement])
+    await publish_stream_event(
+        stream_id,
+        "announcement:update",
+        serialize_announcement(
+            announcement, creator=creators.get(announcement.created_by)
+        ),
+        targets=announcement_targets(announcement),
+    )
+
     return {
         "id": announcement.id,
         "title": announcement.title,
@@ -361,6 +497,7 @@ async def delete_announcement(
     stream_id: str,
     announcement_id: str,
     current_user: User = Depends(get_current_user),
+    stream_roles: StreamRoles = Depends(get_stream_roles),
     session: AsyncSession = Depends(get_async_session),
 ):
     """お知らせを削除 (作成者または管理者のみ)"""
@@ -377,41 +514,24 @@ async def delete_announcement(
             status_code=status.HTTP_404_NOT_FOUND, detail="お知らせが見つかりません"
         )
 
-    # ユーザーのロールを取得
-    membership_statement = select(StreamMembership).where(
-        and_(
-            StreamMembership.user_id == current_user.id,
-            StreamMembership.stream_id == stream_id,
-        )
-    )
-    membership_result = await session.execute(membership_statement)
-    membership = membership_result.scalars().first()
-
     # 作成者または管理者のみ削除可能
     is_creator = announcement.created_by == current_user.id
-    is_admin = membership and membership.role in [
-        StreamRole.STREAM_ADMIN,
-        StreamRole.ADMIN,
-    ]
+    is_admin = stream_roles.is_admin_of(stream_id)
 
     if not (is_creator or is_admin):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="この投稿を削除する権限がありません"
         )
 
-    # 関連するリアクションも削除
-    reaction_statement = select(AnnouncementReaction).where(
-        AnnouncementReaction.announcement_id == announcement_id
-    )
-    reaction_result = await session.execute(reaction_statement)
-    reactions = reaction_result.scalars().all()
-
-    for reaction in reactions:
-        await session.delete(reaction)
-
-    # お知らせを削除
-    await session.delete(announcement)
+    # 関連する行も含めて集合演算でまとめて削除
+    await delete_announcements(session, [announcement_id])
+    await search_backend.remove_announcement(session, announcement_id)
     await session.commit()
+    await feed_cache.invalidate_stream(stream_id)
+
+    await publish_stream_event(
+        stream_id, "announcement:delete", {"id": announcement_id}
+    )
 
     return {"message": "お知らせを削除しました", "deleted_id": announcement_id}
 
@@ -422,90 +542,395 @@ async def add_reaction(
     announcement_id: str,
     reaction_type: str,
     current_user: User = Depends(get_current_user),
+    stream_roles: StreamRoles = Depends(get_stream_roles),
     session: AsyncSession = Depends(get_async_session),
 ):
     """お知らせにリアクションを追加"""
 
-    # 既存のリアクションをチェック
-    existing_reaction_statement = select(AnnouncementReaction).where(
-        and_(
-            AnnouncementReaction.announcement_id == announcement_id,
-            AnnouncementReaction.user_id == current_user.id,
-            AnnouncementReaction.reaction_type == reaction_type,
-        )
+    # 既読はリアクション行ではなく既読位置と例外で管理する
+    if reaction_type == READ_REACTION:
+        return await toggle_read(stream_id, announcement_id, current_user, session)
+
+    stream_roles.require_member(stream_id)
+    await get_announcement_or_404(session, stream_id, announcement_id)
+
+    # 削除を試してから追加する（一意制約により二重タップでも重複しない）
+    delta = await toggle_reaction(
+        session, announcement_id, current_user.id, reaction_type
     )
-    existing_result = await session.execute(existing_reaction_statement)
-    existing_reaction = existing_result.scalars().first()
+    await session.commit()
 
-    if existing_reaction:
-        # 既存のリアクションを削除（トグル）
-        await session.delete(existing_reaction)
-        await session.commit()
+    if delta:
+        await feed_cache.invalidate_stream(stream_id)
+        await publish_reaction_delta(stream_id, announcement_id, reaction_type, delta)
+    if delta < 0:
         return {"message": "リアクションを削除しました"}
+    return {"message": "リアクションを追加しました"}
+
+
+class ReactionBatchRequest(BaseModel):
+    announcement_ids: List[str] = Field(..., min_length=1, max_length=100)
+    reaction_type: str
+    active: bool = True  # False で取り消し
+
+
+@router.post("/{stream_id}/reactions/batch")
+async def apply_reactions_batch(
+    stream_id: str,
+    request: ReactionBatchRequest,
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """複数のお知らせにリアクションをまとめて設定（例: 30件をまとめて既読にする）
+
+    トグルではなく active の状態に揃えるため、同じリクエストを再送しても結果は同じ。
+    """
+    membership = await get_membership_or_403(session, current_user.id, stream_id)
+
+    announcement_ids = list(dict.fromkeys(request.announcement_ids))
+    result = await session.execute(
+        select(Announcement).where(
+            Announcement.stream_id == stream_id,
+            Announcement.id.in_(announcement_ids),
+        )
+    )
+    announcements = result.scalars().all()
+    if len(announcements) != len(announcement_ids):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="お知らせが見つかりません"
+        )
+
+    if request.reaction_type == READ_REACTION:
+        changed = await set_read_many(
+            session, membership, announcements, request.active
+        )
+    elif request.active:
+        changed = await add_reactions(
+            session, announcement_ids, current_user.id, request.reaction_type
+        )
     else:
-        # 新しいリアクションを追加
-        reaction = AnnouncementReaction(
-            announcement_id=announcement_id,
-            user_id=current_user.id,
-            reaction_type=reaction_type,
+        changed = await remove_reactions(
+            session, announcement_ids, current_user.id, request.reaction_type
         )
-        session.add(reaction)
-        await session.commit()
+    await session.commit()
+
+    if changed:
+        await feed_cache.invalidate_stream(stream_id)
+        if request.reaction_type == READ_REACTION:
+            await record_urgent_reads(
+                session, membership, announcements, changed, request.active
+            )
+        for announcement_id in changed:
+            await publish_reaction_delta(
+                stream_id,
+                announcement_id,
+                request.reaction_type,
+                1 if request.active else -1,
+            )
+
+    changed_ids = set(changed)
+    return {
+        "changed": changed,
+        "unchanged": [i for i in announcement_ids if i not in changed_ids],
+    }
+
+
+async def publish_reaction_delta(
+    stream_id: str, announcement_id: str, reaction_type: str, delta: int
+):
+    await publish_stream_event(
+        stream_id,
+        "reaction:delta",
+        {
+            "announcement_id": announcement_id,
+            "reaction_type": reaction_type,
+            "delta": delta,
+        },
+    )
+
+
+async def get_membership_or_403(
+    session: AsyncSession, user_id: str, stream_id: str
+) -> StreamMembership:
+    membership_statement = select(StreamMembership).where(
+        and_(
+            StreamMembership.user_id == user_id,
+            StreamMembership.stream_id == stream_id,
+        )
+    )
+    membership_result = await session.execute(membership_statement)
+    membership = membership_result.scalars().first()
+
+    if not membership:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="このストリームへのアクセス権限がありません"
+        )
+    return membership
+
+
+async def get_announcement_or_404(
+    session: AsyncSession, stream_id: str, announcement_id: str
+) -> Announcement:
+    announcement_statement = select(Announcement).where(
+        and_(Announcement.id == announcement_id, Announcement.stream_id == stream_id)
+    )
+    announcement_result = await session.execute(announcement_statement)
+    announcement = announcement_result.scalars().first()
+
+    if not announcement:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="お知らせが見つかりません"
+        )
+    return announcement
+
+
+async def toggle_read(
+    stream_id: str, announcement_id: str, current_user: User, session: AsyncSession
+):
+    """お知らせ1件の既読/未読を切り替え"""
+    membership = await get_membership_or_403(session, current_user.id, stream_id)
+    announcement = await get_announcement_or_404(session, stream_id, announcement_id)
+
+    read_map = await load_read_map(session, membership, [announcement])
+    is_read = not read_map[announcement.id]
+    changed = await set_read(session, membership, announcement, is_read)
+    await session.commit()
+
+    if changed:
+        await feed_cache.invalidate_stream(stream_id)
+        await record_urgent_reads(
+            session, membership, [announcement], [announcement.id], is_read
+        )
+        await publish_reaction_delta(
+            stream_id, announcement_id, READ_REACTION, 1 if is_read else -1
+        )
+
+    if is_read:
         return {"message": "リアクションを追加しました"}
+    return {"message": "リアクションを削除しました"}
+
+
+@router.get("/{stream_id}/events")
+async def stream_events(
+    stream_id: str,
+    request: Request,
+    token: Optional[str] = Query(None, description="EventSource 用のアクセストークン"),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """ストリームの更新を Server-Sent Events で配信
+
+    EventSource はヘッダーを設定できないため、トークンはクエリパラメータでも受け付ける。
+    イベント: announcement:new / announcement:update / announcement:delete / reaction:delta
+    対象学年・クラスが閲覧者に合わないお知らせのイベントは送らない。
+    """
+    access_token = credentials.credentials if credentials else token
+    if not access_token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated"
+        )
+    payload = auth_manager.verify_token(access_token)
+    user_id = payload.get("sub")
+    if user_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials",
+        )
+
+    role = (await resolve_stream_roles(session, user_id)).require_member(stream_id)
+    user = await session.get(User, user_id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found"
+        )
+    audience = audience_for_roles(user, {stream_id: role})
+    # 接続中にデータベース接続を保持しない
+    await session.close()
+
+    queue = stream_event_hub.subscribe(stream_id)
+
+    async def event_generator():
+        try:
+            yield format_sse("ready", json.dumps({"stream_id": stream_id}))
+            while not await request.is_disconnected():
+                try:
+                    message = await asyncio.wait_for(
+                        queue.get(), timeout=EVENT_KEEPALIVE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                event = event_for_audience(message, audience)
+                if event is not None:
+                    yield format_sse(*event)
+        finally:
+            stream_event_hub.unsubscribe(stream_id, queue)
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/{stream_id}/tags")
+async def get_stream_tags(
+    stream_id: str,
+    prefix: Optional[str] = Query(None, description="タグの前方一致（入力補完用）"),
+    limit: int = Query(50, ge=1, le=200),
+    stream_roles: StreamRoles = Depends(get_stream_roles),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """ストリームのタグ別お知らせ件数（ファセット）
+
+    書き込み時に更新する集計テーブルから取得する。件数は対象学年・クラスに
+    関わらずストリーム全体の件数。
+    """
+    stream_roles.require_member(stream_id)
+    return await load_tag_facets(session, stream_id, prefix=prefix, limit=limit)
+
 
+@router.post("/{stream_id}/read")
+async def mark_stream_read(
+    stream_id: str,
+    up_to: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """指定したお知らせ（省略時は最新）までをまとめて既読にする"""
+
+    membership = await get_membership_or_403(session, current_user.id, stream_id)
+
+    if up_to:
+        announcement = await get_announcement_or_404(session, stream_id, up_to)
+    else:
+        latest_statement = (
+            select(Announcement)
+            .where(Announcement.stream_id == stream_id)
+            .order_by(Announcement.created_at.desc(), Announcement.id.desc())
+            .limit(1)
+        )
+        latest_result = await session.execute(latest_statement)
+        announcement = latest_result.scalars().first()
+        if not announcement:
+            return {"message": "既読にするお知らせがありません", "newly_read": 0}
+
+    audience = audience_for(current_user, [membership])
+    # 既読位置を進める前に、新たに既読になる緊急のお知らせを調べておく
+    urgent_ids = await urgent_ids_newly_read(session, membership, announcement)
+    newly_read = await mark_read_up_to(
+        session,
+        membership,
+        announcement,
+        visible=audience_condition(audience) if audience else None,
+    )
+    await session.commit()
+
+    if newly_read:
+        # 既読数が変わるのでキャッシュ済みのページを無効化
+        await feed_cache.invalidate_stream(stream_id)
+        await record_read_receipts(session, membership, urgent_ids, True)
+
+    return {
+        "message": "お知らせを既読にしました",
+        "newly_read": newly_read,
+        "last_read_at": membership.last_read_at,
+        "last_read_id": membership.last_read_id,
+    }
+
+
+@router.get("/{stream_id}/announcements/{announcement_id}/receipts")
+async def get_read_receipts(
+    stream_id: str,
+    announcement_id: str,
+    unread_limit: int = Query(200, ge=0, le=2000),
+    current_user: User = Depends(require_stream_role({"stream_admin", "admin"})),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """緊急のお知らせの既読率と未読のメンバー（ストリームの管理者のみ）
 
-@router.get("/search")
+    既読はメンバーごとの連番をビット位置とするビット列で保持し、
+    対象メンバーのビットマスクとの演算で未読者と既読率を求める。
+    """
+    announcement = await get_announcement_or_404(session, stream_id, announcement_id)
+    if not announcement.is_urgent:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="既読レシートは緊急のお知らせのみ確認できます",
+        )
+    return await summarize_read_receipts(session, announcement, unread_limit)
+
+
+@router.get("/{stream_id}/announcements/{announcement_id}/readers")
+async def get_announcement_readers(
+    stream_id: str,
+    announcement_id: str,
+    current_user: User = Depends(require_stream_role({"stream_admin", "admin"})),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """お知らせの既読・未読メンバー一覧（ストリーム管理者以上のみ）"""
+
+    announcement = await get_announcement_or_404(session, stream_id, announcement_id)
+    readers = await load_readers(session, stream_id, announcement)
+
+    total = len(readers["read"]) + len(readers["unread"])
+    return {
+        "announcement_id": announcement.id,
+        "read_count": len(readers["read"]),
+        "unread_count": len(readers["unread"]),
+        "read_rate": len(readers["read"]) / total if total else 0.0,
+        "read": readers["read"],
+        "unread": readers["unread"],
+    }
+
+
+@router.get("/search", dependencies=[Depends(rate_limit("search"))])
 async def search_across_streams(
     q: str = Query(..., min_length=1),
+    tag: Optional[str] = Query(None, description="タグの完全一致"),
+    tag_prefix: Optional[str] = Query(None, description="タグの前方一致"),
+    include_archive: bool = Query(False, description="アーカイブ済みも対象にする"),
     current_user: User = Depends(get_current_user),
+    stream_roles: StreamRoles = Depends(get_stream_roles),
     session: AsyncSession = Depends(get_async_session),
 ):
     """クラス横断全文検索"""
 
     # ユーザーがアクセス可能なストリームIDを取得
-    membership_statement = select(StreamMembership).where(
-        StreamMembership.user_id == current_user.id
-    )
-    membership_result = await session.execute(membership_statement)
-    memberships = membership_result.scalars().all()
-
-    accessible_stream_ids = [m.stream_id for m in memberships]
+    accessible_stream_ids = stream_roles.stream_ids
 
     if not accessible_stream_ids:
         return []
 
-    # 全文検索
-    search_statement = (
-        select(Announcement)
-        .where(
-            and_(
-                Announcement.stream_id.in_(accessible_stream_ids),
-                or_(
-                    Announcement.title.ilike(f"%{q}%"),
-                    Announcement.content.ilike(f"%{q}%"),
-                    Announcement.tags.ilike(f"%{q}%"),
-                ),
-            )
-        )
-        .order_by(Announcement.created_at.desc())
-        .limit(50)
+    # 全文検索（関連度順、対象学年・クラスで絞り込み）
+    hits = await search_backend.search(
+        session,
+        q,
+        accessible_stream_ids,
+        limit=50,
+        audience=audience_for_roles(current_user, stream_roles.roles),
+        tag_filter=TagFilter.from_params(tag, tag_prefix),
+        include_archive=include_archive,
     )
-
-    result = await session.execute(search_statement)
-    announcements = result.scalars().all()
+    ranked = await load_ranked_announcements(session, hits, include_archive)
+    announcements = [announcement for _, announcement in ranked]
+
+    # ストリーム・作成者情報をまとめて取得
+    stream_ids = {a.stream_id for a in announcements}
+    streams = {}
+    if stream_ids:
+        stream_result = await session.execute(
+            select(Stream).where(Stream.id.in_(stream_ids))
+        )
+        streams = {stream.id: stream for stream in stream_result.scalars().all()}
+    creators = await load_creators(session, announcements)
+    reaction_counts = await load_reaction_counts(session, [a.id for a in announcements])
 
     # 結果をストリーム情報と共に返す
     search_results = []
-    for announcement in announcements:
-        # ストリーム情報を取得
-        stream_statement = select(Stream).where(Stream.id == announcement.stream_id)
-        stream_result = await session.execute(stream_statement)
-        stream = stream_result.scalars().first()
-
-        # 作成者情報を取得
-        creator_statement = select(User).where(User.id == announcement.created_by)
-        creator_result = await session.execute(creator_statement)
-        creator = creator_result.scalars().first()
+    for hit, announcement in ranked:
+        stream = streams.get(announcement.stream_id)
+        creator = creators.get(announcement.created_by)
 
         search_results.append(
             {
@@ -514,6 +939,8 @@ async def search_across_streams(
                 "content": announcement.content[:200] + "..."
                 if len(announcement.content) > 200
                 else announcement.content,
+                **snippet_fields(announcement, q),
+                "score": hit.score,
                 "announcement_type": announcement.announcement_type,
                 "stream": {
                     "id": stream.id,
@@ -523,6 +950,7 @@ async def search_across_streams(
                 if stream
                 else None,
                 "creator": {"name": creator.name} if creator else None,
+                "reaction_counts": reaction_counts.get(announcement.id, {}),
                 "created_at": announcement.created_at,
             }
         )
@@ -567,6 +995,7 @@ async def create_stream(
 
     session.add(membership)
     await session.commit()
+    await invalidate_stream_roles([current_user.id])
 
     return {
         "id": stream.id,
@@ -633,6 +1062,7 @@ async def invite_user_to_stream(
 
     session.add(membership)
     await session.commit()
+    await invalidate_stream_roles([user.id])
     await session.refresh(membership)
 
     return {
@@ -642,52 +1072,152 @@ async def invite_user_to_stream(
     }
 
 
-@router.get("/{stream_id}/members", response_model=List[dict])
-async def get_stream_members(
+class BulkMemberItem(BaseModel):
+    email: str
+    role: Optional[str] = None
+
+
+class BulkMemberRequest(BaseModel):
+    members: List[BulkMemberItem]
+
+
+async def iter_json_members(request: BulkMemberRequest):
+    for row, item in enumerate(request.members, 1):
+        yield MemberRow(row=row, email=item.email.strip(), role=item.role)
+
+
+@router.post("/{stream_id}/members/bulk", response_model=dict)
+async def bulk_add_members(
     stream_id: str,
-    current_user: User = Depends(get_current_user),
+    request: Request,
+    current_user: User = Depends(require_stream_role({"stream_admin", "admin"})),
     session: AsyncSession = Depends(get_async_session),
 ):
-    """ストリームのメンバー一覧を取得"""
+    """ストリームにメンバーを一括登録（ストリーム管理者以上のみ）
 
-    # ユーザーがこのストリームのメンバーかチェック
-    user_membership_statement = select(StreamMembership).where(
-        and_(
-            StreamMembership.user_id == current_user.id,
-            StreamMembership.stream_id == stream_id,
+    以下のいずれかの形式で受け付ける。
+    - application/json: {"members": [{"email": "...", "role": "student"}]}
+    - text/csv: email,role の CSV（リクエスト本文を受信しながら解析）
+    - multipart/form-data: file フィールドに CSV ファイル
+
+    既にメンバーのユーザーはスキップし、行ごとの結果を返す。
+    """
+
+    stream_statement = select(Stream).where(Stream.id == stream_id)
+    stream_result = await session.execute(stream_statement)
+    stream = stream_result.scalars().first()
+
+    if not stream:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="ストリームが見つかりません"
         )
-    )
-    user_membership_result = await session.execute(user_membership_statement)
-    user_membership = user_membership_result.scalars().first()
 
-    if not user_membership:
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        try:
+            body = BulkMemberRequest.model_validate(await request.json())
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="メンバー一覧の形式が不正です"
+            )
+        members = iter_json_members(body)
+    elif content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="CSV ファイルを指定してください"
+            )
+        members = iter_csv_members(iter_upload_chunks(upload))
+    elif content_type.startswith("text/csv"):
+        members = iter_csv_members(request.stream())
+    else:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN, detail="このストリームへのアクセス権限がありません"
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="JSON または CSV で送信してください",
+        )
+
+    try:
+        report = await import_memberships(session, stream_id, members)
+    except (UnicodeDecodeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="CSV ファイルの形式が不正です"
+        )
+    await session.commit()
+    await invalidate_stream_roles(report.pop("added_user_ids"))
+
+    added = report["summary"]["added"]
+    return {
+        "message": f"{stream.name}に{added}人を追加しました",
+        "stream": {"id": stream.id, "name": stream.name},
+        **report,
+    }
+
+
+@router.get("/{stream_id}/members")
+async def get_stream_members(
+    stream_id: str,
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    role: Optional[StreamRole] = None,
+    grade: Optional[int] = None,
+    class_name: Optional[str] = None,
+    q: Optional[str] = Query(None, description="名前・メールアドレスの前方一致"),
+    count_only: bool = False,
+    stream_roles: StreamRoles = Depends(get_stream_roles),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """ストリームのメンバー一覧を取得
+
+    メンバーシップとユーザーを1回の結合で取得し、名前順のキーセット
+    ページネーションで返す。次ページのカーソルは X-Next-Cursor ヘッダーで返す。
+    count_only を指定すると条件に合うメンバー数だけを返す。
+    """
+
+    stream_roles.require_member(stream_id)
+
+    condition = member_filter_condition(stream_id, role, grade, class_name, q)
+
+    if count_only:
+        count_statement = (
+            select(func.count())
+            .select_from(StreamMembership)
+            .join(User, User.id == StreamMembership.user_id)
+            .where(condition)
         )
+        count_result = await session.execute(count_statement)
+        return {"count": count_result.scalar_one()}
 
-    # ストリームのすべてのメンバーシップを取得
-    memberships_statement = select(StreamMembership).where(
-        StreamMembership.stream_id == stream_id
+    statement = (
+        select(StreamMembership, User)
+        .join(User, User.id == StreamMembership.user_id)
+        .where(condition)
     )
-    memberships_result = await session.execute(memberships_statement)
-    memberships = memberships_result.scalars().all()
-
-    members = []
-    for membership in memberships:
-        # ユーザー情報を取得
-        user_statement = select(User).where(User.id == membership.user_id)
-        user_result = await session.execute(user_statement)
-        user = user_result.scalars().first()
-
-        if user:
-            members.append(
-                {
-                    "id": user.id,
-                    "name": user.name,
-                    "email": user.email,
-                    "role": membership.role,
-                    "joined_at": membership.joined_at,
-                }
+    if cursor:
+        try:
+            statement = statement.where(member_keyset_condition(cursor))
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="カーソルが不正です"
             )
+    statement = statement.order_by(*MEMBER_ORDER).limit(limit)
 
-    return members
+    result = await session.execute(statement)
+    rows = result.all()
+
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = encode_member_cursor(rows[-1][1])
+
+    return [
+        {
+            "id": user.id,
+            "name": user.name,
+            "email": user.email,
+            "role": membership.role,
+            "grade": user.grade,
+            "class_name": user.class_name,
+            "joined_at": membership.joined_at,
+        }
+        for membership, user in rows
+    ]
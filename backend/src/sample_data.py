@@ -1,15 +1,29 @@
 """
 新規ユーザー向けサンプルデータ生成機能
+
+既定のストリームへの参加だけはログイン時に1回の INSERT で行い、発行する
+トークンのロールに含める（join_default_streams）。課題・イベントは作成せず、
+sample_data_seeded_at が未設定のユーザーについて
+レスポンス後にバックグラウンドジョブを登録する（schedule_sample_data）。
+ジョブは sample_data_seeded_at を NULL から更新できた場合だけ作成し、
+更新と作成を同じトランザクションでコミットする。同時に複数回ログインしても
+作成は1回だけで、失敗した場合はフラグが戻り次のログインで再登録される。
 """
+import os
 from datetime import datetime, timedelta
-from typing import List
+from typing import Dict, List, Optional
+from uuid import uuid4
 
+from sqlalchemy import exists, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import select
 
+from .database import AsyncSessionLocal, dialect_insert, task_sessions
+from .membership_resolver import invalidate_stream_roles
 from .models import (
     Assignment,
     AssignmentLog,
+    AssignmentStatus,
     Event,
     Stream,
     StreamMembership,
@@ -18,23 +32,16 @@ from .models import (
     User,
 )
 
+# celery: Celery のタスクで作成 / background: API プロセスでレスポンス後に作成
+SAMPLE_DATA_SEEDING = os.getenv("SAMPLE_DATA_SEEDING", "celery")
 
-async def create_sample_assignments_for_user(
-    session: AsyncSession, user: User
-) -> List[Assignment]:
-    """新規ユーザー向けサンプル課題を作成"""
-
-    # 既に課題が存在するかチェック
-    statement = select(Assignment).where(Assignment.created_by == user.id)
-    result = await session.execute(statement)
-    existing = result.scalars().all()
-
-    if existing:
-        return existing  # 既存の課題がある場合はそのまま返す
+# 新規ユーザーを自動参加させるストリーム
+DEFAULT_STREAM_NAMES = ["1年A組", "数学科", "全校"]
 
-    today = datetime.utcnow()
 
-    sample_assignments = [
+def build_sample_assignments(user: User, today: datetime) -> List[Assignment]:
+    """サンプル課題（未保存）"""
+    return [
         Assignment(
             title=f"{user.name}さんへ：CampusFlowへようこそ！",
             subject="システム案内",
@@ -65,34 +72,10 @@ async def create_sample_assignments_for_user(
         ),
     ]
 
-    for assignment in sample_assignments:
-        session.add(assignment)
-
-    await session.commit()
-
-    # 作成された課題を取得して返す
-    for assignment in sample_assignments:
-        await session.refresh(assignment)
-
-    return sample_assignments
-
-
-async def create_sample_events_for_user(
-    session: AsyncSession, user: User
-) -> List[Event]:
-    """新規ユーザー向けサンプルイベントを作成"""
-
-    # 既にイベントが存在するかチェック
-    statement = select(Event).where(Event.created_by == user.id)
-    result = await session.execute(statement)
-    existing = result.scalars().all()
-
-    if existing:
-        return existing  # 既存のイベントがある場合はそのまま返す
-
-    today = datetime.utcnow()
 
-    sample_events = [
+def build_sample_events(user: User, today: datetime) -> List[Event]:
+    """サンプルイベント（未保存）"""
+    return [
         Event(
             title=f"{user.name}さんのCampusFlow開始記念",
             description="学習管理システムの利用開始を記念して！効率的な学習計画を立てて目標を達成しましょう。",
@@ -140,123 +123,145 @@ async def create_sample_events_for_user(
         ),
     ]
 
-    for event in sample_events:
-        session.add(event)
-
-    await session.commit()
-
-    # 作成されたイベントを取得して返す
-    for event in sample_events:
-        await session.refresh(event)
-
-    return sample_events
 
+def build_sample_log(user: User, assignment: Assignment) -> AssignmentLog:
+    """サンプル課題の種類に応じた進捗ログ（未保存）"""
+    if "ようこそ" in assignment.title:
+        # ウェルカム課題は「進行中」
+        status = AssignmentStatus.IN_PROGRESS
+        notes = "CampusFlowの機能を確認中です。"
+    elif "数学" in assignment.subject:
+        # 数学課題も「進行中」（AssignmentStatus に「開始済み」はない）
+        status = AssignmentStatus.IN_PROGRESS
+        notes = "教科書の例題を確認しました。"
+    else:
+        # その他は「未開始」
+        status = AssignmentStatus.NOT_STARTED
+        notes = ""
+    return AssignmentLog(
+        assignment_id=assignment.id, user_id=user.id, status=status, notes=notes
+    )
 
-async def ensure_user_stream_memberships(
-    session: AsyncSession, user: User
-) -> List[StreamMembership]:
-    """新規ユーザーを既存の主要ストリームに自動参加させる"""
 
-    # 既存のメンバーシップをチェック
-    existing_statement = select(StreamMembership).where(
-        StreamMembership.user_id == user.id
+async def _claim_seeding(session: AsyncSession, user_id: str) -> bool:
+    """sample_data_seeded_at を NULL から更新できたら True（コミットはしない）"""
+    result = await session.execute(
+        update(User)
+        .where(User.id == user_id, User.sample_data_seeded_at.is_(None))
+        .values(sample_data_seeded_at=datetime.utcnow())
     )
-    existing_result = await session.execute(existing_statement)
-    existing_memberships = existing_result.scalars().all()
-
-    if existing_memberships:
-        return existing_memberships  # 既にメンバーシップがある場合はそのまま返す
-
-    # 参加させたいデフォルトストリーム名
-    default_stream_names = ["1年A組", "数学科", "全校"]
-
-    new_memberships = []
-
-    for stream_name in default_stream_names:
-        # ストリームを検索
-        stream_statement = select(Stream).where(Stream.name == stream_name)
-        stream_result = await session.execute(stream_statement)
-        stream = stream_result.scalars().first()
-
-        if stream:
-            # メンバーシップを作成
-            membership = StreamMembership(
-                user_id=user.id,
-                stream_id=stream.id,
-                role=StreamRole.STUDENT,
-                joined_at=datetime.utcnow(),
+    return result.rowcount == 1
+
+
+async def seed_user_sample_data(
+    session: AsyncSession, user_id: str
+) -> Optional[Dict[str, int]]:
+    """ユーザーのサンプルデータを1回だけ作成し、作成した件数を返す
+
+    他のジョブが作成済み（または作成中）なら None。以前のログイン時の作成で
+    既にある種類のデータは作らない。
+    """
+    if not await _claim_seeding(session, user_id):
+        await session.rollback()
+        return None
+    user = await session.get(User, user_id)
+
+    has_assignments, has_events = (
+        await session.execute(
+            select(
+                exists().where(Assignment.created_by == user_id),
+                exists().where(Event.created_by == user_id),
             )
-            session.add(membership)
-            new_memberships.append(membership)
-
-    # 変更をコミット
+        )
+    ).one()
+
+    now = datetime.utcnow()
+    assignments = [] if has_assignments else build_sample_assignments(user, now)
+    logs = [build_sample_log(user, assignment) for assignment in assignments]
+    events = [] if has_events else build_sample_events(user, now)
+    # 種類ごとにまとめて INSERT される（refresh はしない）
+    session.add_all([*assignments, *logs, *events])
     await session.commit()
 
-    # 作成されたメンバーシップを更新
-    for membership in new_memberships:
-        await session.refresh(membership)
-
-    return new_memberships
-
-
-async def ensure_user_has_sample_data(session: AsyncSession, user: User):
-    """ユーザーにサンプルデータがあることを保証する"""
-
-    # 課題をチェックして、必要に応じて作成
-    assignments = await create_sample_assignments_for_user(session, user)
-
-    # イベントをチェックして、必要に応じて作成
-    events = await create_sample_events_for_user(session, user)
-
-    # 既存のストリームに自動参加させる
-    stream_memberships = await ensure_user_stream_memberships(session, user)
-
     return {
         "assignments_created": len(assignments),
+        "assignment_logs_created": len(logs),
         "events_created": len(events),
-        "stream_memberships_created": len(stream_memberships),
-        "message": f"ユーザー {user.name} のサンプルデータを準備しました",
     }
 
 
-async def create_assignment_sample_logs(
-    session: AsyncSession, user: User, assignment: Assignment
-):
-    """サンプル課題に対する進捗ログを作成"""
+async def join_default_streams(session: AsyncSession, user: User) -> int:
+    """サンプルデータ未作成のユーザーを既定のストリームに参加させ、参加した数を返す
 
-    # 既にログが存在するかチェック
-    statement = select(AssignmentLog).where(
-        AssignmentLog.assignment_id == assignment.id, AssignmentLog.user_id == user.id
+    トークンのロールのクレームに含めるため、トークンの発行前に呼ぶ。
+    既にどこかのストリームに参加していれば何もしない。
+    """
+    if user.sample_data_seeded_at is not None:
+        return 0
+    streams = await session.execute(
+        select(Stream.id).where(
+            Stream.name.in_(DEFAULT_STREAM_NAMES),
+            ~exists().where(StreamMembership.user_id == user.id),
+        )
+    )
+    now = datetime.utcnow()
+    values = [
+        {
+            "id": str(uuid4()),
+            "user_id": user.id,
+            "stream_id": stream_id,
+            "role": StreamRole.STUDENT,
+            "joined_at": now,
+        }
+        for stream_id in streams.scalars().all()
+    ]
+    if not values:
+        return 0
+
+    statement = (
+        dialect_insert(session, StreamMembership)
+        .values(values)
+        .on_conflict_do_nothing(index_elements=["user_id", "stream_id"])
     )
     result = await session.execute(statement)
-    existing_log = result.scalars().first()
+    await session.commit()
+    await invalidate_stream_roles([user.id])
+    return result.rowcount
 
-    if existing_log:
-        return existing_log
 
-    # 課題の種類に応じてサンプルログを作成
-    if "ようこそ" in assignment.title:
-        # ウェルカム課題は「進行中」
-        status = "in_progress"
-        notes = "CampusFlowの機能を確認中です。"
-    elif "数学" in assignment.subject:
-        # 数学課題は「開始済み」
-        status = "started"
-        notes = "教科書の例題を確認しました。"
-    else:
-        # その他は「未開始」
-        status = "not_started"
-        notes = ""
+async def run_seed_user_sample_data(user_id: str) -> Optional[Dict[str, int]]:
+    async with task_sessions() as sessions, sessions() as session:
+        return await seed_user_sample_data(session, user_id)
 
-    log = AssignmentLog(
-        assignment_id=assignment.id,
-        user_id=user.id,
-        status=status,
-        notes=notes,
-    )
 
-    session.add(log)
-    await session.commit()
-    await session.refresh(log)
+def enqueue_sample_data(user_id: str):
+    """サンプルデータの作成タスクを登録（レスポンス後にバックグラウンドで呼ぶ）
 
-    return log
+    登録できなくてもフラグは未設定のままなので、次のログインで再登録される。
+    """
+    from .tasks import seed_sample_data
+
+    try:
+        # ブローカーに接続できない場合に待ち続けないよう、再接続しない
+        seed_sample_data.apply_async((user_id,), retry=False)
+    except Exception as e:
+        print(f"サンプルデータの作成を登録できませんでした: {e}")
+
+
+async def seed_sample_data_in_background(user_id: str):
+    """Celery を使わない環境向けに、API プロセスでレスポンス後に作成する"""
+    try:
+        async with AsyncSessionLocal() as session:
+            await seed_user_sample_data(session, user_id)
+    except Exception as e:
+        print(f"サンプルデータ作成エラー: {e}")
+
+
+def schedule_sample_data(background_tasks, user: User):
+    """サンプルデータが未作成ならレスポンス後の作成を登録する"""
+    if user.sample_data_seeded_at is not None:
+        return
+    if SAMPLE_DATA_SEEDING == "background":
+        background_tasks.add_task(seed_sample_data_in_background, user.id)
+    else:
+        background_tasks.add_task(enqueue_sample_data, user.id)
@@ -0,0 +1,576 @@
+"""
+お知らせ全文検索インデックス
+
+日本語は単語区切りの空白がないため、テキストを文字bigramに分割して
+インデックスする。SQLite では FTS5、PostgreSQL では tsvector (+ pg_trgm) を
+バックエンドとして使い、関連度順の結果とサーバー側で作成したスニペットを返す。
+"""
+import json
+import unicodedata
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import Float, String, bindparam, exists, or_, text
+from sqlmodel import select
+
+from .announcement_tags import TagFilter
+from .announcement_targets import Audience, audience_condition
+from .database import async_engine
+from .models import (
+    Announcement,
+    AnnouncementTag,
+    ArchivedAnnouncement,
+    ArchivedAnnouncementTag,
+    ArchivedAnnouncementTargetClass,
+    ArchivedAnnouncementTargetGrade,
+)
+
+NGRAM_SIZE = 2
+SNIPPET_WIDTH = 80
+
+
+@dataclass
+class SearchHit:
+    announcement_id: str
+    score: float
+
+
+@dataclass
+class Snippet:
+    text: str
+    highlights: List[Tuple[int, int]] = field(default_factory=list)
+
+
+def normalize_text(value: str) -> str:
+    """全角/半角・大文字/小文字の揺れを吸収"""
+    return unicodedata.normalize("NFKC", value).lower()
+
+
+def _runs(value: str) -> List[str]:
+    """記号や空白で区切られた文字の連続部分を取り出す"""
+    runs = []
+    current = []
+    for ch in normalize_text(value):
+        if ch.isalnum():
+            current.append(ch)
+        elif current:
+            runs.append("".join(current))
+            current = []
+    if current:
+        runs.append("".join(current))
+    return runs
+
+
+def ngram_tokens(value: Optional[str]) -> List[str]:
+    """インデックス用の文字n-gramトークン列
+
+    各連続部分の末尾1文字も加えることで、1文字の前方一致検索にも対応する。
+    例: "数学部" -> ["数学", "学部", "部"]
+    """
+    if not value:
+        return []
+    tokens = []
+    for run in _runs(value):
+        tokens.extend(run[i : i + NGRAM_SIZE] for i in range(len(run) - 1))
+        tokens.append(run[-1])
+    return tokens
+
+
+def query_terms(query: str) -> List[Tuple[List[str], bool]]:
+    """検索語を (bigramフレーズ, 前方一致か) のリストに変換
+
+    2文字以上の部分は隣接bigramのフレーズ一致（=部分文字列一致）、
+    1文字の部分はその文字で始まるトークンへの前方一致になる。
+    """
+    terms = []
+    for run in _runs(query):
+        if len(run) < NGRAM_SIZE:
+            terms.append(([run], True))
+        else:
+            terms.append(
+                ([run[i : i + NGRAM_SIZE] for i in range(len(run) - 1)], False)
+            )
+    return terms
+
+
+def tags_text(tags: Optional[str]) -> str:
+    """JSON形式のタグを検索用テキストに変換"""
+    if not tags:
+        return ""
+    try:
+        return " ".join(str(tag) for tag in json.loads(tags))
+    except (TypeError, ValueError):
+        return tags
+
+
+def make_snippet(value: str, query: str, width: int = SNIPPET_WIDTH) -> Snippet:
+    """検索語の周辺を切り出したスニペットとハイライト位置を作成"""
+    # 正規化後の文字位置から元の文字位置へ戻すための対応表
+    normalized = []
+    positions = []
+    for index, ch in enumerate(value):
+        for normalized_ch in normalize_text(ch):
+            normalized.append(normalized_ch)
+            positions.append(index)
+    haystack = "".join(normalized)
+
+    matches = []
+    for run in sorted(_runs(query), key=len, reverse=True):
+        start = haystack.find(run)
+        while start != -1:
+            matches.append((positions[start], positions[start + len(run) - 1] + 1))
+            start = haystack.find(run, start + len(run))
+
+    if not matches:
+        snippet = value[:width]
+        return Snippet(text=snippet + ("…" if len(value) > width else ""))
+
+    first_start = min(start for start, _ in matches)
+    window_start = max(0, first_start - width // 4)
+    window_end = min(len(value), window_start + width)
+
+    prefix = "…" if window_start > 0 else ""
+    suffix = "…" if window_end < len(value) else ""
+    offset = len(prefix) - window_start
+
+    highlights = []
+    for start, end in sorted(matches):
+        if start < window_start or end > window_end:
+            continue
+        if highlights and start < highlights[-1][1] - offset:
+            continue
+        highlights.append((start + offset, end + offset))
+
+    return Snippet(
+        text=prefix + value[window_start:window_end] + suffix, highlights=highlights
+    )
+
+
+class SearchBackend:
+    """検索インデックスのバックエンド共通インターフェース"""
+
+    async def ensure_schema(self, conn):
+        raise NotImplementedError
+
+    async def index_announcement(self, session, announcement: Announcement):
+        raise NotImplementedError
+
+    async def remove_announcement(self, session, announcement_id: str):
+        raise NotImplementedError
+
+    async def search(
+        self,
+        session,
+        query: str,
+        stream_ids: Sequence[str],
+        limit: int = 50,
+        offset: int = 0,
+        audience: Optional[Audience] = None,
+        tag_filter: Optional[TagFilter] = None,
+        include_archive: bool = False,
+    ) -> List[SearchHit]:
+        """関連度順の検索結果
+
+        audience を指定すると対象学年・クラスで、tag_filter を指定するとタグで絞り込む。
+        include_archive を指定するとアーカイブ済みのお知らせも対象にする。
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    async def _execute_ranked(
+        session,
+        ranked,
+        limit: int,
+        offset: int,
+        audience: Optional[Audience],
+        tag_filter: Optional[TagFilter],
+        descending: bool,
+        include_archive: bool = False,
+    ):
+        """(announcement_id, stream_id, rank) を返す検索クエリを絞り込み・並べ替える
+
+        インデックスにはアーカイブ済みのお知らせの文書も残っているため、
+        include_archive でなければアーカイブにあるものを除く。
+        """
+        hits = ranked.columns(
+            announcement_id=String, stream_id=String, rank=Float
+        ).subquery("hits")
+        announcement_id = hits.c.announcement_id
+        statement = select(announcement_id, hits.c.rank)
+        if not include_archive:
+            statement = statement.where(
+                ~exists().where(ArchivedAnnouncement.id == announcement_id)
+            )
+        if audience is not None:
+            statement = statement.where(
+                audience_condition(audience, announcement_id, hits.c.stream_id)
+            )
+            if include_archive:
+                # お知らせは片方のテーブルにしかないため、もう片方の条件は常に真
+                statement = statement.where(
+                    audience_condition(
+                        audience,
+                        announcement_id,
+                        hits.c.stream_id,
+                        grade_table=ArchivedAnnouncementTargetGrade,
+                        class_table=ArchivedAnnouncementTargetClass,
+                    )
+                )
+        if tag_filter is not None:
+            condition = tag_filter.condition(announcement_id)
+            if include_archive:
+                condition = or_(
+                    condition,
+                    tag_filter.condition(
+                        announcement_id, tag_table=ArchivedAnnouncementTag
+                    ),
+                )
+            statement = statement.where(condition)
+        order = hits.c.rank.desc() if descending else hits.c.rank
+        statement = statement.order_by(order).limit(limit).offset(offset)
+        result = await session.execute(statement)
+        return result.all()
+
+    async def rebuild(self, conn):
+        """既存のお知らせ（アーカイブ済みを含む）からインデックスを作り直す"""
+        result = await conn.execute(
+            text(
+                "SELECT id, stream_id, title, content, tags FROM announcements "
+                "UNION ALL "
+                "SELECT id, stream_id, title, content, tags FROM announcements_archive"
+            )
+        )
+        for row in result.all():
+            await self.index_announcement(
+                conn,
+                Announcement(
+                    id=row.id,
+                    stream_id=row.stream_id,
+                    title=row.title,
+                    content=row.content,
+                    tags=row.tags,
+                    created_by="",
+                ),
+            )
+
+    async def is_empty(self, conn) -> bool:
+        result = await conn.execute(
+            text("SELECT 1 FROM announcement_search_docs LIMIT 1")
+        )
+        return result.first() is None
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    """SQLite FTS5 バックエンド
+
+    announcement_search_docs が announcement_id と FTS5 の rowid を対応付け、
+    削除やストリームでの絞り込みをインデックス経由で行えるようにする。
+    """
+
+    async def ensure_schema(self, conn):
+        await conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS announcement_search_docs ("
+                "rowid INTEGER PRIMARY KEY, "
+                "announcement_id TEXT NOT NULL UNIQUE, "
+                "stream_id TEXT NOT NULL)"
+            )
+        )
+        await conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_announcement_search_docs_stream "
+                "ON announcement_search_docs (stream_id)"
+            )
+        )
+        await conn.execute(
+            text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS announcement_search_fts "
+                "USING fts5(title, content, tags, "
+                "tokenize = 'unicode61 remove_diacritics 0')"
+            )
+        )
+
+    async def index_announcement(self, session, announcement: Announcement):
+        await self.remove_announcement(session, announcement.id)
+        result = await session.execute(
+            text(
+                "INSERT INTO announcement_search_docs (announcement_id, stream_id) "
+                "VALUES (:announcement_id, :stream_id)"
+            ),
+            {"announcement_id": announcement.id, "stream_id": announcement.stream_id},
+        )
+        await session.execute(
+            text(
+                "INSERT INTO announcement_search_fts (rowid, title, content, tags) "
+                "VALUES (:rowid, :title, :content, :tags)"
+            ),
+            {
+                "rowid": result.lastrowid,
+                "title": " ".join(ngram_tokens(announcement.title)),
+                "content": " ".join(ngram_tokens(announcement.content)),
+                "tags": " ".join(ngram_tokens(tags_text(announcement.tags))),
+            },
+        )
+
+    async def remove_announcement(self, session, announcement_id: str):
+        params = {"announcement_id": announcement_id}
+        await session.execute(
+            text(
+                "DELETE FROM announcement_search_fts WHERE rowid IN ("
+                "SELECT rowid FROM announcement_search_docs "
+                "WHERE announcement_id = :announcement_id)"
+            ),
+            params,
+        )
+        await session.execute(
+            text(
+                "DELETE FROM announcement_search_docs "
+                "WHERE announcement_id = :announcement_id"
+            ),
+            params,
+        )
+
+    @staticmethod
+    def build_match_query(query: str) -> Optional[str]:
+        parts = []
+        for tokens, is_prefix in query_terms(query):
+            if is_prefix:
+                parts.append(f'"{tokens[0]}"*')
+            else:
+                parts.append('"' + " ".join(tokens) + '"')
+        return " AND ".join(parts) if parts else None
+
+    async def search(
+        self,
+        session,
+        query: str,
+        stream_ids: Sequence[str],
+        limit: int = 50,
+        offset: int = 0,
+        audience: Optional[Audience] = None,
+        tag_filter: Optional[TagFilter] = None,
+        include_archive: bool = False,
+    ) -> List[SearchHit]:
+        match_query = self.build_match_query(query)
+        if not match_query or not stream_ids:
+            return []
+
+        # bm25 は小さいほど関連度が高い。タイトル > タグ > 本文 の重み付け
+        ranked = text(
+            "SELECT d.announcement_id, d.stream_id, "
+            "bm25(announcement_search_fts, 10.0, 1.0, 5.0) AS rank "
+            "FROM announcement_search_fts "
+            "JOIN announcement_search_docs d "
+            "ON d.rowid = announcement_search_fts.rowid "
+            "WHERE announcement_search_fts MATCH :match_query "
+            "AND d.stream_id IN :stream_ids"
+        ).bindparams(
+            bindparam("stream_ids", value=list(stream_ids), expanding=True),
+            match_query=match_query,
+        )
+        rows = await self._execute_ranked(
+            session,
+            ranked,
+            limit,
+            offset,
+            audience,
+            tag_filter,
+            descending=False,
+            include_archive=include_archive,
+        )
+        return [
+            SearchHit(announcement_id=row.announcement_id, score=-row.rank)
+            for row in rows
+        ]
+
+
+class PostgresSearchBackend(SearchBackend):
+    """PostgreSQL tsvector + pg_trgm バックエンド
+
+    bigramトークンを 'simple' 設定の tsvector として GIN インデックスに保存し、
+    フレーズ検索 (<->) で一致判定、ts_rank_cd とタイトルの trigram 類似度で
+    順位付けする。
+    """
+
+    def __init__(self):
+        self.trigram_enabled = False
+
+    async def ensure_schema(self, conn):
+        try:
+            async with conn.begin_nested():
+                await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            self.trigram_enabled = True
+        except Exception as e:
+            # 拡張機能を作成する権限がなければ trigram による加点なしで動作
+            print(f"pg_trgm を有効化できませんでした: {e}")
+
+        await conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS announcement_search_docs ("
+                "announcement_id TEXT PRIMARY KEY, "
+                "stream_id TEXT NOT NULL, "
+                "title TEXT NOT NULL, "
+                "document TSVECTOR NOT NULL)"
+            )
+        )
+        await conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_announcement_search_docs_document "
+                "ON announcement_search_docs USING GIN (document)"
+            )
+        )
+        await conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_announcement_search_docs_stream "
+                "ON announcement_search_docs (stream_id)"
+            )
+        )
+        if self.trigram_enabled:
+            await conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_announcement_search_docs_title_trgm "
+                    "ON announcement_search_docs USING GIN (title gin_trgm_ops)"
+                )
+            )
+
+    async def index_announcement(self, session, announcement: Announcement):
+        await session.execute(
+            text(
+                "INSERT INTO announcement_search_docs "
+                "(announcement_id, stream_id, title, document) "
+                "VALUES (:announcement_id, :stream_id, :title, "
+                "setweight(to_tsvector('simple', :title_tokens), 'A') || "
+                "setweight(to_tsvector('simple', :tags_tokens), 'B') || "
+                "setweight(to_tsvector('simple', :content_tokens), 'C')) "
+                "ON CONFLICT (announcement_id) DO UPDATE SET "
+                "stream_id = EXCLUDED.stream_id, title = EXCLUDED.title, "
+                "document = EXCLUDED.document"
+            ),
+            {
+                "announcement_id": announcement.id,
+                "stream_id": announcement.stream_id,
+                "title": normalize_text(announcement.title),
+                "title_tokens": " ".join(ngram_tokens(announcement.title)),
+                "tags_tokens": " ".join(ngram_tokens(tags_text(announcement.tags))),
+                "content_tokens": " ".join(ngram_tokens(announcement.content)),
+            },
+        )
+
+    async def remove_announcement(self, session, announcement_id: str):
+        await session.execute(
+            text(
+                "DELETE FROM announcement_search_docs "
+                "WHERE announcement_id = :announcement_id"
+            ),
+            {"announcement_id": announcement_id},
+        )
+
+    @staticmethod
+    def build_tsquery(query: str) -> Optional[str]:
+        parts = []
+        for tokens, is_prefix in query_terms(query):
+            if is_prefix:
+                parts.append(f"'{tokens[0]}':*")
+            else:
+                parts.append("(" + " <-> ".join(f"'{t}'" for t in tokens) + ")")
+        return " & ".join(parts) if parts else None
+
+    async def search(
+        self,
+        session,
+        query: str,
+        stream_ids: Sequence[str],
+        limit: int = 50,
+        offset: int = 0,
+        audience: Optional[Audience] = None,
+        tag_filter: Optional[TagFilter] = None,
+        include_archive: bool = False,
+    ) -> List[SearchHit]:
+        tsquery = self.build_tsquery(query)
+        if not tsquery or not stream_ids:
+            return []
+
+        rank = "ts_rank_cd(document, to_tsquery('simple', :tsquery))"
+        if self.trigram_enabled:
+            rank += " + word_similarity(:raw_query, title)"
+
+        ranked = text(
+            f"SELECT announcement_id, stream_id, {rank} AS rank "
+            "FROM announcement_search_docs "
+            "WHERE document @@ to_tsquery('simple', :tsquery) "
+            "AND stream_id IN :stream_ids"
+        ).bindparams(
+            bindparam("stream_ids", value=list(stream_ids), expanding=True),
+            tsquery=tsquery,
+            **({"raw_query": normalize_text(query)} if self.trigram_enabled else {}),
+        )
+        rows = await self._execute_ranked(
+            session,
+            ranked,
+            limit,
+            offset,
+            audience,
+            tag_filter,
+            descending=True,
+            include_archive=include_archive,
+        )
+        return [
+            SearchHit(announcement_id=row.announcement_id, score=float(row.rank))
+            for row in rows
+        ]
+
+
+def create_search_backend(dialect_name: str) -> SearchBackend:
+    if dialect_name == "postgresql":
+        return PostgresSearchBackend()
+    return SQLiteFTS5Backend()
+
+
+search_backend = create_search_backend(async_engine.dialect.name)
+
+
+async def init_search_index():
+    """検索インデックスのテーブルを作成し、空であれば既存データから構築"""
+    async with async_engine.begin() as conn:
+        await search_backend.ensure_schema(conn)
+        if await search_backend.is_empty(conn):
+            await search_backend.rebuild(conn)
+
+
+async def load_ranked_announcements(
+    session, hits: Sequence[SearchHit], include_archive: bool = False
+) -> List[Tuple[SearchHit, Announcement]]:
+    """検索結果のお知らせを関連度順のまま1クエリで取得し、(hit, お知らせ) の組で返す
+
+    索引だけに残っていて行のないヒットは除く（組にするのでスコアがずれない）。
+    include_archive の場合、見つからなかったものはアーカイブから
+    ArchivedAnnouncement として取得する（追加で1クエリ）。
+    """
+    if not hits:
+        return []
+    hit_ids = [hit.announcement_id for hit in hits]
+    statement = select(Announcement).where(Announcement.id.in_(hit_ids))
+    result = await session.execute(statement)
+    by_id = {a.id: a for a in result.scalars().all()}
+
+    missing_ids = [i for i in hit_ids if i not in by_id]
+    if include_archive and missing_ids:
+        archived = await session.execute(
+            select(ArchivedAnnouncement).where(ArchivedAnnouncement.id.in_(missing_ids))
+        )
+        by_id.update({a.id: a for a in archived.scalars().all()})
+    return [
+        (hit, by_id[hit.announcement_id])
+        for hit in hits
+        if hit.announcement_id in by_id
+    ]
+
+
+def snippet_fields(announcement: Announcement, query: str) -> dict:
+    """検索結果に付与するスニペット情報"""
+    snippet = make_snippet(announcement.content, query)
+    return {
+        "snippet": snippet.text,
+        "highlights": snippet.highlights,
+        "archived": isinstance(announcement, ArchivedAnnouncement),
+    }
@@ -0,0 +1,56 @@
+"""
+Server-Timing ヘッダー
+
+リクエスト内の処理時間（トークンの検証など）を項目ごとに記録し、
+レスポンスの Server-Timing ヘッダーで返す。ブラウザの開発者ツールで
+レイテンシの内訳として確認できる。
+"""
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar(
+    "server_timings", default=None
+)
+
+
+def record(name: str, seconds: float):
+    """処理時間を加算する（ミドルウェアの外で呼ばれた場合は何もしない）"""
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def format_header(timings: Dict[str, float]) -> str:
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items()
+    )
+
+
+class ServerTimingMiddleware:
+    """記録した処理時間を Server-Timing ヘッダーに付ける ASGI ミドルウェア
+
+    レスポンスの開始時点までに記録されたものだけが含まれる。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: Dict[str, float] = {}
+        token = _timings.set(timings)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and timings:
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", format_header(timings).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _timings.reset(token)
@@ -0,0 +1,124 @@
+"""
+ストリームのリアルタイム配信
+
+お知らせの作成・更新・削除とリアクション数の増減を Redis pub/sub に流し、
+各 API ワーカーが自分に接続しているクライアントへ SSE で配信する。
+ワーカーごとに Redis の購読は1本だけで、ストリーム単位のキューに振り分ける。
+
+対象学年・クラスのあるお知らせのイベントには targets を付けて発行し、
+各接続で閲覧者に表示しないものを除いてから送る（targets はクライアントに送らない）。
+"""
+import asyncio
+import json
+from typing import Dict, Optional, Set, Tuple
+
+from fastapi.encoders import jsonable_encoder
+
+from .announcement_targets import Audience, is_visible_to
+from .redis_client import get_redis
+
+CHANNEL_PREFIX = "stream-events:"
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def channel_for(stream_id: str) -> str:
+    return f"{CHANNEL_PREFIX}{stream_id}"
+
+
+async def publish_stream_event(
+    stream_id: str, event_type: str, data: dict, targets: Optional[dict] = None
+):
+    """ストリームのイベントを発行（失敗しても書き込み処理は継続）
+
+    targets はお知らせの対象学年・クラス（announcement_targets の値）。
+    """
+    event = {"type": event_type, "stream_id": stream_id, "data": jsonable_encoder(data)}
+    if targets and (targets.get("grades") or targets.get("classes")):
+        event["targets"] = targets
+    message = json.dumps(event, ensure_ascii=False)
+    try:
+        await get_redis().publish(channel_for(stream_id), message)
+    except Exception as e:
+        print(f"ストリームイベントの発行に失敗しました: {e}")
+
+
+def event_for_audience(
+    message: str, audience: Optional[Audience]
+) -> Optional[Tuple[str, str]]:
+    """閲覧者に送るイベントの (種類, データ)。送らない場合は None
+
+    対象外になったお知らせの更新は、クライアントが一覧から外せるよう削除として送る。
+    """
+    event = json.loads(message)
+    targets = event.pop("targets", None)
+    if targets is None:
+        return event["type"], message
+    if is_visible_to(audience, event["stream_id"], targets):
+        return event["type"], json.dumps(event, ensure_ascii=False)
+    if event["type"] != "announcement:update":
+        return None
+    deleted = {
+        "type": "announcement:delete",
+        "stream_id": event["stream_id"],
+        "data": {"id": event["data"]["id"]},
+    }
+    return deleted["type"], json.dumps(deleted, ensure_ascii=False)
+
+
+def format_sse(event_type: str, data: str) -> str:
+    return f"event: {event_type}\ndata: {data}\n\n"
+
+
+class StreamEventHub:
+    """ワーカー内の SSE 接続へイベントを振り分ける"""
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self.listener: Optional[asyncio.Task] = None
+
+    def subscribe(self, stream_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers.setdefault(stream_id, set()).add(queue)
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self._listen())
+        return queue
+
+    def unsubscribe(self, stream_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(stream_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[stream_id]
+
+    def dispatch(self, channel: str, message: str):
+        stream_id = channel[len(CHANNEL_PREFIX) :]
+        for queue in self.subscribers.get(stream_id, ()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # 受信が追いつかないクライアントのイベントは破棄する
+                pass
+
+    async def _listen(self):
+        while True:
+            try:
+                pubsub = get_redis().pubsub()
+                await pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+                async for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    channel = message["channel"]
+                    data = message["data"]
+                    self.dispatch(
+                        channel.decode() if isinstance(channel, bytes) else channel,
+                        data.decode() if isinstance(data, bytes) else data,
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"ストリームイベントの購読が切断されました: {e}")
+                await asyncio.sleep(1)
+
+
+stream_event_hub = StreamEventHub()
@@ -0,0 +1,327 @@
+"""
+ストリームメンバーの一括登録と一覧
+
+CSV または JSON で受け取ったメールアドレスとロールを一定件数ずつまとめ、
+ユーザーの解決を IN クエリ1回、メンバーシップの登録を複数行の
+INSERT ... ON CONFLICT DO NOTHING 1回で行う。CSV は受信しながら1行ずつ
+解析するため、ファイルサイズに関わらずメモリ使用量は一定に保たれる。
+"""
+import codecs
+import csv
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+from uuid import uuid4
+
+from sqlalchemy import and_, delete, func, or_, select, tuple_
+
+from .database import dialect_insert
+from .feed_service import decode_cursor, encode_cursor
+from .models import AnnouncementReadMark, StreamMembership, StreamRole, User
+
+MEMBER_ORDER = (User.name, User.id)
+
+MEMBERSHIP_IMPORT_BATCH_SIZE = 500
+MAX_CSV_LINE_LENGTH = 4096
+
+# 行ごとの結果
+ADDED = "added"
+ALREADY_MEMBER = "already_member"
+USER_NOT_FOUND = "user_not_found"
+DUPLICATE = "duplicate"
+INVALID = "invalid"
+
+
+@dataclass
+class MemberRow:
+    row: int
+    email: str
+    role: Optional[str] = None
+
+
+async def iter_csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[List[str]]:
+    """バイト列のチャンクから CSV を1行ずつ取り出す（BOM 付き UTF-8 にも対応）"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        if len(buffer) > MAX_CSV_LINE_LENGTH:
+            raise ValueError("CSV line too long")
+        for row in csv.reader(lines):
+            yield row
+
+    buffer += decoder.decode(b"", final=True)
+    if buffer.strip():
+        for row in csv.reader([buffer]):
+            yield row
+
+
+async def iter_csv_members(chunks: AsyncIterator[bytes]) -> AsyncIterator[MemberRow]:
+    """email,role 形式の CSV をメンバー行に変換（ヘッダー行は省略可）"""
+    row_number = 0
+    async for row in iter_csv_rows(chunks):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        email = row[0].strip()
+        if row_number == 0 and "@" not in email and email.lower() == "email":
+            continue  # ヘッダー行
+        row_number += 1
+        role = row[1].strip() if len(row) > 1 and row[1].strip() else None
+        yield MemberRow(row=row_number, email=email, role=role)
+
+
+async def iter_upload_chunks(upload, chunk_size: int = 64 * 1024):
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _parse_role(role: Optional[str]) -> Optional[StreamRole]:
+    if role is None:
+        return StreamRole.STUDENT
+    try:
+        return StreamRole(role.lower())
+    except ValueError:
+        return None
+
+
+async def _import_batch(session, stream_id: str, batch: List[MemberRow]) -> List[dict]:
+    emails = {member.email for member in batch}
+    user_result = await session.execute(
+        select(User.email, User.id).where(User.email.in_(emails))
+    )
+    user_ids: Dict[str, str] = dict(user_result.all())
+
+    now = datetime.utcnow()
+    values = [
+        {
+            "id": str(uuid4()),
+            "user_id": user_ids[member.email],
+            "stream_id": stream_id,
+            "role": _parse_role(member.role),
+            "joined_at": now,
+        }
+        for member in batch
+        if member.email in user_ids
+    ]
+
+    inserted = set()
+    if values:
+        statement = (
+            dialect_insert(session, StreamMembership)
+            .values(values)
+            .on_conflict_do_nothing(index_elements=["user_id", "stream_id"])
+            .returning(StreamMembership.user_id)
+        )
+        result = await session.execute(statement)
+        inserted = set(result.scalars().all())
+
+    results = []
+    for member in batch:
+        user_id = user_ids.get(member.email)
+        if user_id is None:
+            status = USER_NOT_FOUND
+        elif user_id in inserted:
+            status = ADDED
+        else:
+            status = ALREADY_MEMBER
+        results.append(
+            {
+                "row": member.row,
+                "email": member.email,
+                "role": _parse_role(member.role),
+                "status": status,
+                "user_id": user_id,
+            }
+        )
+    return results
+
+
+async def import_memberships(
+    session, stream_id: str, members: AsyncIterator[MemberRow]
+) -> dict:
+    """メンバーを一括登録し、行ごとの結果と集計を返す（コミットは呼び出し側）"""
+    results: List[dict] = []
+    seen = set()
+    batch: List[MemberRow] = []
+
+    async for member in members:
+        if "@" not in member.email or _parse_role(member.role) is None:
+            results.append(
+                {
+                    "row": member.row,
+                    "email": member.email,
+                    "role": member.role,
+                    "status": INVALID,
+                }
+            )
+            continue
+        if member.email in seen:
+            results.append(
+                {
+                    "row": member.row,
+                    "email": member.email,
+                    "role": _parse_role(member.role),
+                    "status": DUPLICATE,
+                }
+            )
+            continue
+        seen.add(member.email)
+
+        batch.append(member)
+        if len(batch) >= MEMBERSHIP_IMPORT_BATCH_SIZE:
+            results.extend(await _import_batch(session, stream_id, batch))
+            batch = []
+
+    if batch:
+        results.extend(await _import_batch(session, stream_id, batch))
+
+    results.sort(key=lambda r: r["row"])
+    added_user_ids = [r.pop("user_id") for r in results if r["status"] == ADDED]
+    for result in results:
+        result.pop("user_id", None)
+    summary = {
+        status: 0
+        for status in (ADDED, ALREADY_MEMBER, USER_NOT_FOUND, DUPLICATE, INVALID)
+    }
+    for result in results:
+        summary[result["status"]] += 1
+    # ロールのキャッシュの無効化に使う（レスポンスには含めない）
+    return {"summary": summary, "results": results, "added_user_ids": added_user_ids}
+
+
+def member_filter_condition(
+    stream_id: str,
+    role: Optional[StreamRole] = None,
+    grade: Optional[int] = None,
+    class_name: Optional[str] = None,
+    q: Optional[str] = None,
+):
+    """メンバー一覧の絞り込み条件（StreamMembership と User の結合が前提）"""
+    conditions = [StreamMembership.stream_id == stream_id]
+    if role is not None:
+        conditions.append(StreamMembership.role == role)
+    if grade is not None:
+        conditions.append(User.grade == grade)
+    if class_name is not None:
+        conditions.append(User.class_name == class_name)
+    if q:
+        # 名前・メールアドレスの前方一致
+        conditions.append(
+            or_(
+                User.name.startswith(q, autoescape=True),
+                User.email.startswith(q, autoescape=True),
+            )
+        )
+    return and_(*conditions)
+
+
+def encode_member_cursor(user: User) -> str:
+    return encode_cursor([user.name, user.id])
+
+
+def member_keyset_condition(cursor: str):
+    """カーソル位置より後ろのメンバーを絞り込む条件。不正な場合は ValueError"""
+    name, user_id = decode_cursor(cursor, 2)
+    return tuple_(*MEMBER_ORDER) > tuple_(str(name), str(user_id))
+
+
+# 重複を整理するときに残すロールの優先順位（小さいほど優先）
+ROLE_PRIORITY = {StreamRole.ADMIN: 0, StreamRole.STREAM_ADMIN: 1, StreamRole.STUDENT: 2}
+
+
+def _survivor_order(membership) -> tuple:
+    return (
+        ROLE_PRIORITY[StreamRole(membership.role)],
+        membership.joined_at,
+        membership.id,
+    )
+
+
+def _read_position(membership) -> tuple:
+    # 既読位置がないものは最も古い位置として比べる
+    return (membership.last_read_at or datetime.min, membership.last_read_id or "")
+
+
+async def merge_duplicate_memberships(conn) -> int:
+    """(user_id, stream_id) の重複を1件にまとめ、削除した件数を返す
+
+    一意インデックスを作成する前に src.deduplicate から手動で実行する。
+    残すのはロールの優先度が最も高く、参加が最も早いメンバーシップ。
+    削除するものの既読マーク・既読位置・連番は残すものに引き継ぐ。
+    """
+    groups = await conn.execute(
+        select(StreamMembership.user_id, StreamMembership.stream_id)
+        .group_by(StreamMembership.user_id, StreamMembership.stream_id)
+        .having(func.count() > 1)
+    )
+    removed = 0
+    for user_id, stream_id in groups.all():
+        result = await conn.execute(
+            select(StreamMembership.__table__).where(
+                StreamMembership.user_id == user_id,
+                StreamMembership.stream_id == stream_id,
+            )
+        )
+        survivor, *duplicates = sorted(result.all(), key=_survivor_order)
+        await _merge_into(conn, survivor, duplicates)
+        removed += len(duplicates)
+    return removed
+
+
+async def _merge_into(conn, survivor, duplicates):
+    duplicate_ids = [d.id for d in duplicates]
+    kept = select(AnnouncementReadMark.announcement_id).where(
+        AnnouncementReadMark.membership_id == survivor.id
+    )
+    marks = await conn.execute(
+        select(AnnouncementReadMark.__table__).where(
+            AnnouncementReadMark.membership_id.in_(duplicate_ids),
+            AnnouncementReadMark.announcement_id.not_in(kept),
+        )
+    )
+    moved = {}
+    for mark in marks.all():
+        # 同じお知らせに複数あれば既読を優先する
+        if mark.announcement_id not in moved or mark.is_read:
+            moved[mark.announcement_id] = mark
+
+    await conn.execute(
+        delete(AnnouncementReadMark).where(
+            AnnouncementReadMark.membership_id.in_(duplicate_ids)
+        )
+    )
+    await conn.execute(
+        delete(StreamMembership).where(StreamMembership.id.in_(duplicate_ids))
+    )
+    if moved:
+        await conn.execute(
+            AnnouncementReadMark.__table__.insert(),
+            [
+                {
+                    "membership_id": survivor.id,
+                    "announcement_id": mark.announcement_id,
+                    "is_read": mark.is_read,
+                    "created_at": mark.created_at,
+                }
+                for mark in moved.values()
+            ],
+        )
+
+    latest = max([survivor, *duplicates], key=_read_position)
+    ordinal = survivor.ordinal
+    if ordinal is None:
+        # 残すものに連番がなければ、削除したものの連番（ビット位置）を使う
+        ordinal = next((d.ordinal for d in duplicates if d.ordinal is not None), None)
+    await conn.execute(
+        StreamMembership.__table__.update()
+        .where(StreamMembership.id == survivor.id)
+        .values(
+            last_read_at=latest.last_read_at,
+            last_read_id=latest.last_read_id,
+            ordinal=ordinal,
+        )
+    )
@@ -193,6 +193,84 @@ CampusFlow Team
     return "Assignment reminders sent successfully"
 
 
+@app.task
+def archive_old_announcements():
+    """Move announcements older than the academic-year cutoff into the archive"""
+    import asyncio
+
+    from .announcement_archive import archive_old_announcements as archive
+
+    result = asyncio.run(archive())
+    print(f"Archived {result['archived']} announcements before {result['cutoff']}")
+    return result
+
+
+@app.task(
+    bind=True,
+    ignore_result=True,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=5,
+)
+def notify_urgent_announcement(self, announcement_id: str):
+    """Split an urgent announcement's recipients into keyset chunks and enqueue them"""
+    import asyncio
+
+    from .urgent_notifications import run_fan_out
+
+    def enqueue(chunk):
+        after_id, last_id = chunk
+        send_urgent_notification_chunk.delay(announcement_id, after_id, last_id)
+
+    chunks = asyncio.run(run_fan_out(announcement_id, enqueue))
+    print(f"Enqueued {chunks} notification chunks for announcement {announcement_id}")
+    return chunks
+
+
+@app.task(
+    bind=True,
+    ignore_result=True,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    retry_backoff_max=600,
+    max_retries=8,
+)
+def send_urgent_notification_chunk(
+    self, announcement_id: str, after_id: str, last_id: str
+):
+    """Email one chunk of recipients; already-notified users are skipped on retry"""
+    import asyncio
+
+    from .urgent_notifications import run_deliver_chunk
+
+    result = asyncio.run(
+        run_deliver_chunk(announcement_id, (after_id, last_id), send_email)
+    )
+    print(
+        f"Urgent notification chunk ({after_id}, {last_id}] for "
+        f"{announcement_id}: {result}"
+    )
+    return result
+
+
+@app.task(
+    bind=True,
+    ignore_result=True,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=5,
+)
+def seed_sample_data(self, user_id: str):
+    """Create a user's one-time sample data; no-op if another job claimed it"""
+    import asyncio
+
+    from .sample_data import run_seed_user_sample_data
+
+    result = asyncio.run(run_seed_user_sample_data(user_id))
+    print(f"Sample data for user {user_id}: {result or 'already seeded'}")
+    return result
+
+
 @app.task
 def send_welcome_email(user_email: str, user_name: str):
     """Send welcome email to new user"""
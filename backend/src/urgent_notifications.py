@@ -0,0 +1,254 @@
+"""
+緊急のお知らせのメール通知
+
+投稿時に通知の振り分けタスクを1つ登録し、振り分けタスクはストリームの
+メンバーシップを id のキーセットで一定件数ごとの範囲 (after_id, last_id] に
+区切って、範囲ごとの送信タスクを登録する。範囲はメンバーの増減に関わらず
+固定なので、送信タスクを再試行しても同じメンバーが対象になる。
+
+重複送信を防ぐため、Redis に次の冪等キーを記録する。
+
+- 振り分け: notify:urgent:<announcement_id>:fanout
+- 範囲: notify:urgent:<announcement_id>:chunk:<last_id>（送信完了後）
+- 受信者: notify:urgent:<announcement_id>:user:<user_id>（送信前に確保し、
+  失敗したら削除して再試行に回す）
+"""
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, or_, select
+
+from .announcement_targets import (
+    UNRESTRICTED_STREAM_ROLES,
+    UNRESTRICTED_USER_ROLES,
+    Audience,
+    audience_condition,
+)
+from .database import task_sessions
+from .models import Announcement, Stream, StreamMembership, User
+from .redis_client import create_task_redis
+
+NOTIFICATION_CHUNK_SIZE = int(os.getenv("NOTIFICATION_CHUNK_SIZE", "200"))
+NOTIFICATION_IDEMPOTENCY_TTL_SECONDS = 7 * 24 * 60 * 60
+FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
+
+NOTIFICATION_KEY_PREFIX = "notify:urgent:"
+
+Chunk = Tuple[Optional[str], str]
+
+
+class NotificationDeliveryError(Exception):
+    """範囲内の一部の受信者に送信できなかった（タスクを再試行する）"""
+
+
+def fanout_key(announcement_id: str) -> str:
+    return f"{NOTIFICATION_KEY_PREFIX}{announcement_id}:fanout"
+
+
+def chunk_key(announcement_id: str, last_id: str) -> str:
+    return f"{NOTIFICATION_KEY_PREFIX}{announcement_id}:chunk:{last_id}"
+
+
+def recipient_key(announcement_id: str, user_id: str) -> str:
+    return f"{NOTIFICATION_KEY_PREFIX}{announcement_id}:user:{user_id}"
+
+
+async def plan_notification_chunks(
+    session, stream_id: str, chunk_size: int = NOTIFICATION_CHUNK_SIZE
+) -> List[Chunk]:
+    """メンバーシップを id 順に chunk_size 件ずつ区切った範囲 (after_id, last_id]"""
+    chunks = []
+    after_id = None
+    while True:
+        statement = (
+            select(StreamMembership.id)
+            .where(StreamMembership.stream_id == stream_id)
+            .order_by(StreamMembership.id)
+            .limit(chunk_size)
+        )
+        if after_id is not None:
+            statement = statement.where(StreamMembership.id > after_id)
+        membership_ids = (await session.execute(statement)).scalars().all()
+        if not membership_ids:
+            return chunks
+        chunks.append((after_id, membership_ids[-1]))
+        if len(membership_ids) < chunk_size:
+            return chunks
+        after_id = membership_ids[-1]
+
+
+def _recipient_condition(announcement: Announcement):
+    """お知らせが表示されるメンバー（投稿者を除く）"""
+    return and_(
+        User.id != announcement.created_by,
+        or_(
+            User.role.in_(UNRESTRICTED_USER_ROLES),
+            StreamMembership.role.in_(UNRESTRICTED_STREAM_ROLES),
+            audience_condition(
+                Audience(User.grade, User.class_name),
+                announcement.id,
+                announcement.stream_id,
+            ),
+        ),
+    )
+
+
+async def load_chunk_recipients(
+    session, announcement: Announcement, chunk: Chunk
+) -> List[User]:
+    after_id, last_id = chunk
+    statement = (
+        select(User)
+        .join(StreamMembership, StreamMembership.user_id == User.id)
+        .where(
+            StreamMembership.stream_id == announcement.stream_id,
+            StreamMembership.id <= last_id,
+            _recipient_condition(announcement),
+        )
+        .order_by(StreamMembership.id)
+    )
+    if after_id is not None:
+        statement = statement.where(StreamMembership.id > after_id)
+    return (await session.execute(statement)).scalars().all()
+
+
+def render_urgent_notification(
+    announcement: Announcement, stream: Stream
+) -> Tuple[str, str, str]:
+    """件名・本文・HTML 本文（範囲内の受信者で共通）"""
+    url = f"{FRONTEND_URL}/streams/{stream.id}"
+    subject = f"【緊急】{stream.name}: {announcement.title}"
+    body = f"""
+{stream.name} に緊急のお知らせが投稿されました。
+
+{announcement.title}
+
+{announcement.content}
+
+{url}
+    """.strip()
+    html_body = f"""
+<html>
+<body>
+    <h2>【緊急】{announcement.title}</h2>
+    <p>{stream.name} に緊急のお知らせが投稿されました。</p>
+    <p>{announcement.content}</p>
+    <p><a href="{url}">CampusFlow で開く</a></p>
+</body>
+</html>
+    """.strip()
+    return subject, body, html_body
+
+
+async def _load_announcement(session, announcement_id: str):
+    result = await session.execute(
+        select(Announcement, Stream)
+        .join(Stream, Stream.id == Announcement.stream_id)
+        .where(Announcement.id == announcement_id)
+    )
+    return result.first()
+
+
+async def fan_out_notification(
+    session,
+    client,
+    announcement_id: str,
+    enqueue: Callable[[Chunk], None],
+    chunk_size: int = NOTIFICATION_CHUNK_SIZE,
+) -> int:
+    """範囲ごとの送信タスクを登録し、登録した範囲の数を返す
+
+    すべて登録できてから振り分け済みのキーを記録する。途中で失敗して
+    再試行した場合に同じ範囲が重複して登録されても、受信者の冪等キーで
+    二重送信は起きない。
+    """
+    if await client.exists(fanout_key(announcement_id)):
+        return 0
+    row = await _load_announcement(session, announcement_id)
+    if row is None or not row.Announcement.is_urgent:
+        return 0
+
+    chunks = await plan_notification_chunks(
+        session, row.Announcement.stream_id, chunk_size
+    )
+    for chunk in chunks:
+        enqueue(chunk)
+    await client.set(
+        fanout_key(announcement_id), "1", ex=NOTIFICATION_IDEMPOTENCY_TTL_SECONDS
+    )
+    return len(chunks)
+
+
+async def deliver_chunk(
+    session,
+    client,
+    announcement_id: str,
+    chunk: Chunk,
+    send: Callable[..., bool],
+) -> Dict[str, int]:
+    """範囲内の受信者に送信し、送信・スキップ・失敗の件数を返す
+
+    失敗した受信者がいれば NotificationDeliveryError を送出する
+    （送信済みの受信者は再試行でスキップされる）。
+    """
+    summary = {"sent": 0, "skipped": 0, "failed": 0}
+    done_key = chunk_key(announcement_id, chunk[1])
+    if await client.exists(done_key):
+        return summary
+
+    row = await _load_announcement(session, announcement_id)
+    if row is None:
+        return summary
+    subject, body, html_body = render_urgent_notification(*row)
+
+    for user in await load_chunk_recipients(session, row.Announcement, chunk):
+        key = recipient_key(announcement_id, user.id)
+        claimed = await client.set(
+            key, "1", nx=True, ex=NOTIFICATION_IDEMPOTENCY_TTL_SECONDS
+        )
+        if not claimed:
+            summary["skipped"] += 1
+        elif send(user.email, subject, body, html_body):
+            summary["sent"] += 1
+        else:
+            await client.delete(key)
+            summary["failed"] += 1
+
+    if summary["failed"]:
+        raise NotificationDeliveryError(f"{summary['failed']} 件の通知を送信できませんでした")
+    await client.set(done_key, "1", ex=NOTIFICATION_IDEMPOTENCY_TTL_SECONDS)
+    return summary
+
+
+async def run_fan_out(announcement_id: str, enqueue: Callable[[Chunk], None]) -> int:
+    client = create_task_redis()
+    try:
+        async with task_sessions() as sessions, sessions() as session:
+            return await fan_out_notification(session, client, announcement_id, enqueue)
+    finally:
+        await client.aclose()
+
+
+async def run_deliver_chunk(
+    announcement_id: str, chunk: Chunk, send: Callable[..., bool]
+) -> Dict[str, int]:
+    client = create_task_redis()
+    try:
+        async with task_sessions() as sessions, sessions() as session:
+            return await deliver_chunk(session, client, announcement_id, chunk, send)
+    finally:
+        await client.aclose()
+
+
+def enqueue_urgent_notification(announcement_id: str):
+    """通知の振り分けタスクを登録（レスポンス後にバックグラウンドで呼ぶ）
+
+    登録できなくても投稿は失敗させない。
+    """
+    from .tasks import notify_urgent_announcement
+
+    try:
+        # ブローカーに接続できない場合に待ち続けないよう、再接続しない
+        notify_urgent_announcement.apply_async((announcement_id,), retry=False)
+    except Exception as e:
+        print(f"緊急のお知らせの通知を登録できませんでした: {e}")
@@ -0,0 +1,164 @@
+"""
+認証済みユーザーのキャッシュ
+
+get_current_user はリクエストごとに User を1件取得するため、ワーカー内の
+TTL 付き LRU と全ワーカーで共有する Redis の2段でキャッシュする。
+値は User のカラムを JSON にしたもので、取り出すたびに新しい User を作る。
+
+プロフィールの更新・ストリーム管理者への昇格・ログイン時に invalidate で
+このワーカーと Redis のエントリを削除する。他のワーカーのプロセス内の
+エントリは USER_CACHE_LOCAL_TTL_SECONDS で消えるため、変更が反映されるまでの
+遅れは最大でその秒数になる。
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from .metrics import metrics
+from .models import User
+from .redis_client import get_redis
+
+USER_CACHE_BACKEND = os.getenv("USER_CACHE_BACKEND", "redis")
+USER_CACHE_LOCAL_TTL_SECONDS = float(os.getenv("USER_CACHE_LOCAL_TTL_SECONDS", "5"))
+USER_CACHE_REDIS_TTL_SECONDS = int(os.getenv("USER_CACHE_REDIS_TTL_SECONDS", "300"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+
+
+def user_key(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+def dump_user(user: User) -> Dict:
+    return user.model_dump(mode="json")
+
+
+def load_user(data: Dict) -> User:
+    """キャッシュの値から、セッションに merge(load=False) できる User を作る"""
+    user = User.model_validate(data)
+    make_transient_to_detached(user)
+    return user
+
+
+class LocalUserCache:
+    """ワーカー内の TTL 付き LRU"""
+
+    def __init__(
+        self,
+        max_entries: int = USER_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = USER_CACHE_LOCAL_TTL_SECONDS,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at < time.monotonic():
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        return data
+
+    def set(self, user_id: str, data: Dict):
+        self.entries[user_id] = (time.monotonic() + self.ttl_seconds, data)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def delete(self, user_id: str):
+        self.entries.pop(user_id, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class UserCache:
+    """2段のユーザーキャッシュ。Redis の障害時はプロセス内のキャッシュだけで動作する"""
+
+    def __init__(self, local: Optional[LocalUserCache], use_redis: bool):
+        self.local = local
+        self.use_redis = use_redis
+
+    @property
+    def enabled(self) -> bool:
+        return self.local is not None or self.use_redis
+
+    async def get(self, user_id: str) -> Optional[User]:
+        if not self.enabled:
+            return None
+        if self.local is not None:
+            data = self.local.get(user_id)
+            if data is not None:
+                metrics.incr("user_cache.local_hit")
+                return load_user(data)
+
+        data = await self._get_shared(user_id)
+        if data is None:
+            metrics.incr("user_cache.miss")
+            return None
+        metrics.incr("user_cache.redis_hit")
+        if self.local is not None:
+            self.local.set(user_id, data)
+        return load_user(data)
+
+    async def _get_shared(self, user_id: str) -> Optional[Dict]:
+        if not self.use_redis:
+            return None
+        try:
+            body = await get_redis().get(user_key(user_id))
+        except Exception as e:
+            metrics.incr("user_cache.error")
+            print(f"ユーザーキャッシュの取得に失敗しました: {e}")
+            return None
+        return json.loads(body) if body is not None else None
+
+    async def set(self, user: User):
+        if not self.enabled:
+            return
+        data = dump_user(user)
+        if self.local is not None:
+            self.local.set(user.id, data)
+        if not self.use_redis:
+            return
+        try:
+            await get_redis().set(
+                user_key(user.id),
+                json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+                ex=USER_CACHE_REDIS_TTL_SECONDS,
+            )
+        except Exception as e:
+            metrics.incr("user_cache.error")
+            print(f"ユーザーキャッシュの保存に失敗しました: {e}")
+
+    async def invalidate(self, user_id: str):
+        """コミット後に呼び出し、ユーザーのキャッシュを削除する"""
+        if not self.enabled:
+            return
+        metrics.incr("user_cache.invalidate")
+        if self.local is not None:
+            self.local.delete(user_id)
+        if not self.use_redis:
+            return
+        try:
+            await get_redis().delete(user_key(user_id))
+        except Exception as e:
+            metrics.incr("user_cache.error")
+            print(f"ユーザーキャッシュの削除に失敗しました: {e}")
+
+
+def create_user_cache(backend: str) -> UserCache:
+    if backend == "redis":
+        return UserCache(LocalUserCache(), use_redis=True)
+    if backend == "local":
+        return UserCache(LocalUserCache(), use_redis=False)
+    return UserCache(None, use_redis=False)
+
+
+user_cache = create_user_cache(USER_CACHE_BACKEND)
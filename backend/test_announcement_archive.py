@@ -0,0 +1,208 @@
+"""
+Tests for set-based announcement deletion and academic-year archival
+Run with: python -m pytest test_announcement_archive.py -v
+"""
+
+from datetime import datetime
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import event, func
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel, select
+
+from src.announcement_archive import (
+    academic_year_start,
+    archive_announcements,
+    archive_cutoff,
+    delete_announcements,
+)
+from src.announcement_tags import TagFilter, set_announcement_tags
+from src.announcement_targets import Audience, set_announcement_targets
+from src.database import _enable_sqlite_foreign_keys
+from src.models import (
+    Announcement,
+    AnnouncementReaction,
+    AnnouncementReactionCount,
+    AnnouncementTag,
+    AnnouncementTargetGrade,
+    ArchivedAnnouncement,
+    ArchivedAnnouncementReaction,
+    ArchivedAnnouncementTag,
+    ArchivedAnnouncementTargetGrade,
+    StreamTagCount,
+)
+from src.reaction_counters import apply_reaction_delta
+from src.search_service import SQLiteFTS5Backend, load_ranked_announcements
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+@pytest_asyncio.fixture
+async def engine():
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await SQLiteFTS5Backend().ensure_schema(conn)
+    yield engine
+    await engine.dispose()
+
+
+async def seed_announcement(
+    session: AsyncSession, announcement_id: str, created_at: datetime, **fields
+):
+    announcement = Announcement(
+        id=announcement_id,
+        title="体育祭",
+        content="体育祭のお知らせ",
+        stream_id="s1",
+        created_by="teacher",
+        created_at=created_at,
+        **fields,
+    )
+    session.add(announcement)
+    await session.flush()
+    await set_announcement_targets(session, announcement, grades=[2])
+    await set_announcement_tags(session, announcement, ["行事"])
+    session.add(
+        AnnouncementReaction(
+            announcement_id=announcement_id, user_id="u1", reaction_type="like"
+        )
+    )
+    await apply_reaction_delta(session, announcement_id, "like", "u1", 1)
+    await SQLiteFTS5Backend().index_announcement(session, announcement)
+    return announcement
+
+
+async def count(session: AsyncSession, table) -> int:
+    result = await session.execute(select(func.count()).select_from(table))
+    return result.scalar_one()
+
+
+async def tag_count(session: AsyncSession) -> int:
+    result = await session.execute(select(StreamTagCount.count))
+    return result.scalar_one()
+
+
+class TestCutoff:
+    """Test cases for the academic-year cutoff"""
+
+    def test_year_starts_in_april(self):
+        assert academic_year_start(datetime(2026, 3, 31)) == datetime(2025, 4, 1)
+        assert academic_year_start(datetime(2026, 4, 1)) == datetime(2026, 4, 1)
+
+    def test_retention_keeps_previous_years(self):
+        now = datetime(2026, 10, 17)
+        assert archive_cutoff(now, retention_years=0) == datetime(2026, 4, 1)
+        assert archive_cutoff(now, retention_years=1) == datetime(2025, 4, 1)
+
+
+class TestDeleteAnnouncements:
+    """Test cases for the set-based delete path"""
+
+    @pytest.mark.asyncio
+    async def test_deletes_children_and_decrements_tag_counts(self, engine):
+        async with AsyncSession(engine) as session:
+            for announcement_id in ("a", "b", "c"):
+                await seed_announcement(session, announcement_id, datetime(2026, 5, 1))
+            assert await tag_count(session) == 3
+
+            await delete_announcements(session, ["a", "b"])
+
+            assert await count(session, Announcement) == 1
+            assert await count(session, AnnouncementReaction) == 1
+            assert await count(session, AnnouncementReactionCount) == 1
+            assert await count(session, AnnouncementTargetGrade) == 1
+            assert await count(session, AnnouncementTag) == 1
+            assert await tag_count(session) == 1
+
+    @pytest.mark.asyncio
+    async def test_database_cascade_with_foreign_keys(self, tmp_path):
+        url = f"sqlite+aiosqlite:///{tmp_path / 'cascade.db'}"
+        setup_engine = create_async_engine(url)
+        async with setup_engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        async with AsyncSession(setup_engine) as session:
+            session.add(
+                ArchivedAnnouncement(
+                    id="old", title="t", content="c", stream_id="s1", created_by="u"
+                )
+            )
+            session.add(ArchivedAnnouncementTargetGrade(announcement_id="old", grade=1))
+            await session.commit()
+        await setup_engine.dispose()
+
+        # 接続時に外部キー制約を有効にすると、親行の削除で子行も削除される
+        engine = create_async_engine(url)
+        event.listen(engine.sync_engine, "connect", _enable_sqlite_foreign_keys)
+        async with engine.begin() as conn:
+            await conn.execute(
+                ArchivedAnnouncement.__table__.delete().where(
+                    ArchivedAnnouncement.id == "old"
+                )
+            )
+        async with AsyncSession(engine) as session:
+            assert await count(session, ArchivedAnnouncementTargetGrade) == 0
+        await engine.dispose()
+
+
+class TestArchive:
+    """Test cases for moving old announcements to the archive"""
+
+    @pytest.mark.asyncio
+    async def test_moves_old_rows_and_keeps_pinned(self, engine):
+        async with AsyncSession(engine) as session:
+            await seed_announcement(session, "old", datetime(2024, 6, 1))
+            await seed_announcement(
+                session, "pinned", datetime(2024, 6, 1), is_pinned=True
+            )
+            await seed_announcement(session, "new", datetime(2026, 5, 1))
+            await session.commit()
+
+            archived = await archive_announcements(session, datetime(2025, 4, 1))
+            await session.commit()
+
+            assert archived == ["old"]
+            live = await session.execute(select(Announcement.id))
+            assert sorted(live.scalars().all()) == ["new", "pinned"]
+            assert (await session.get(ArchivedAnnouncement, "old")).title == "体育祭"
+            assert await count(session, ArchivedAnnouncementReaction) == 1
+            assert await count(session, ArchivedAnnouncementTargetGrade) == 1
+            assert await count(session, ArchivedAnnouncementTag) == 1
+            assert await tag_count(session) == 2
+
+    @pytest.mark.asyncio
+    async def test_search_opts_in_to_archive(self, engine):
+        backend = SQLiteFTS5Backend()
+        async with AsyncSession(engine) as session:
+            await seed_announcement(session, "old", datetime(2024, 6, 1))
+            await seed_announcement(session, "new", datetime(2026, 5, 1))
+            await archive_announcements(session, datetime(2025, 4, 1))
+            await session.commit()
+
+            hits = await backend.search(session, "体育祭", ["s1"])
+            assert [hit.announcement_id for hit in hits] == ["new"]
+
+            hits = await backend.search(
+                session,
+                "体育祭",
+                ["s1"],
+                audience=Audience(grade=2, class_name="2年A組"),
+                tag_filter=TagFilter(exact="行事"),
+                include_archive=True,
+            )
+            assert {hit.announcement_id for hit in hits} == {"old", "new"}
+            ranked = await load_ranked_announcements(session, hits, True)
+            assert {type(a) for _, a in ranked} == {
+                Announcement,
+                ArchivedAnnouncement,
+            }
+
+            hits = await backend.search(
+                session,
+                "体育祭",
+                ["s1"],
+                audience=Audience(grade=1, class_name="1年A組"),
+                include_archive=True,
+            )
+            assert hits == []
@@ -0,0 +1,123 @@
+"""
+Tests for the normalized tag index and facet counts
+Run with: python -m pytest test_announcement_tags.py -v
+"""
+
+import json
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel, select
+
+from src.announcement_tags import (
+    TagFilter,
+    delete_announcement_tags,
+    load_tag_facets,
+    normalize_tags,
+    rebuild_announcement_tags,
+    set_announcement_tags,
+)
+from src.models import Announcement
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+@pytest_asyncio.fixture
+async def engine():
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    yield engine
+    await engine.dispose()
+
+
+async def seed_tagged(session: AsyncSession, tagged: dict):
+    announcements = {}
+    for announcement_id, tags in tagged.items():
+        announcement = Announcement(
+            id=announcement_id,
+            title=announcement_id,
+            content="内容",
+            stream_id="s1",
+            created_by="teacher",
+        )
+        session.add(announcement)
+        await session.flush()
+        await set_announcement_tags(session, announcement, tags)
+        announcements[announcement_id] = announcement
+    await session.commit()
+    return announcements
+
+
+async def matching_ids(session: AsyncSession, tag_filter: TagFilter):
+    result = await session.execute(
+        select(Announcement.id).where(tag_filter.condition())
+    )
+    return sorted(result.scalars().all())
+
+
+class TestNormalization:
+    """Test cases for tag normalization"""
+
+    def test_width_whitespace_and_duplicates(self):
+        assert normalize_tags([" ＰＴＡ", "PTA", "", "数学"]) == ["PTA", "数学"]
+
+    def test_empty_filter_is_none(self):
+        assert TagFilter.from_params(None, " ") is None
+
+
+class TestTagFilter:
+    """Test cases for exact and prefix tag filtering"""
+
+    @pytest.mark.asyncio
+    async def test_exact_does_not_match_longer_tags(self, engine):
+        async with AsyncSession(engine) as session:
+            await seed_tagged(session, {"a": ["数学"], "b": ["数学部活"], "c": ["行事"]})
+
+            assert await matching_ids(session, TagFilter(exact="数学")) == ["a"]
+            assert await matching_ids(session, TagFilter(prefix="数学")) == [
+                "a",
+                "b",
+            ]
+            assert await matching_ids(session, TagFilter(prefix="%")) == []
+
+
+class TestTagFacets:
+    """Test cases for maintained per-stream tag counts"""
+
+    @pytest.mark.asyncio
+    async def test_counts_follow_updates_and_deletes(self, engine):
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            announcements = await seed_tagged(
+                session, {"a": ["数学", "行事"], "b": ["数学"], "c": ["行事"]}
+            )
+            assert await load_tag_facets(session, "s1") == [
+                {"tag": "数学", "count": 2},
+                {"tag": "行事", "count": 2},
+            ]
+
+            await set_announcement_tags(session, announcements["a"], ["PTA"])
+            await delete_announcement_tags(session, ["b"])
+            await session.commit()
+
+            assert await load_tag_facets(session, "s1") == [
+                {"tag": "PTA", "count": 1},
+                {"tag": "行事", "count": 1},
+            ]
+            assert json.loads(announcements["a"].tags) == ["PTA"]
+            assert await load_tag_facets(session, "s1", prefix="行") == [
+                {"tag": "行事", "count": 1}
+            ]
+
+    @pytest.mark.asyncio
+    async def test_rebuild_matches_incremental_counts(self, engine):
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            await seed_tagged(session, {"a": ["数学", "行事"], "b": ["数学"], "c": ["行事"]})
+            incremental = await load_tag_facets(session, "s1")
+
+        async with engine.begin() as conn:
+            await rebuild_announcement_tags(conn)
+
+        async with AsyncSession(engine) as session:
+            assert await load_tag_facets(session, "s1") == incremental
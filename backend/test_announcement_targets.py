@@ -0,0 +1,176 @@
+"""
+Tests for grade/class announcement targeting
+Run with: python -m pytest test_announcement_targets.py -v
+"""
+
+import json
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel, select
+
+from src.announcement_targets import (
+    Audience,
+    audience_condition,
+    audience_for,
+    rebuild_announcement_targets,
+    set_announcement_targets,
+)
+from src.models import (
+    Announcement,
+    AnnouncementTargetGrade,
+    StreamMembership,
+    StreamRole,
+    User,
+    UserRole,
+)
+from src.search_service import SQLiteFTS5Backend
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+TARGETS = {
+    "all": (None, None),
+    "grade2": ([2], None),
+    "grade1": ([1], None),
+    "class2B": ([2], ["2年B組"]),
+    "class2A": (None, ["2年A組"]),
+}
+
+
+@pytest_asyncio.fixture
+async def engine():
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    yield engine
+    await engine.dispose()
+
+
+async def seed_targeted(session: AsyncSession):
+    for announcement_id, (grades, classes) in TARGETS.items():
+        announcement = Announcement(
+            id=announcement_id,
+            title="体育祭",
+            content="体育祭のお知らせ",
+            stream_id="s1",
+            created_by="teacher",
+        )
+        session.add(announcement)
+        await session.flush()
+        await set_announcement_targets(session, announcement, grades, classes)
+    await session.commit()
+
+
+async def visible_ids(session: AsyncSession, audience: Audience):
+    result = await session.execute(
+        select(Announcement.id).where(audience_condition(audience))
+    )
+    return sorted(result.scalars().all())
+
+
+class TestAudience:
+    """Test cases for deciding who is filtered"""
+
+    def test_teachers_see_everything(self):
+        teacher = User(email="t@example.com", name="先生", role=UserRole.TEACHER)
+        assert audience_for(teacher, []) is None
+
+    def test_stream_admins_see_everything_in_their_stream(self):
+        student = User(email="s@example.com", name="生徒", grade=2)
+        admin = StreamMembership(
+            user_id="u", stream_id="s1", role=StreamRole.STREAM_ADMIN
+        )
+        member = StreamMembership(user_id="u", stream_id="s2")
+
+        assert audience_for(student, [admin]) is None
+        assert audience_for(student, [admin, member]).unrestricted_stream_ids == ("s1",)
+
+
+class TestAudienceCondition:
+    """Test cases for SQL-side targeting"""
+
+    @pytest.mark.asyncio
+    async def test_grade_and_class_filters(self, engine):
+        async with AsyncSession(engine) as session:
+            await seed_targeted(session)
+
+            assert await visible_ids(session, Audience(2, "2年B組")) == [
+                "all",
+                "class2B",
+                "grade2",
+            ]
+            assert await visible_ids(session, Audience(1, "1年A組")) == [
+                "all",
+                "grade1",
+            ]
+            assert await visible_ids(session, Audience(None, None)) == ["all"]
+
+    @pytest.mark.asyncio
+    async def test_unrestricted_streams_bypass_targets(self, engine):
+        async with AsyncSession(engine) as session:
+            await seed_targeted(session)
+            assert len(await visible_ids(session, Audience(None, None, ("s1",)))) == 5
+
+    @pytest.mark.asyncio
+    async def test_search_is_filtered(self, engine):
+        backend = SQLiteFTS5Backend()
+        async with engine.begin() as conn:
+            await backend.ensure_schema(conn)
+
+        async with AsyncSession(engine) as session:
+            await seed_targeted(session)
+            for announcement in (await session.execute(select(Announcement))).scalars():
+                await backend.index_announcement(session, announcement)
+
+            hits = await backend.search(
+                session, "体育祭", ["s1"], audience=Audience(1, "1年A組")
+            )
+
+        assert sorted(hit.announcement_id for hit in hits) == ["all", "grade1"]
+
+
+class TestTargetRows:
+    """Test cases for writing and migrating target rows"""
+
+    @pytest.mark.asyncio
+    async def test_set_targets_replaces_rows(self, engine):
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            await seed_targeted(session)
+            announcement = await session.get(Announcement, "grade2")
+            await set_announcement_targets(session, announcement, [3, 1, 3], None)
+            await session.commit()
+
+            result = await session.execute(
+                select(AnnouncementTargetGrade.grade).where(
+                    AnnouncementTargetGrade.announcement_id == "grade2"
+                )
+            )
+            assert sorted(result.scalars().all()) == [1, 3]
+            assert json.loads(announcement.target_grades) == [1, 3]
+
+    @pytest.mark.asyncio
+    async def test_rebuild_from_json_columns(self, engine):
+        async with engine.begin() as conn:
+            await conn.execute(
+                Announcement.__table__.insert(),
+                [
+                    {
+                        "id": "legacy",
+                        "title": "t",
+                        "content": "c",
+                        "announcement_type": "GENERAL",
+                        "is_urgent": False,
+                        "is_pinned": False,
+                        "stream_id": "s1",
+                        "created_by": "teacher",
+                        "target_grades": "[2, 3]",
+                        "target_classes": "[]",
+                    }
+                ],
+            )
+            await rebuild_announcement_targets(conn)
+
+        async with AsyncSession(engine) as session:
+            assert await visible_ids(session, Audience(2, "2年A組")) == ["legacy"]
+            assert await visible_ids(session, Audience(1, "1年A組")) == []
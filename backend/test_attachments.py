@@ -0,0 +1,198 @@
+"""
+Tests for the content-addressed attachment store and download endpoint
+Run with: python -m pytest test_attachments.py -v
+"""
+
+import hashlib
+
+import httpx
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel, func, select
+
+from src.attachment_store import (
+    AttachmentStore,
+    AttachmentTooLarge,
+    LocalAttachmentStore,
+)
+from src.auth import get_current_user, get_stream_roles
+from src.database import get_async_session
+from src.main import app
+from src.membership_resolver import StreamRoles
+from src.models import Attachment, AttachmentBlob, StreamRole, User
+from src.routers import attachments
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+PDF = b"%PDF-1.4 " + bytes(range(256)) * 64
+
+
+async def iter_chunks(data: bytes, size: int = 1000):
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+def login_as(user_id, role, stream_roles):
+    app.dependency_overrides[get_current_user] = lambda: User(
+        id=user_id, email=f"{user_id}@example.com", name=user_id, role=role
+    )
+    app.dependency_overrides[get_stream_roles] = lambda: StreamRoles(
+        user_id, stream_roles
+    )
+
+
+@pytest_asyncio.fixture
+async def client(tmp_path, monkeypatch):
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    session_factory = sessionmaker(
+        bind=engine, class_=AsyncSession, expire_on_commit=False
+    )
+
+    async def override_session():
+        async with session_factory() as session:
+            yield session
+
+    monkeypatch.setattr(
+        attachments, "attachment_store", LocalAttachmentStore(str(tmp_path))
+    )
+    app.dependency_overrides[get_async_session] = override_session
+    login_as("teacher", "teacher", {"s1": StreamRole.ADMIN})
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        yield client, session_factory
+    app.dependency_overrides.clear()
+    await engine.dispose()
+
+
+class TestLocalAttachmentStore:
+    """Test cases for the local filesystem store"""
+
+    @pytest.mark.asyncio
+    async def test_same_content_is_stored_once(self, tmp_path):
+        store = LocalAttachmentStore(str(tmp_path))
+        first = await store.save(iter_chunks(PDF))
+        second = await store.save(iter_chunks(PDF, size=4096))
+
+        assert first == second
+        assert first.sha256 == hashlib.sha256(PDF).hexdigest()
+        assert first.size == len(PDF)
+        assert store.local_path(first.sha256).read_bytes() == PDF
+        assert list((tmp_path / "tmp").iterdir()) == []
+
+    @pytest.mark.asyncio
+    async def test_too_large_upload_leaves_no_file(self, tmp_path):
+        store = LocalAttachmentStore(str(tmp_path))
+        with pytest.raises(AttachmentTooLarge):
+            await store.save(iter_chunks(PDF), max_bytes=len(PDF) - 1)
+        assert list((tmp_path / "tmp").iterdir()) == []
+
+    def test_store_interface_is_abstract(self):
+        with pytest.raises(TypeError):
+            AttachmentStore()
+
+    def test_rejects_non_hash_paths(self, tmp_path):
+        with pytest.raises(ValueError):
+            LocalAttachmentStore(str(tmp_path)).path_for("../../etc/passwd")
+
+
+class TestAttachmentEndpoints:
+    """Test cases for upload and download"""
+
+    @pytest.mark.asyncio
+    async def test_upload_deduplicates_blobs(self, client):
+        client, session_factory = client
+        for _ in range(2):
+            response = await client.post(
+                "/api/attachments",
+                params={"filename": "時間割.pdf", "stream_id": "s1"},
+                content=iter_chunks(PDF),
+                headers={"Content-Type": "application/pdf"},
+            )
+            assert response.status_code == 201
+
+        body = response.json()
+        assert body["sha256"] == hashlib.sha256(PDF).hexdigest()
+        assert body["size"] == len(PDF)
+        async with session_factory() as session:
+            blobs = await session.execute(select(func.count(AttachmentBlob.sha256)))
+            uploads = await session.execute(select(func.count(Attachment.id)))
+            assert blobs.scalar_one() == 1
+            assert uploads.scalar_one() == 2
+
+    @pytest.mark.asyncio
+    async def test_download_range_and_etag(self, client):
+        client, _ = client
+        uploaded = await client.post(
+            "/api/attachments",
+            params={"filename": "資料.pdf", "stream_id": "s1"},
+            content=PDF,
+            headers={"Content-Type": "application/pdf"},
+        )
+        url = uploaded.json()["url"]
+        etag = f'"{uploaded.json()["sha256"]}"'
+
+        response = await client.get(url)
+        assert response.status_code == 200
+        assert response.content == PDF
+        assert response.headers["etag"] == etag
+        assert response.headers["accept-ranges"] == "bytes"
+
+        response = await client.get(url, headers={"Range": "bytes=9-18"})
+        assert response.status_code == 206
+        assert response.content == PDF[9:19]
+        assert response.headers["content-range"] == f"bytes 9-18/{len(PDF)}"
+
+        # If-Range が一致しなければ全体を返す
+        response = await client.get(
+            url, headers={"Range": "bytes=0-1", "If-Range": '"stale"'}
+        )
+        assert response.status_code == 200
+
+        response = await client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+    @pytest.mark.asyncio
+    async def test_declared_size_over_limit(self, client, monkeypatch):
+        client, _ = client
+        monkeypatch.setattr(attachments, "ATTACHMENT_MAX_BYTES", 10)
+        response = await client.post(
+            "/api/attachments",
+            params={"filename": "a.pdf", "stream_id": "s1"},
+            content=PDF,
+        )
+        assert response.status_code == 413
+
+    @pytest.mark.asyncio
+    async def test_only_teachers_upload_and_members_download(self, client):
+        client, _ = client
+        uploaded = await client.post(
+            "/api/attachments",
+            params={"filename": "資料.pdf", "stream_id": "s1"},
+            content=PDF,
+        )
+        url = uploaded.json()["url"]
+
+        login_as("member", "student", {"s1": StreamRole.STUDENT})
+        assert (await client.get(url)).status_code == 200
+        response = await client.post(
+            "/api/attachments",
+            params={"filename": "b.pdf", "stream_id": "s1"},
+            content=PDF,
+        )
+        assert response.status_code == 403
+
+        login_as("outsider", "student", {"s2": StreamRole.STUDENT})
+        assert (await client.get(url)).status_code == 403
+
+        # 教員でも参加していないストリームには投稿できない
+        login_as("other-teacher", "teacher", {})
+        response = await client.post(
+            "/api/attachments",
+            params={"filename": "c.pdf", "stream_id": "s1"},
+            content=PDF,
+        )
+        assert response.status_code == 403
@@ -0,0 +1,88 @@
+"""
+Tests for the stream feed response cache
+Run with: python -m pytest test_feed_cache.py -v
+"""
+
+import pytest
+
+from src.feed_cache import FeedCache, FeedCacheStore, LocalFeedCacheStore
+from src.metrics import metrics
+
+PARAMS = {"cursor": None, "skip": 0, "limit": 20}
+PAGE = {"items": [{"id": "a1", "user_reactions": []}], "next_cursor": None}
+
+
+class FailingStore(FeedCacheStore):
+    async def get_version(self, stream_id):
+        raise ConnectionError("redis down")
+
+    async def bump_version(self, stream_id):
+        raise ConnectionError("redis down")
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+class TestFeedCache:
+    """Test cases for versioned page caching"""
+
+    @pytest.mark.asyncio
+    async def test_miss_then_hit(self):
+        cache = FeedCache(LocalFeedCacheStore())
+
+        version, page = await cache.get_page("s1", PARAMS)
+        assert page is None
+        await cache.set_page("s1", version, PARAMS, PAGE)
+
+        _, page = await cache.get_page("s1", PARAMS)
+        assert page == PAGE
+        assert metrics.get("feed_cache.miss") == 1
+        assert metrics.get("feed_cache.hit") == 1
+
+    @pytest.mark.asyncio
+    async def test_pages_are_keyed_by_params(self):
+        cache = FeedCache(LocalFeedCacheStore())
+        version, _ = await cache.get_page("s1", PARAMS)
+        await cache.set_page("s1", version, PARAMS, PAGE)
+
+        _, page = await cache.get_page("s1", {**PARAMS, "cursor": "abc"})
+        assert page is None
+
+    @pytest.mark.asyncio
+    async def test_invalidate_bumps_version(self):
+        cache = FeedCache(LocalFeedCacheStore())
+        version, _ = await cache.get_page("s1", PARAMS)
+        await cache.set_page("s1", version, PARAMS, PAGE)
+
+        await cache.invalidate_stream("s1")
+
+        new_version, page = await cache.get_page("s1", PARAMS)
+        assert page is None
+        assert new_version == version + 1
+
+    @pytest.mark.asyncio
+    async def test_overlay_does_not_leak_into_cached_body(self):
+        cache = FeedCache(LocalFeedCacheStore())
+        version, _ = await cache.get_page("s1", PARAMS)
+        await cache.set_page("s1", version, PARAMS, PAGE)
+
+        _, page = await cache.get_page("s1", PARAMS)
+        page["items"][0]["user_reactions"].append("like")
+
+        _, page = await cache.get_page("s1", PARAMS)
+        assert page["items"][0]["user_reactions"] == []
+
+    @pytest.mark.asyncio
+    async def test_store_failure_falls_back_to_uncached(self):
+        cache = FeedCache(FailingStore())
+
+        version, page = await cache.get_page("s1", PARAMS)
+        await cache.set_page("s1", version, PARAMS, PAGE)
+        await cache.invalidate_stream("s1")
+
+        assert (version, page) == (None, None)
+        assert metrics.get("feed_cache.error") == 2
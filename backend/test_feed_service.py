@@ -0,0 +1,313 @@
+"""
+Tests for stream feed assembly
+Run with: python -m pytest test_feed_service.py -v
+"""
+
+from datetime import datetime
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel, select
+
+from src.feed_service import (
+    FEED_ORDER,
+    TIMELINE_ORDER,
+    apply_timeline_overlay,
+    build_announcement_feed,
+    build_shared_feed,
+    decode_feed_cursor,
+    encode_feed_cursor,
+    encode_timeline_cursor,
+    feed_keyset_condition,
+    timeline_keyset_condition,
+    timeline_statement,
+)
+from src.models import (
+    Announcement,
+    AnnouncementReaction,
+    Stream,
+    StreamMembership,
+    User,
+)
+from src.reaction_counters import apply_reaction_delta, rebuild_reaction_counts
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+@pytest_asyncio.fixture
+async def engine():
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    yield engine
+    await engine.dispose()
+
+
+async def seed_announcements(session: AsyncSession, count: int, readers: int):
+    teacher = User(email="teacher@example.com", name="先生", role="teacher")
+    students = [
+        User(email=f"student{i}@example.com", name=f"生徒{i}") for i in range(readers)
+    ]
+    session.add(teacher)
+    session.add_all(students)
+    await session.flush()
+
+    stream = Stream(name="全校", created_by=teacher.id)
+    session.add(stream)
+    await session.flush()
+
+    announcements = [
+        Announcement(
+            title=f"お知らせ{i}",
+            content="内容",
+            stream_id=stream.id,
+            created_by=teacher.id,
+        )
+        for i in range(count)
+    ]
+    session.add_all(announcements)
+    await session.flush()
+
+    for announcement in announcements:
+        for student in students:
+            session.add(
+                AnnouncementReaction(
+                    announcement_id=announcement.id,
+                    user_id=student.id,
+                    reaction_type="read",
+                )
+            )
+        session.add(
+            AnnouncementReaction(
+                announcement_id=announcement.id,
+                user_id=students[0].id,
+                reaction_type="like",
+            )
+        )
+    await session.flush()
+    await rebuild_reaction_counts(session)
+    await session.commit()
+    return students[0], announcements
+
+
+class TestBuildAnnouncementFeed:
+    """Test cases for batched feed assembly"""
+
+    @pytest.mark.asyncio
+    async def test_feed_contains_creator_and_reactions(self, engine):
+        """Test that creators, user reactions and counts are attached"""
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            viewer, announcements = await seed_announcements(session, 3, 4)
+            feed = await build_announcement_feed(session, announcements, viewer.id)
+
+        assert [item["id"] for item in feed] == [a.id for a in announcements]
+        for item in feed:
+            assert item["creator"]["name"] == "先生"
+            assert sorted(item["user_reactions"]) == ["like", "read"]
+            assert item["reaction_counts"] == {"read": 4, "like": 1}
+
+    @pytest.mark.asyncio
+    async def test_query_count_is_independent_of_page_size(self, engine):
+        """Test that assembling a page issues a fixed number of queries"""
+        statements = []
+        event.listen(
+            engine.sync_engine,
+            "before_cursor_execute",
+            lambda *args: statements.append(args[2]),
+        )
+
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            viewer, announcements = await seed_announcements(session, 25, 3)
+
+            statements.clear()
+            await build_announcement_feed(session, announcements[:5], viewer.id)
+            small_page_queries = len(statements)
+
+            statements.clear()
+            await build_announcement_feed(session, announcements, viewer.id)
+            large_page_queries = len(statements)
+
+        assert small_page_queries == large_page_queries == 3
+
+    @pytest.mark.asyncio
+    async def test_empty_page_issues_no_queries(self, engine):
+        """Test that an empty page short-circuits"""
+        async with AsyncSession(engine) as session:
+            assert await build_announcement_feed(session, [], "nobody") == []
+
+
+class TestReactionCounters:
+    """Test cases for denormalized reaction counters"""
+
+    @pytest.mark.asyncio
+    async def test_deltas_are_summed_across_shards(self, engine):
+        """Test that toggles from many users add up and cancel out"""
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            viewer, announcements = await seed_announcements(session, 1, 1)
+            announcement_id = announcements[0].id
+
+            for i in range(20):
+                await apply_reaction_delta(
+                    session, announcement_id, "important", f"user-{i}", 1
+                )
+            for i in range(5):
+                await apply_reaction_delta(
+                    session, announcement_id, "important", f"user-{i}", -1
+                )
+            await apply_reaction_delta(session, announcement_id, "like", viewer.id, -1)
+            await session.commit()
+
+            feed = await build_announcement_feed(session, announcements, viewer.id)
+
+        assert feed[0]["reaction_counts"] == {"read": 1, "important": 15}
+
+
+class TestFeedCursor:
+    """Test cases for keyset pagination cursors"""
+
+    def test_cursor_round_trip(self):
+        """Test that a cursor decodes to the announcement's sort key"""
+        announcement = Announcement(
+            id="a1",
+            title="t",
+            content="c",
+            stream_id="s1",
+            created_by="u1",
+            is_pinned=True,
+            created_at=datetime(2024, 4, 8, 8, 0, 0, 123456),
+        )
+        cursor = encode_feed_cursor(announcement)
+        assert decode_feed_cursor(cursor) == (True, announcement.created_at, "a1")
+
+    def test_invalid_cursor_is_rejected(self):
+        """Test that garbage cursors raise ValueError"""
+        for cursor in ["not-a-cursor", "e30", ""]:
+            with pytest.raises(ValueError):
+                decode_feed_cursor(cursor)
+
+    @pytest.mark.asyncio
+    async def test_keyset_pages_match_offset_pages(self, engine):
+        """Test that walking cursors yields the same order as OFFSET paging"""
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            _, announcements = await seed_announcements(session, 12, 1)
+            # 同時刻の投稿とピン留めを混ぜて並び順のタイブレークを確認
+            same_time = datetime(2024, 4, 8, 8, 0, 0)
+            for i, announcement in enumerate(announcements):
+                announcement.created_at = (
+                    same_time if i % 3 else datetime(2024, 4, i + 1)
+                )
+                announcement.is_pinned = i in (2, 7)
+                session.add(announcement)
+            await session.commit()
+
+            base = select(Announcement).order_by(*FEED_ORDER)
+            expected = [a.id for a in (await session.execute(base)).scalars().all()]
+
+            walked = []
+            cursor = None
+            while True:
+                statement = base.limit(5)
+                if cursor:
+                    statement = statement.where(feed_keyset_condition(cursor))
+                page = (await session.execute(statement)).scalars().all()
+                walked.extend(a.id for a in page)
+                if len(page) < 5:
+                    break
+                cursor = encode_feed_cursor(page[-1])
+
+        assert walked == expected
+
+
+class TestTimeline:
+    """Test cases for the merged cross-stream timeline"""
+
+    @pytest.mark.asyncio
+    async def test_cursor_walk_merges_streams_in_order(self, engine):
+        """Test that keyset pages over several streams match a global sort"""
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            same_time = datetime(2024, 4, 8, 8, 0, 0)
+            for i in range(15):
+                session.add(
+                    Announcement(
+                        id=f"a{i:02d}",
+                        title=f"お知らせ{i}",
+                        content="内容",
+                        stream_id=f"s{i % 3}",
+                        created_by="teacher",
+                        created_at=same_time
+                        if i % 4 == 0
+                        else datetime(2024, 4, i + 1),
+                        is_urgent=i % 2 == 0,
+                    )
+                )
+            session.add(
+                Announcement(
+                    id="other",
+                    title="他のストリーム",
+                    content="内容",
+                    stream_id="s9",
+                    created_by="teacher",
+                )
+            )
+            await session.commit()
+
+            stream_ids = ["s0", "s1", "s2"]
+            base = select(Announcement.id).where(Announcement.stream_id.in_(stream_ids))
+            expected = (await session.execute(base.order_by(*TIMELINE_ORDER))).scalars()
+            expected = list(expected)
+
+            walked = []
+            conditions = []
+            while True:
+                statement = timeline_statement(stream_ids, conditions, 4)
+                page = (await session.execute(statement)).scalars().all()
+                walked.extend(a.id for a in page)
+                if len(page) < 4:
+                    break
+                conditions = [
+                    timeline_keyset_condition(encode_timeline_cursor(page[-1]))
+                ]
+
+            assert walked == expected
+
+            urgent = timeline_statement(stream_ids, [Announcement.is_urgent], 20)
+            page = (await session.execute(urgent)).scalars().all()
+            assert [a.id for a in page] == [i for i in expected if int(i[1:]) % 2 == 0]
+
+    @pytest.mark.asyncio
+    async def test_overlay_uses_each_streams_membership(self, engine):
+        """Test that read state comes from the membership of the item's stream"""
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            announcements = [
+                Announcement(
+                    id=f"a{i}",
+                    title="t",
+                    content="c",
+                    stream_id=f"s{i}",
+                    created_by="teacher",
+                    created_at=datetime(2024, 4, 1 + i),
+                )
+                for i in range(2)
+            ]
+            session.add_all(announcements)
+            memberships = {
+                "s0": StreamMembership(
+                    id="m0",
+                    user_id="u1",
+                    stream_id="s0",
+                    last_read_at=datetime(2024, 5, 1),
+                    last_read_id="",
+                ),
+                "s1": StreamMembership(id="m1", user_id="u1", stream_id="s1"),
+            }
+            session.add_all(memberships.values())
+            await session.commit()
+
+            feed = await build_shared_feed(session, announcements)
+            for item, announcement in zip(feed, announcements):
+                item["stream_id"] = announcement.stream_id
+            feed = await apply_timeline_overlay(session, feed, "u1", memberships)
+
+            assert [item["user_reactions"] for item in feed] == [["read"], []]
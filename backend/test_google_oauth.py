@@ -0,0 +1,228 @@
+"""
+Tests for the pooled Google OAuth client against a local fake OAuth server
+Run with: python -m pytest test_google_oauth.py -v
+"""
+
+import asyncio
+import hashlib
+import time
+
+import httpx
+import pytest
+import pytest_asyncio
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import FastAPI, Form, Response
+from jose import jwk, jwt
+from jose.utils import calculate_at_hash
+
+from src import google_oauth
+from src.google_oauth import (
+    CircuitBreaker,
+    GoogleOAuthClient,
+    GoogleOAuthError,
+    GoogleOAuthUnavailableError,
+)
+
+CLIENT_ID = "campusflow-test-client"
+ISSUER = "https://accounts.google.com"
+
+
+def generate_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+    public = jwk.construct(pem, "RS256").public_key().to_dict()
+    return pem, {**public, "kid": kid, "use": "sig"}
+
+
+class FakeGoogle:
+    """トークンエンドポイントと JWKS だけを持つ OAuth サーバー"""
+
+    def __init__(self):
+        self.keys = [generate_key("key-1")]
+        self.users = {}
+        self.calls = {"token": 0, "jwks": 0}
+        self.fail_with = None
+        self.audience = CLIENT_ID
+        self.expires_in = 3600
+        self.app = FastAPI()
+        self.app.post("/token")(self.token)
+        self.app.get("/certs")(self.certs)
+
+    def add_user(self, code, email, name):
+        self.users[code] = {"email": email, "name": name}
+
+    def rotate_key(self, kid):
+        self.keys = [generate_key(kid)]
+
+    async def token(self, response: Response, code: str = Form(...)):
+        self.calls["token"] += 1
+        if self.fail_with:
+            response.status_code = self.fail_with
+            return {"error": "backend_error"}
+        user = self.users.get(code)
+        if user is None:
+            response.status_code = 400
+            return {"error": "invalid_grant"}
+        # 同時に交換された別のリクエストと入れ替わらないかを確かめるため少し待つ
+        await asyncio.sleep(0.01)
+        pem, public = self.keys[0]
+        access_token = f"access-{code}"
+        now = int(time.time())
+        claims = {
+            "iss": ISSUER,
+            "aud": self.audience,
+            "sub": code,
+            "email": user["email"],
+            "email_verified": True,
+            "name": user["name"],
+            "iat": now,
+            "exp": now + self.expires_in,
+            "at_hash": calculate_at_hash(access_token, hashlib.sha256),
+        }
+        id_token = jwt.encode(
+            claims, pem, algorithm="RS256", headers={"kid": public["kid"]}
+        )
+        return {
+            "access_token": access_token,
+            "id_token": id_token,
+            "token_type": "Bearer",
+        }
+
+    async def certs(self, response: Response):
+        self.calls["jwks"] += 1
+        response.headers["Cache-Control"] = "public, max-age=600"
+        return {"keys": [public for _, public in self.keys]}
+
+
+@pytest.fixture
+def fake_google(monkeypatch):
+    fake = FakeGoogle()
+    monkeypatch.setattr(google_oauth, "GOOGLE_TOKEN_URL", "http://google.test/token")
+    monkeypatch.setattr(google_oauth, "GOOGLE_JWKS_URL", "http://google.test/certs")
+    return fake
+
+
+@pytest_asyncio.fixture
+async def oauth(fake_google):
+    client = GoogleOAuthClient(
+        CLIENT_ID,
+        "secret",
+        "http://localhost/callback",
+        http_client=httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=fake_google.app)
+        ),
+        breaker=CircuitBreaker(failure_threshold=2, reset_seconds=60),
+    )
+    yield client
+    await client.aclose()
+
+
+async def login(oauth, code):
+    return await oauth.get_user_info(await oauth.exchange_code(code))
+
+
+@pytest.mark.asyncio
+async def test_login_verifies_id_token_with_cached_jwks(oauth, fake_google):
+    fake_google.add_user("code-a", "a@example.com", "生徒A")
+    fake_google.add_user("code-b", "b@example.com", "生徒B")
+
+    assert await login(oauth, "code-a") == {
+        "email": "a@example.com",
+        "name": "生徒A",
+        "picture": None,
+    }
+    await login(oauth, "code-b")
+    assert fake_google.calls == {"token": 2, "jwks": 1}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_logins_do_not_share_tokens(oauth, fake_google):
+    codes = [f"code-{i}" for i in range(10)]
+    for i, code in enumerate(codes):
+        fake_google.add_user(code, f"user{i}@example.com", f"生徒{i}")
+
+    results = await asyncio.gather(*(login(oauth, code) for code in codes))
+    assert [r["email"] for r in results] == [f"user{i}@example.com" for i in range(10)]
+    assert fake_google.calls["jwks"] == 1
+
+
+@pytest.mark.asyncio
+async def test_rejects_foreign_or_expired_id_tokens(oauth, fake_google):
+    fake_google.add_user("code-a", "a@example.com", "生徒A")
+    fake_google.audience = "another-client"
+    with pytest.raises(GoogleOAuthError, match="id_token"):
+        await login(oauth, "code-a")
+
+    fake_google.audience = CLIENT_ID
+    fake_google.expires_in = -60
+    with pytest.raises(GoogleOAuthError, match="id_token"):
+        await login(oauth, "code-a")
+
+    fake_google.expires_in = 3600
+    token = {**await oauth.exchange_code("code-a"), "access_token": "other"}
+    with pytest.raises(GoogleOAuthError, match="at_hash"):
+        await oauth.get_user_info(token)
+
+
+@pytest.mark.asyncio
+async def test_refetches_jwks_after_key_rotation(oauth, fake_google, monkeypatch):
+    monkeypatch.setattr(google_oauth, "GOOGLE_JWKS_MIN_REFRESH_SECONDS", 0)
+    fake_google.add_user("code-a", "a@example.com", "生徒A")
+    await login(oauth, "code-a")
+
+    fake_google.rotate_key("key-2")
+    assert (await login(oauth, "code-a"))["email"] == "a@example.com"
+    assert fake_google.calls["jwks"] == 2
+
+
+@pytest.mark.asyncio
+async def test_invalid_code_does_not_open_breaker(oauth, fake_google):
+    for _ in range(3):
+        with pytest.raises(GoogleOAuthError) as excinfo:
+            await oauth.exchange_code("unknown")
+        assert not isinstance(excinfo.value, GoogleOAuthUnavailableError)
+    assert not oauth.breaker.is_open
+
+
+@pytest.mark.asyncio
+async def test_breaker_opens_after_upstream_failures(oauth, fake_google):
+    fake_google.add_user("code-a", "a@example.com", "生徒A")
+    fake_google.fail_with = 503
+    for _ in range(2):
+        with pytest.raises(GoogleOAuthUnavailableError):
+            await oauth.exchange_code("code-a")
+    assert oauth.breaker.is_open
+
+    # 開いている間は Google を呼ばずに失敗する
+    fake_google.fail_with = None
+    with pytest.raises(GoogleOAuthUnavailableError):
+        await oauth.exchange_code("code-a")
+    assert fake_google.calls["token"] == 2
+
+    # リセット時間が過ぎたら1回試し、成功すれば閉じる
+    oauth.breaker.opened_at -= 60
+    await login(oauth, "code-a")
+    assert not oauth.breaker.is_open
+
+
+@pytest.mark.asyncio
+async def test_timeouts_count_as_failures(fake_google):
+    async def hang(request):
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    client = GoogleOAuthClient(
+        CLIENT_ID,
+        "secret",
+        "http://localhost/callback",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(hang)),
+        breaker=CircuitBreaker(failure_threshold=1, reset_seconds=60),
+    )
+    with pytest.raises(GoogleOAuthUnavailableError):
+        await client.exchange_code("code-a")
+    assert client.breaker.is_open
+    await client.aclose()
@@ -0,0 +1,92 @@
+"""
+Tests for pluggable JWT backends and the verified-payload cache
+Run with: python -m pytest test_jwt_backend.py -v
+"""
+
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+
+from src import auth, jwt_backend
+from src.auth import JWT_ALGORITHM, JWT_SECRET_KEY, auth_manager
+from src.jwt_backend import (
+    InvalidTokenError,
+    JoseBackend,
+    PyJWTBackend,
+    VerifiedTokenCache,
+)
+from src.server_timing import ServerTimingMiddleware, record
+
+BACKENDS = [JoseBackend(), PyJWTBackend()]
+
+
+def make_payload(minutes: int = 30) -> dict:
+    return {"sub": "user-1", "exp": datetime.utcnow() + timedelta(minutes=minutes)}
+
+
+@pytest.mark.parametrize("encoder", BACKENDS, ids=lambda b: b.name)
+@pytest.mark.parametrize("decoder", BACKENDS, ids=lambda b: b.name)
+def test_backends_are_interchangeable(encoder, decoder):
+    token = encoder.encode(make_payload(), JWT_SECRET_KEY, JWT_ALGORITHM)
+    assert decoder.decode(token, JWT_SECRET_KEY, JWT_ALGORITHM)["sub"] == "user-1"
+
+    with pytest.raises(InvalidTokenError):
+        decoder.decode(token, "wrong-key-" + "x" * 32, JWT_ALGORITHM)
+    expired = encoder.encode(make_payload(-1), JWT_SECRET_KEY, JWT_ALGORITHM)
+    with pytest.raises(InvalidTokenError):
+        decoder.decode(expired, JWT_SECRET_KEY, JWT_ALGORITHM)
+
+
+def test_cache_honors_exp_and_bound(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(jwt_backend.time, "time", lambda: now[0])
+    cache = VerifiedTokenCache(max_entries=2)
+    cache.set("a", {"sub": "a", "exp": 1010})
+    cache.set("no-exp", {"sub": "x"})
+    assert cache.get("a") == {"sub": "a", "exp": 1010}
+    assert cache.get("no-exp") is None
+
+    cache.set("b", {"sub": "b", "exp": 2000})
+    cache.set("c", {"sub": "c", "exp": 2000})
+    assert cache.get("a") is None  # 上限を超えたので追い出された
+    now[0] = 2000.0
+    assert cache.get("b") is None  # exp を過ぎた
+
+
+def test_verify_token_decodes_once(monkeypatch):
+    monkeypatch.setattr(auth, "verified_token_cache", VerifiedTokenCache())
+    calls = []
+    backend = auth.jwt_backend
+    monkeypatch.setattr(
+        backend, "decode", lambda *args: calls.append(args) or {"sub": "u", "exp": 1e10}
+    )
+
+    token = auth_manager.create_access_token(data={"sub": "u"})
+    payload = auth_manager.verify_token(token)
+    payload["sub"] = "changed"
+    assert auth_manager.verify_token(token)["sub"] == "u"
+    assert len(calls) == 1
+
+    monkeypatch.undo()
+    with pytest.raises(HTTPException):
+        auth_manager.verify_token(token + "x")
+
+
+@pytest.mark.asyncio
+async def test_server_timing_header():
+    app = FastAPI()
+    app.add_middleware(ServerTimingMiddleware)
+
+    @app.get("/")
+    async def index():
+        record("auth", 0.0015)
+        record("auth", 0.0005)
+        return {}
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        response = await client.get("/")
+    assert response.headers["server-timing"] == "auth;dur=2.00"
@@ -0,0 +1,247 @@
+"""
+Tests for request-scoped and cached stream-role resolution
+Run with: python -m pytest test_membership_resolver.py -v
+"""
+
+import httpx
+import pytest
+import pytest_asyncio
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+
+from src import auth, membership_resolver
+from src.auth import auth_manager, get_current_user
+from src.database import get_async_session
+from src.main import app
+from src.membership_resolver import (
+    decode_role_claim,
+    encode_role_claim,
+    invalidate_stream_roles,
+    resolve_stream_roles,
+    roles_from_claims,
+    stream_role_claims,
+)
+from src.models import Announcement, Stream, StreamMembership, StreamRole, User
+from src.search_service import search_backend
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def set(self, key, value, nx=False):
+        self.commands.append((self.redis.set_now, key, value, nx))
+
+    def incr(self, key):
+        self.commands.append((self.redis.incr_now, key))
+
+    async def execute(self):
+        for command, *args in self.commands:
+            command(*args)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None, nx=False):
+        self.set_now(key, value, nx)
+
+    def set_now(self, key, value, nx=False):
+        if not (nx and key in self.data):
+            self.data[key] = str(value)
+
+    def incr_now(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+
+    def clear_cached_roles(self):
+        for key in list(self.data):
+            if not key.startswith("stream-roles:version:"):
+                del self.data[key]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(membership_resolver, "get_redis", lambda: redis)
+    return redis
+
+
+@pytest_asyncio.fixture
+async def engine(redis):
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await search_backend.ensure_schema(conn)
+    yield engine
+    await engine.dispose()
+
+
+def membership_queries(engine):
+    statements = []
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def record(conn, cursor, statement, *args):
+        if "stream_memberships" in statement:
+            statements.append(statement)
+
+    return statements
+
+
+async def seed(engine):
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        teacher = User(email="t@example.com", name="先生", role="teacher")
+        session.add(teacher)
+        await session.flush()
+        streams = [Stream(name=f"ストリーム{i}", created_by=teacher.id) for i in range(2)]
+        session.add_all(streams)
+        await session.flush()
+        session.add(
+            StreamMembership(
+                user_id=teacher.id, stream_id=streams[0].id, role=StreamRole.ADMIN
+            )
+        )
+        announcement = Announcement(
+            title="お知らせ",
+            content="内容",
+            stream_id=streams[0].id,
+            created_by=teacher.id,
+        )
+        session.add(announcement)
+        await session.commit()
+        return teacher, streams, announcement
+
+
+@pytest.mark.asyncio
+async def test_roles_are_cached_until_invalidated(engine):
+    teacher, streams, _ = await seed(engine)
+    queries = membership_queries(engine)
+
+    async with AsyncSession(engine) as session:
+        first = await resolve_stream_roles(session, teacher.id)
+        second = await resolve_stream_roles(session, teacher.id)
+    assert first.roles == second.roles == {streams[0].id: StreamRole.ADMIN}
+    assert len(queries) == 1
+
+    async with AsyncSession(engine) as session:
+        session.add(StreamMembership(user_id=teacher.id, stream_id=streams[1].id))
+        await session.commit()
+    await invalidate_stream_roles([teacher.id])
+
+    async with AsyncSession(engine) as session:
+        roles = await resolve_stream_roles(session, teacher.id)
+    assert roles.role_in(streams[1].id) == StreamRole.STUDENT
+    assert not roles.is_admin_of(streams[1].id)
+    assert len(queries) == 3  # INSERT と再読み込み
+
+
+@pytest.mark.asyncio
+async def test_warm_cache_authorizes_without_membership_queries(engine):
+    teacher, streams, announcement = await seed(engine)
+    session_factory = sessionmaker(
+        bind=engine, class_=AsyncSession, expire_on_commit=False
+    )
+
+    async def override_session():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_async_session] = override_session
+    app.dependency_overrides[get_current_user] = lambda: teacher
+    try:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as client:
+            url = f"/api/streams/{streams[0].id}/members"
+            assert (await client.get(url)).status_code == 200
+            queries = membership_queries(engine)
+
+            response = await client.get(url, params={"count_only": True})
+            assert response.json() == {"count": 1}
+            response = await client.delete(
+                f"/api/streams/{streams[0].id}/announcements/{announcement.id}"
+            )
+            assert response.status_code == 200
+            response = await client.get(f"/api/streams/{streams[1].id}/tags")
+            assert response.status_code == 403
+    finally:
+        app.dependency_overrides.clear()
+
+    # 件数の集計以外にメンバーシップを参照しない
+    assert len(queries) == 1
+
+
+def test_role_claim_round_trip():
+    roles = {
+        "6f9619ff-8b86-d011-b42d-00c04fc964ff": StreamRole.ADMIN,
+        "0e984725-c51c-4bf4-9960-e1c80e27aba0": StreamRole.STUDENT,
+    }
+    claim = encode_role_claim(roles)
+    assert len(claim) == 46  # 17 バイト × 2 の base64url
+    assert decode_role_claim(claim) == roles
+    assert encode_role_claim({"test_stream_1": StreamRole.STUDENT}) is None
+
+
+@pytest.mark.asyncio
+async def test_current_claims_skip_membership_lookup(engine, redis, monkeypatch):
+    monkeypatch.setattr(membership_resolver, "STREAM_ROLE_CLAIMS", True)
+    monkeypatch.setattr(auth, "STREAM_ROLE_CLAIMS", True)
+    teacher, streams, _ = await seed(engine)
+    async with AsyncSession(engine) as session:
+        claims = await stream_role_claims(session, teacher.id)
+    assert claims["mv"] == int(redis.data[f"stream-roles:version:{teacher.id}"])
+    token = auth_manager.create_access_token(data={"sub": teacher.id, **claims})
+
+    async def override_session():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    app.dependency_overrides[get_async_session] = override_session
+    app.dependency_overrides[get_current_user] = lambda: teacher
+    try:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            base_url="http://test",
+            headers={"Authorization": f"Bearer {token}"},
+        ) as client:
+            queries = membership_queries(engine)
+            url = f"/api/streams/{streams[0].id}/tags"
+            assert (await client.get(url)).status_code == 200
+            assert queries == []
+
+            # 招待などでバージョンが上がると、クレームは使われない
+            await invalidate_stream_roles([teacher.id])
+            redis.clear_cached_roles()
+            assert (await client.get(url)).status_code == 200
+            assert len(queries) == 1
+    finally:
+        app.dependency_overrides.clear()
+
+
+@pytest.mark.asyncio
+async def test_claims_are_stale_after_version_key_is_lost(engine, redis, monkeypatch):
+    monkeypatch.setattr(membership_resolver, "STREAM_ROLE_CLAIMS", True)
+    teacher, _, _ = await seed(engine)
+    for lost_key in ("flush", "invalidate"):
+        async with AsyncSession(engine) as session:
+            claims = await stream_role_claims(session, teacher.id)
+        assert await roles_from_claims(teacher.id, claims) is not None
+
+        # フラッシュや退避でキーが消えても、0 や 1 から数え直さない
+        redis.data.clear()
+        if lost_key == "invalidate":
+            await invalidate_stream_roles([teacher.id])
+        assert await roles_from_claims(teacher.id, claims) is None
+        assert await roles_from_claims(teacher.id, {**claims, "mv": 0}) is None
+        assert await roles_from_claims(teacher.id, {**claims, "mv": 1}) is None
@@ -0,0 +1,220 @@
+"""
+Tests for the token-bucket rate limiter dependency
+Run with: python -m pytest test_rate_limit.py -v
+"""
+
+import os
+from uuid import uuid4
+
+import httpx
+import pytest
+import pytest_asyncio
+import redis.asyncio as redis_asyncio
+from fastapi import Depends, FastAPI
+
+from src import rate_limit as rate_limit_module
+from src.auth import get_current_user
+from src.models import User
+from src.rate_limit import (
+    LocalLeases,
+    RateLimiter,
+    RateLimitPolicy,
+    bucket_key,
+    rate_limit,
+)
+
+
+class FakeRedis:
+    """TOKEN_BUCKET_SCRIPT と同じ計算をする Redis（時刻は now で進める）"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.calls = 0
+        self.now = 1000.0
+
+    def register_script(self, script):
+        return self.token_bucket
+
+    async def token_bucket(self, keys, args):
+        self.calls += 1
+        capacity, rate, lease = float(args[0]), float(args[1]), int(args[2])
+        tokens, ts = self.buckets.get(keys[0], (capacity, self.now))
+        tokens = min(capacity, tokens + max(0, self.now - ts) * rate)
+        granted, retry_after = 0, 0
+        if lease > 1 and tokens - lease >= capacity / 2:
+            granted = lease
+        elif tokens >= 1:
+            granted = 1
+        else:
+            retry_after = (1 - tokens) / rate
+        self.buckets[keys[0]] = (tokens - granted, self.now)
+        return [granted, str(retry_after).encode()]
+
+
+class UnavailableRedis:
+    def register_script(self, script):
+        async def token_bucket(keys, args):
+            raise ConnectionError("redis is down")
+
+        return token_bucket
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(rate_limit_module, "get_redis", lambda: redis)
+    monkeypatch.setattr(rate_limit_module, "rate_limiter", RateLimiter(LocalLeases()))
+    monkeypatch.setitem(
+        rate_limit_module.RATE_LIMIT_POLICIES,
+        "test",
+        RateLimitPolicy("test", capacity=3, period_seconds=30),
+    )
+    return redis
+
+
+def make_client(user_id="student"):
+    app = FastAPI()
+
+    @app.get("/limited", dependencies=[Depends(rate_limit("test"))])
+    async def limited():
+        return {"ok": True}
+
+    @app.post(
+        "/sessions/{session_id}/ideas",
+        dependencies=[Depends(rate_limit("test", per=("session_id",)))],
+    )
+    async def submit_idea(session_id: str):
+        return {"ok": True}
+
+    app.dependency_overrides[get_current_user] = lambda: User(
+        id=user_id, email=f"{user_id}@example.com", name="生徒"
+    )
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    )
+
+
+@pytest.mark.asyncio
+async def test_rejects_with_retry_after_and_refills(redis):
+    async with make_client() as client:
+        for _ in range(3):
+            assert (await client.get("/limited")).status_code == 200
+        response = await client.get("/limited")
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "10"
+
+        redis.now += 10
+        assert (await client.get("/limited")).status_code == 200
+        assert (await client.get("/limited")).status_code == 429
+
+
+@pytest.mark.asyncio
+async def test_buckets_are_per_user(redis):
+    async with make_client("a") as client:
+        for _ in range(3):
+            await client.get("/limited")
+        assert (await client.get("/limited")).status_code == 429
+    async with make_client("b") as client:
+        assert (await client.get("/limited")).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_buckets_can_be_split_by_path_parameters(redis):
+    async with make_client() as client:
+        for _ in range(3):
+            await client.post("/sessions/s1/ideas")
+        assert (await client.post("/sessions/s1/ideas")).status_code == 429
+        assert (await client.post("/sessions/s2/ideas")).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_leases_serve_clients_far_below_the_limit(redis):
+    limiter = RateLimiter(LocalLeases())
+    policy = RateLimitPolicy("feed", capacity=100, period_seconds=60, lease=10)
+
+    for _ in range(10):
+        assert (await limiter.acquire(policy, "student"))[0]
+    assert redis.calls == 1
+
+    # リースした分はバケットから差し引かれているので、上限は超えない
+    results = [(await limiter.acquire(policy, "student"))[0] for _ in range(100)]
+    assert results.count(True) == 90
+    # 容量の半分まではリース（残り 4 回）、その後は1つずつ 50 回、拒否された 10 回
+    assert redis.calls == 1 + 4 + 50 + 10
+
+
+@pytest.mark.asyncio
+async def test_takes_single_tokens_near_the_limit(redis):
+    limiter = RateLimiter(LocalLeases())
+    policy = RateLimitPolicy("feed", capacity=10, period_seconds=60, lease=4)
+
+    results = [(await limiter.acquire(policy, "student"))[0] for _ in range(11)]
+    assert results == [True] * 10 + [False]
+    # 4 をリースすると残りは 6、次のリースでは半分を下回るので1つずつ確保する
+    assert redis.calls == 1 + 6 + 1
+
+
+@pytest.mark.asyncio
+async def test_leases_left_on_other_workers_keep_half_the_capacity(redis):
+    policy = RateLimitPolicy("feed", capacity=100, period_seconds=60, lease=10)
+    workers = [RateLimiter(LocalLeases()) for _ in range(10)]
+
+    # 1回ずつ別のワーカーに振り分けられ、各ワーカーにリースが残る
+    for worker in workers:
+        assert (await worker.acquire(policy, "student"))[0]
+    # そのあと1つのワーカーに集中しても、容量の半分以上は使える
+    results = [(await workers[0].acquire(policy, "student"))[0] for _ in range(100)]
+    # 5 つのワーカーが 10 ずつリースし、残り 5 つは1つずつ確保した（バケットは 45）。
+    # ワーカー 0 のリースの残り 9 と合わせて 54 回許可される
+    assert results.count(True) == 9 + 45
+
+
+@pytest.mark.asyncio
+async def test_allows_requests_when_redis_is_unavailable(monkeypatch):
+    monkeypatch.setattr(rate_limit_module, "get_redis", UnavailableRedis)
+    limiter = RateLimiter(LocalLeases())
+    policy = RateLimitPolicy("search", capacity=1, period_seconds=60)
+    for _ in range(3):
+        assert await limiter.acquire(policy, "student") == (True, 0.0)
+
+
+@pytest_asyncio.fixture
+async def real_redis(monkeypatch):
+    """TOKEN_BUCKET_SCRIPT を実際の Redis で実行する（接続できなければスキップ）"""
+    client = redis_asyncio.from_url(
+        os.getenv("REDIS_URL", "redis://localhost:6379/0"), socket_connect_timeout=1
+    )
+    try:
+        await client.ping()
+    except Exception:
+        await client.aclose()
+        pytest.skip("Redis に接続できません")
+    monkeypatch.setattr(rate_limit_module, "get_redis", lambda: client)
+    identity = f"test-{uuid4()}"
+    yield client, identity
+    await client.delete(bucket_key("search", identity), bucket_key("feed", identity))
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_script_on_redis(real_redis):
+    client, identity = real_redis
+    limiter = RateLimiter(None)
+    policy = RateLimitPolicy("search", capacity=3, period_seconds=30)
+
+    results = [await limiter.acquire(policy, identity) for _ in range(4)]
+    assert [allowed for allowed, _ in results] == [True, True, True, False]
+    assert 9 < results[-1][1] <= 10
+    assert await client.ttl(bucket_key("search", identity)) > 0
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_script_leases_on_redis(real_redis):
+    client, identity = real_redis
+    limiter = RateLimiter(LocalLeases())
+    policy = RateLimitPolicy("feed", capacity=100, period_seconds=60, lease=10)
+
+    for _ in range(10):
+        assert (await limiter.acquire(policy, identity))[0]
+    tokens = await client.hget(bucket_key("feed", identity), "tokens")
+    assert 90 <= float(tokens) < 91
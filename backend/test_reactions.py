@@ -0,0 +1,111 @@
+"""
+Tests for atomic reaction toggles and batch reactions
+Run with: python -m pytest test_reactions.py -v
+"""
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel, select
+
+from src.models import AnnouncementReaction, AnnouncementReactionCount
+from src.reaction_counters import load_reaction_counts
+from src.reactions import (
+    add_reactions,
+    remove_duplicate_reactions,
+    remove_reactions,
+    toggle_reaction,
+)
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+@pytest_asyncio.fixture
+async def engine():
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    yield engine
+    await engine.dispose()
+
+
+async def like_counts(session: AsyncSession, announcement_ids):
+    counts = await load_reaction_counts(session, announcement_ids)
+    return [counts.get(i, {}).get("like", 0) for i in announcement_ids]
+
+
+async def reaction_rows(session: AsyncSession) -> int:
+    result = await session.execute(select(func.count(AnnouncementReaction.id)))
+    return result.scalar_one()
+
+
+class TestToggleReaction:
+    """Test cases for single reaction toggles"""
+
+    @pytest.mark.asyncio
+    async def test_toggle_adds_then_removes(self, engine):
+        async with AsyncSession(engine) as session:
+            assert await toggle_reaction(session, "a1", "u1", "like") == 1
+            assert await like_counts(session, ["a1"]) == [1]
+            assert await toggle_reaction(session, "a1", "u1", "like") == -1
+            assert await like_counts(session, ["a1"]) == [0]
+            assert await reaction_rows(session) == 0
+
+    @pytest.mark.asyncio
+    async def test_repeated_add_is_idempotent(self, engine):
+        async with AsyncSession(engine) as session:
+            assert await add_reactions(session, ["a1"], "u1", "like") == ["a1"]
+            assert await add_reactions(session, ["a1"], "u1", "like") == []
+            assert await reaction_rows(session) == 1
+            assert await like_counts(session, ["a1"]) == [1]
+
+
+class TestBatchReactions:
+    """Test cases for adding and removing many reactions at once"""
+
+    @pytest.mark.asyncio
+    async def test_only_changed_rows_are_counted(self, engine):
+        async with AsyncSession(engine) as session:
+            await add_reactions(session, ["a1"], "u1", "like")
+
+            added = await add_reactions(session, ["a1", "a2", "a3"], "u1", "like")
+            assert sorted(added) == ["a2", "a3"]
+            assert await like_counts(session, ["a1", "a2", "a3"]) == [1, 1, 1]
+
+            removed = await remove_reactions(session, ["a2", "a4"], "u1", "like")
+            assert removed == ["a2"]
+            assert await like_counts(session, ["a1", "a2", "a3"]) == [1, 0, 1]
+
+
+class TestRemoveDuplicateReactions:
+    """Test cases for cleaning up rows created before the unique index"""
+
+    @pytest.mark.asyncio
+    async def test_duplicates_are_removed_from_rows_and_counts(self):
+        engine = create_async_engine(TEST_DATABASE_URL)
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+            await conn.exec_driver_sql(
+                "DROP INDEX ux_announcement_reactions_announcement_user_type"
+            )
+            for _ in range(3):
+                await conn.execute(
+                    AnnouncementReaction.__table__.insert().values(
+                        AnnouncementReaction(
+                            announcement_id="a1", user_id="u1", reaction_type="like"
+                        ).model_dump()
+                    )
+                )
+            await conn.execute(
+                AnnouncementReactionCount.__table__.insert().values(
+                    announcement_id="a1", reaction_type="like", shard=3, count=3
+                )
+            )
+
+            await remove_duplicate_reactions(conn)
+
+        async with AsyncSession(engine) as session:
+            assert await reaction_rows(session) == 1
+            assert await like_counts(session, ["a1"]) == [1]
+        await engine.dispose()
@@ -0,0 +1,300 @@
+"""
+Tests for read-receipt bitmaps of urgent announcements
+Run with: python -m pytest test_read_receipts.py -v
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel
+
+from src import read_receipts
+from src.announcement_targets import set_announcement_targets
+from src.models import Announcement, Stream, StreamMembership, StreamRole, User
+from src.read_receipts import (
+    bitmap_to_int,
+    ensure_member_ordinals,
+    int_to_bitmap,
+    load_read_bitmap,
+    load_reader_mask,
+    load_recipient_mask,
+    ordinals_in,
+    record_read_receipts,
+    summarize_read_receipts,
+    urgent_ids_newly_read,
+)
+from src.read_state import mark_read_up_to, set_read
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+class UnavailableRedis:
+    async def get(self, key):
+        raise ConnectionError("redis unavailable")
+
+
+class FakeRedis:
+    """既読レシートのスクリプトと同じ操作をする Redis（ビット列は整数で持つ）"""
+
+    def __init__(self):
+        self.bitmaps = {}
+        self.hashes = {}
+
+    async def get(self, key):
+        value = self.bitmaps.get(key)
+        return None if value is None else int_to_bitmap(value)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def eval(self, script, numkeys, *args):
+        keys, argv = args[:numkeys], args[numkeys:]
+        if script == read_receipts._SET_BITS_IF_EXISTS:
+            ordinal, bit = int(argv[0]), int(argv[1])
+            for key, journal in zip(keys[::2], keys[1::2]):
+                if key in self.bitmaps:
+                    self.set_bit(key, ordinal, bit)
+                if journal in self.hashes:
+                    self.hashes[journal][str(ordinal)] = str(bit)
+            return None
+        key, journal = keys
+        if key not in self.bitmaps:
+            self.bitmaps[key] = bitmap_to_int(argv[0])
+            for field, bit in self.hashes.get(journal, {}).items():
+                if field:
+                    self.set_bit(key, int(field), int(bit))
+        self.hashes.pop(journal, None)
+        return int_to_bitmap(self.bitmaps[key])
+
+    def set_bit(self, key, ordinal, bit):
+        if bit:
+            self.bitmaps[key] |= 1 << ordinal
+        else:
+            self.bitmaps[key] &= ~(1 << ordinal)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def hsetnx(self, key, field, value):
+        self.redis.hashes.setdefault(key, {}).setdefault(field, value)
+
+    def expire(self, key, seconds):
+        pass
+
+    async def execute(self):
+        return []
+
+
+@pytest_asyncio.fixture
+async def session(monkeypatch):
+    monkeypatch.setattr(read_receipts, "get_redis", lambda: UnavailableRedis())
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
+    await engine.dispose()
+
+
+async def seed(session: AsyncSession):
+    teacher = User(email="teacher@example.com", name="先生", role="teacher")
+    students = [
+        User(
+            email=f"s{i}@example.com",
+            name=f"生徒{i}",
+            grade=1,
+            class_name="1年A組" if i < 2 else "1年B組",
+        )
+        for i in range(4)
+    ]
+    session.add_all([teacher, *students])
+    await session.flush()
+
+    stream = Stream(name="1年", created_by=teacher.id)
+    session.add(stream)
+    await session.flush()
+
+    start = datetime(2024, 4, 8, 8, 0, 0)
+    session.add(
+        StreamMembership(
+            user_id=teacher.id,
+            stream_id=stream.id,
+            role=StreamRole.STREAM_ADMIN,
+            joined_at=start,
+        )
+    )
+    memberships = [
+        StreamMembership(
+            user_id=student.id,
+            stream_id=stream.id,
+            joined_at=start + timedelta(minutes=i + 1),
+        )
+        for i, student in enumerate(students)
+    ]
+    session.add_all(memberships)
+
+    announcements = [
+        Announcement(
+            title=f"緊急{i}",
+            content="内容",
+            stream_id=stream.id,
+            created_by=teacher.id,
+            is_urgent=True,
+            created_at=start + timedelta(hours=i + 1),
+        )
+        for i in range(2)
+    ]
+    session.add_all(announcements)
+    await session.commit()
+    return memberships, announcements
+
+
+def test_bitmap_uses_redis_bit_order():
+    # SETBIT key 0 1 / SETBIT key 9 1 の結果と同じバイト列
+    assert int_to_bitmap((1 << 0) | (1 << 9)) == b"\x80\x40"
+    assert bitmap_to_int(b"\x80\x40") == (1 << 0) | (1 << 9)
+    assert int_to_bitmap(0) == b"\x00"
+    value = 0b1011 << 100
+    assert bitmap_to_int(int_to_bitmap(value)) == value
+    assert ordinals_in(value) == [100, 101, 103]
+
+
+@pytest.mark.asyncio
+async def test_ordinals_follow_join_order(session):
+    memberships, _ = await seed(session)
+    await ensure_member_ordinals(session, memberships[0].stream_id)
+    for membership in memberships:
+        await session.refresh(membership)
+    # 0 番は最初に参加した教員
+    assert [m.ordinal for m in memberships] == [1, 2, 3, 4]
+
+    other = Stream(name="2年", created_by=memberships[0].user_id)
+    session.add(other)
+    await session.flush()
+    late = StreamMembership(user_id=memberships[0].user_id, stream_id=other.id)
+    session.add(late)
+    await session.commit()
+    await ensure_member_ordinals(session, other.id)
+    await session.refresh(late)
+    # ストリームごとに 0 から振る
+    assert late.ordinal == 0
+
+
+@pytest.mark.asyncio
+async def test_ordinals_of_members_who_left_are_not_reused(session):
+    memberships, _ = await seed(session)
+    stream_id = memberships[0].stream_id
+    await ensure_member_ordinals(session, stream_id)
+    await session.refresh(memberships[-1])
+    assert memberships[-1].ordinal == 4
+
+    # 最大の番号のメンバーが抜けたあとに参加したメンバーは、その番号を引き継がない
+    await session.delete(memberships[-1])
+    await session.commit()
+    newcomer = StreamMembership(user_id=memberships[-1].user_id, stream_id=stream_id)
+    session.add(newcomer)
+    await session.commit()
+    await ensure_member_ordinals(session, stream_id)
+    await session.refresh(newcomer)
+    assert newcomer.ordinal == 5
+
+
+@pytest.mark.asyncio
+async def test_reader_mask_matches_read_state(session):
+    memberships, announcements = await seed(session)
+    await ensure_member_ordinals(session, memberships[0].stream_id)
+    for membership in memberships:
+        await session.refresh(membership)
+    first, second = announcements
+
+    # 生徒0: 一括既読で2件とも既読 / 生徒1: 2件目だけ既読
+    # 生徒2: 一括既読のあと1件目を未読に戻す
+    await mark_read_up_to(session, memberships[0], second)
+    await set_read(session, memberships[1], second, True)
+    await mark_read_up_to(session, memberships[2], second)
+    await set_read(session, memberships[2], first, False)
+    await session.commit()
+
+    assert ordinals_in(await load_reader_mask(session, first)) == [1]
+    assert ordinals_in(await load_reader_mask(session, second)) == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_summary_respects_audience(session):
+    memberships, announcements = await seed(session)
+    first = announcements[0]
+    await set_announcement_targets(session, first, classes=["1年A組"])
+    await set_read(session, memberships[0], first, True)
+    await session.commit()
+
+    summary = await summarize_read_receipts(session, first)
+
+    assert summary["recipient_count"] == 2
+    assert summary["read_count"] == 1
+    assert summary["unread_count"] == 1
+    assert summary["read_percentage"] == 50.0
+    assert [m["name"] for m in summary["unread_members"]] == ["生徒1"]
+
+
+@pytest.mark.asyncio
+async def test_reads_during_rebuild_are_not_lost(session, monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(read_receipts, "get_redis", lambda: redis)
+    memberships, announcements = await seed(session)
+    await ensure_member_ordinals(session, memberships[0].stream_id)
+    for membership in memberships:
+        await session.refresh(membership)
+    first = announcements[0]
+    await set_read(session, memberships[0], first, True)
+    await session.commit()
+
+    load_from_database = read_receipts.load_reader_mask
+
+    async def read_lands_after_database_load(session, announcement):
+        readers = await load_from_database(session, announcement)
+        # データベースを読んだ直後に、別のリクエストが既読にした
+        await record_read_receipts(session, memberships[1], [first.id], True)
+        return readers
+
+    monkeypatch.setattr(
+        read_receipts, "load_reader_mask", read_lands_after_database_load
+    )
+    assert ordinals_in(await load_read_bitmap(session, first)) == [1, 2]
+    assert redis.hashes == {}
+
+    # 保存後はビット列を直接更新する
+    await record_read_receipts(session, memberships[0], [first.id], False)
+    assert ordinals_in(await load_read_bitmap(session, first)) == [2]
+
+
+@pytest.mark.asyncio
+async def test_bulk_read_looks_only_past_the_old_watermark(session):
+    memberships, announcements = await seed(session)
+    first, second = announcements
+    membership = memberships[0]
+
+    assert set(await urgent_ids_newly_read(session, membership, second)) == {
+        first.id,
+        second.id,
+    }
+    await mark_read_up_to(session, membership, first)
+    await session.commit()
+    assert await urgent_ids_newly_read(session, membership, second) == [second.id]
+
+    # 既読位置以前で未読に戻したものは、もう一度既読になる
+    await set_read(session, membership, first, False)
+    await session.commit()
+    assert set(await urgent_ids_newly_read(session, membership, second)) == {
+        first.id,
+        second.id,
+    }
@@ -0,0 +1,269 @@
+"""
+Tests for read watermarks and read-mark exceptions
+Run with: python -m pytest test_read_state.py -v
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel, select
+
+from src.database import add_missing_columns
+from src.models import (
+    Announcement,
+    AnnouncementReaction,
+    AnnouncementReadMark,
+    Stream,
+    StreamMembership,
+    User,
+)
+from src.reaction_counters import load_reaction_counts
+from src.read_state import (
+    load_read_map,
+    load_readers,
+    mark_read_up_to,
+    migrate_read_reactions,
+    set_read,
+    set_read_many,
+    unread_count_expression,
+)
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+@pytest_asyncio.fixture
+async def session():
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
+    await engine.dispose()
+
+
+async def seed(session: AsyncSession, count: int = 5):
+    teacher = User(email="teacher@example.com", name="先生", role="teacher")
+    student = User(email="student@example.com", name="生徒")
+    session.add_all([teacher, student])
+    await session.flush()
+
+    stream = Stream(name="1年A組", created_by=teacher.id)
+    session.add(stream)
+    await session.flush()
+
+    membership = StreamMembership(user_id=student.id, stream_id=stream.id)
+    session.add(membership)
+
+    start = datetime(2024, 4, 8, 8, 0, 0)
+    announcements = [
+        Announcement(
+            title=f"お知らせ{i}",
+            content="内容",
+            stream_id=stream.id,
+            created_by=teacher.id,
+            created_at=start + timedelta(minutes=i),
+        )
+        for i in range(count)
+    ]
+    session.add_all(announcements)
+    await session.commit()
+    return membership, announcements
+
+
+async def unread_count(session: AsyncSession, membership: StreamMembership) -> int:
+    statement = select(unread_count_expression()).where(
+        StreamMembership.id == membership.id
+    )
+    return (await session.execute(statement)).scalar_one()
+
+
+async def visible_unread_count(
+    session: AsyncSession, membership: StreamMembership, visible
+) -> int:
+    statement = select(unread_count_expression(visible)).where(
+        StreamMembership.id == membership.id
+    )
+    return (await session.execute(statement)).scalar_one()
+
+
+async def read_count(session: AsyncSession, announcement: Announcement) -> int:
+    counts = await load_reaction_counts(session, [announcement.id])
+    return counts.get(announcement.id, {}).get("read", 0)
+
+
+class TestReadState:
+    """Test cases for the read-state store"""
+
+    @pytest.mark.asyncio
+    async def test_everything_is_unread_without_watermark(self, session):
+        """Test that a fresh membership has every announcement unread"""
+        membership, announcements = await seed(session)
+        read_map = await load_read_map(session, membership, announcements)
+        assert not any(read_map.values())
+        assert await unread_count(session, membership) == 5
+
+    @pytest.mark.asyncio
+    async def test_out_of_order_reads_are_exceptions(self, session):
+        """Test reading a single announcement above the watermark"""
+        membership, announcements = await seed(session)
+        assert await set_read(session, membership, announcements[3], True)
+        assert not await set_read(session, membership, announcements[3], True)
+        await session.commit()
+
+        read_map = await load_read_map(session, membership, announcements)
+        assert [read_map[a.id] for a in announcements] == [
+            False,
+            False,
+            False,
+            True,
+            False,
+        ]
+        assert await unread_count(session, membership) == 4
+        assert await read_count(session, announcements[3]) == 1
+
+    @pytest.mark.asyncio
+    async def test_exceptions_follow_the_visibility_filter(self, session):
+        """Test that marks on hidden announcements do not change the count"""
+        membership, announcements = await seed(session)
+        hidden = announcements[3]
+        await set_read(session, membership, hidden, True)
+        await session.commit()
+
+        visible = Announcement.id != hidden.id
+        assert await visible_unread_count(session, membership, visible) == 4
+
+        await mark_read_up_to(session, membership, announcements[-1])
+        await set_read(session, membership, hidden, False)
+        await session.commit()
+        assert await visible_unread_count(session, membership, visible) == 0
+
+    @pytest.mark.asyncio
+    async def test_mark_read_up_to_advances_watermark(self, session):
+        """Test bulk marking, exception cleanup and counters"""
+        membership, announcements = await seed(session)
+        await set_read(session, membership, announcements[1], True)
+        await set_read(session, membership, announcements[4], True)
+
+        newly_read = await mark_read_up_to(session, membership, announcements[2])
+        await session.commit()
+
+        # announcements[1] は既読済みなので新たに既読になるのは 0, 2 の2件
+        assert newly_read == 2
+        assert membership.last_read_id == announcements[2].id
+        marks = (await session.execute(select(AnnouncementReadMark))).scalars().all()
+        assert [m.announcement_id for m in marks] == [announcements[4].id]
+        assert await unread_count(session, membership) == 1
+        for announcement in announcements:
+            assert await read_count(session, announcement) == (
+                0 if announcement is announcements[3] else 1
+            )
+
+    @pytest.mark.asyncio
+    async def test_set_read_many(self, session):
+        """Test batch reads on both sides of the watermark"""
+        membership, announcements = await seed(session)
+        await mark_read_up_to(session, membership, announcements[1])
+
+        # 0 は既読位置以前で既読のまま、2, 3 は例外として既読になる
+        changed = await set_read_many(session, membership, announcements[:4], True)
+        assert changed == [announcements[2].id, announcements[3].id]
+        # 1 を未読に戻し（例外）、2 を未読に戻す（例外を削除）
+        changed = await set_read_many(
+            session, membership, [announcements[1], announcements[2]], False
+        )
+        await session.commit()
+
+        assert changed == [announcements[1].id, announcements[2].id]
+        read_map = await load_read_map(session, membership, announcements)
+        assert [read_map[a.id] for a in announcements] == [
+            True,
+            False,
+            False,
+            True,
+            False,
+        ]
+        assert await unread_count(session, membership) == 3
+        assert [await read_count(session, a) for a in announcements] == [
+            1,
+            0,
+            0,
+            1,
+            0,
+        ]
+
+    @pytest.mark.asyncio
+    async def test_unread_below_watermark(self, session):
+        """Test marking an old announcement unread again"""
+        membership, announcements = await seed(session)
+        await mark_read_up_to(session, membership, announcements[-1])
+        await set_read(session, membership, announcements[0], False)
+        await session.commit()
+
+        assert await unread_count(session, membership) == 1
+        assert await read_count(session, announcements[0]) == 0
+
+        # 既読位置以前を指定しても既読位置は後退せず、未読の例外だけ解消される
+        assert await mark_read_up_to(session, membership, announcements[0]) == 1
+        assert membership.last_read_id == announcements[-1].id
+        assert await unread_count(session, membership) == 0
+
+    @pytest.mark.asyncio
+    async def test_readers(self, session):
+        """Test the teacher-side read/unread member split"""
+        membership, announcements = await seed(session)
+        await mark_read_up_to(session, membership, announcements[1])
+        await session.commit()
+
+        readers = await load_readers(session, membership.stream_id, announcements[0])
+        assert [r["name"] for r in readers["read"]] == ["生徒"]
+        readers = await load_readers(session, membership.stream_id, announcements[2])
+        assert [r["name"] for r in readers["unread"]] == ["生徒"]
+
+    @pytest.mark.asyncio
+    async def test_legacy_read_reactions_are_migrated(self, session):
+        """Test that old read reaction rows become read marks"""
+        membership, announcements = await seed(session)
+        session.add(
+            AnnouncementReaction(
+                announcement_id=announcements[2].id,
+                user_id=membership.user_id,
+                reaction_type="read",
+            )
+        )
+        await session.commit()
+
+        await migrate_read_reactions(session)
+        await session.commit()
+
+        remaining = await session.execute(select(AnnouncementReaction))
+        assert remaining.scalars().all() == []
+        read_map = await load_read_map(session, membership, announcements)
+        assert read_map[announcements[2].id] is True
+
+
+class TestAddMissingColumns:
+    """Test cases for upgrading a database created before the watermark columns"""
+
+    @pytest.mark.asyncio
+    async def test_adds_columns_to_existing_table(self):
+        engine = create_async_engine(TEST_DATABASE_URL)
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql(
+                "CREATE TABLE stream_memberships (id VARCHAR PRIMARY KEY, "
+                "user_id VARCHAR, stream_id VARCHAR, role VARCHAR, joined_at DATETIME)"
+            )
+            await conn.exec_driver_sql(
+                "INSERT INTO stream_memberships VALUES "
+                "('m1', 'u1', 's1', 'STUDENT', '2024-04-08 08:00:00')"
+            )
+            await conn.run_sync(SQLModel.metadata.create_all)
+            await conn.run_sync(add_missing_columns)
+            await conn.run_sync(add_missing_columns)
+
+            result = await conn.execute(
+                select(StreamMembership.last_read_at, StreamMembership.last_read_id)
+            )
+            assert result.all() == [(None, None)]
+        await engine.dispose()
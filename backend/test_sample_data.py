@@ -0,0 +1,203 @@
+"""
+Tests for one-time background sample-data seeding
+Run with: python -m pytest test_sample_data.py -v
+"""
+
+import asyncio
+from datetime import datetime
+
+import httpx
+import pytest
+import pytest_asyncio
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel
+
+from src import membership_resolver, sample_data
+from src.database import add_missing_columns, get_async_session
+from src.main import app
+from src.models import (
+    Assignment,
+    AssignmentLog,
+    AssignmentStatus,
+    Event,
+    Stream,
+    StreamMembership,
+    User,
+    UserRole,
+)
+from src.sample_data import join_default_streams, seed_user_sample_data
+
+
+class UnavailableRedis:
+    def pipeline(self, transaction=True):
+        raise ConnectionError("redis is down")
+
+
+@pytest_asyncio.fixture
+async def engine(tmp_path, monkeypatch):
+    monkeypatch.setattr(membership_resolver, "get_redis", UnavailableRedis)
+    # 同時実行を確かめるため、接続ごとに別のトランザクションを持てるファイルを使う
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'seed.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    yield engine
+    await engine.dispose()
+
+
+async def seed_user(engine, **fields):
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        owner = User(email="owner@example.com", name="管理者", role="teacher")
+        user = User(email="student@example.com", name="生徒", **fields)
+        session.add_all([owner, user])
+        await session.flush()
+        session.add_all(
+            Stream(name=name, created_by=owner.id) for name in ["1年A組", "全校", "部活"]
+        )
+        await session.commit()
+        return user
+
+
+async def count(engine, model, **filters):
+    async with AsyncSession(engine) as session:
+        statement = select(func.count()).select_from(model).filter_by(**filters)
+        return (await session.execute(statement)).scalar_one()
+
+
+@pytest.mark.asyncio
+async def test_seeds_once_in_a_single_transaction(engine):
+    user = await seed_user(engine)
+
+    async with AsyncSession(engine) as session:
+        result = await seed_user_sample_data(session, user.id)
+    assert result == {
+        "assignments_created": 4,
+        "assignment_logs_created": 4,
+        "events_created": 5,
+    }
+
+    async with AsyncSession(engine) as session:
+        assert await seed_user_sample_data(session, user.id) is None
+        seeded = await session.get(User, user.id)
+        assert seeded.sample_data_seeded_at is not None
+        statuses = (await session.execute(select(AssignmentLog.status))).scalars()
+        assert set(statuses) <= set(AssignmentStatus)
+    assert await count(engine, Assignment, created_by=user.id) == 4
+    assert await count(engine, Event, created_by=user.id) == 5
+
+
+@pytest.mark.asyncio
+async def test_concurrent_jobs_seed_once(engine):
+    user = await seed_user(engine)
+
+    async def job():
+        async with AsyncSession(engine) as session:
+            return await seed_user_sample_data(session, user.id)
+
+    results = await asyncio.gather(*(job() for _ in range(4)))
+    assert sum(result is not None for result in results) == 1
+    assert await count(engine, Assignment, created_by=user.id) == 4
+
+
+@pytest.mark.asyncio
+async def test_keeps_data_seeded_by_earlier_logins(engine):
+    user = await seed_user(engine)
+    async with AsyncSession(engine) as session:
+        session.add(
+            Assignment(
+                title="既存の課題",
+                subject="数学",
+                due_at=datetime.utcnow(),
+                created_by=user.id,
+            )
+        )
+        await session.commit()
+
+    async with AsyncSession(engine) as session:
+        result = await seed_user_sample_data(session, user.id)
+    assert result["assignments_created"] == 0
+    assert result["assignment_logs_created"] == 0
+    assert result["events_created"] == 5
+    assert await count(engine, Assignment, created_by=user.id) == 1
+
+
+@pytest.mark.asyncio
+async def test_joins_default_streams_once_before_seeding(engine):
+    user = await seed_user(engine)
+
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        assert await join_default_streams(session, user) == 2
+        assert await join_default_streams(session, user) == 0
+    assert await count(engine, StreamMembership, user_id=user.id) == 2
+
+    # 作成済みのユーザーがストリームを抜けても、次のログインで戻さない
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        await seed_user_sample_data(session, user.id)
+        seeded = await session.get(User, user.id)
+        await session.execute(
+            StreamMembership.__table__.delete().where(
+                StreamMembership.user_id == user.id
+            )
+        )
+        await session.commit()
+        assert await join_default_streams(session, seeded) == 0
+
+
+@pytest.mark.asyncio
+async def test_login_schedules_seeding_without_waiting(engine, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(sample_data, "SAMPLE_DATA_SEEDING", "celery")
+    monkeypatch.setattr(sample_data, "enqueue_sample_data", scheduled.append)
+
+    async def override_session():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    await seed_user(engine)
+    app.dependency_overrides[get_async_session] = override_session
+    try:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as client:
+            response = await client.post("/api/auth/super_admin/login")
+            assert response.status_code == 200
+            user_id = response.json()["user"]["id"]
+            assert scheduled == [user_id]
+            assert await count(engine, Assignment, created_by=user_id) == 0
+            # 既定のストリームにはトークンの発行前に参加している
+            assert await count(engine, StreamMembership, user_id=user_id) == 2
+
+            async with AsyncSession(engine) as session:
+                await seed_user_sample_data(session, user_id)
+            await client.post("/api/auth/super_admin/login")
+            assert scheduled == [user_id]
+    finally:
+        app.dependency_overrides.clear()
+
+    async with AsyncSession(engine) as session:
+        admin = await session.get(User, user_id)
+    assert admin.role == UserRole.SUPER_ADMIN
+
+
+@pytest.mark.asyncio
+async def test_seeds_users_created_before_the_flag_column(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'old.db'}")
+    async with engine.begin() as conn:
+        await conn.exec_driver_sql(
+            "CREATE TABLE users (id VARCHAR PRIMARY KEY, email VARCHAR, "
+            "name VARCHAR, picture_url VARCHAR, role VARCHAR, class_name VARCHAR, "
+            "grade INTEGER, student_number VARCHAR, "
+            "created_at DATETIME, updated_at DATETIME)"
+        )
+        await conn.exec_driver_sql(
+            "INSERT INTO users VALUES ('u1', 'old@example.com', '既存', NULL, "
+            "'STUDENT', NULL, NULL, NULL, '2024-04-08 08:00:00', "
+            "'2024-04-08 08:00:00')"
+        )
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+
+    async with AsyncSession(engine) as session:
+        assert (await seed_user_sample_data(session, "u1")) is not None
+    assert await count(engine, Assignment, created_by="u1") > 0
+    await engine.dispose()
@@ -0,0 +1,164 @@
+"""
+Tests for the announcement search index
+Run with: python -m pytest test_search_service.py -v
+"""
+
+import json
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel
+
+from src.models import Announcement
+from src.search_service import (
+    PostgresSearchBackend,
+    SearchHit,
+    SQLiteFTS5Backend,
+    load_ranked_announcements,
+    make_snippet,
+    ngram_tokens,
+    query_terms,
+)
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+@pytest_asyncio.fixture
+async def backend_session():
+    engine = create_async_engine(TEST_DATABASE_URL)
+    backend = SQLiteFTS5Backend()
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await backend.ensure_schema(conn)
+
+    async with AsyncSession(engine) as session:
+        yield backend, session
+    await engine.dispose()
+
+
+def make_announcement(announcement_id, title, content, stream_id="s1", tags=None):
+    return Announcement(
+        id=announcement_id,
+        title=title,
+        content=content,
+        stream_id=stream_id,
+        tags=json.dumps(tags) if tags else None,
+        created_by="teacher",
+    )
+
+
+class TestTokenization:
+    """Test cases for character n-gram tokenization"""
+
+    def test_japanese_text_is_split_into_bigrams(self):
+        """Test that unspaced Japanese text becomes bigrams"""
+        assert ngram_tokens("数学部") == ["数学", "学部", "部"]
+
+    def test_width_and_case_are_normalized(self):
+        """Test that full-width and upper-case letters are folded"""
+        assert ngram_tokens("ＡＢ") == ngram_tokens("ab")
+
+    def test_punctuation_splits_runs(self):
+        """Test that bigrams never span punctuation or spaces"""
+        assert ngram_tokens("明日、集会") == ["明日", "日", "集会", "会"]
+
+    def test_query_terms(self):
+        """Test phrase and prefix query terms"""
+        assert query_terms("体育祭 a") == [(["体育", "育祭"], False), (["a"], True)]
+
+
+class TestSnippet:
+    """Test cases for server-side snippets"""
+
+    def test_highlight_points_at_match(self):
+        """Test that highlight offsets cover the matched text"""
+        snippet = make_snippet("明日の体育祭は雨天のため延期します。", "体育祭")
+        start, end = snippet.highlights[0]
+        assert snippet.text[start:end] == "体育祭"
+
+    def test_long_text_is_windowed(self):
+        """Test that long content is trimmed around the first match"""
+        content = "あ" * 200 + "期末試験" + "い" * 200
+        snippet = make_snippet(content, "期末試験", width=40)
+        assert snippet.text.startswith("…") and snippet.text.endswith("…")
+        start, end = snippet.highlights[0]
+        assert snippet.text[start:end] == "期末試験"
+
+
+class TestSQLiteFTS5Backend:
+    """Test cases for the SQLite FTS5 backend"""
+
+    @pytest.mark.asyncio
+    async def test_substring_match_without_spaces(self, backend_session):
+        """Test that Japanese words are found inside unspaced text"""
+        backend, session = backend_session
+        await backend.index_announcement(
+            session, make_announcement("a1", "お知らせ", "明日の体育祭は延期します")
+        )
+        await backend.index_announcement(
+            session, make_announcement("a2", "お知らせ", "文化祭の準備を始めます")
+        )
+
+        hits = await backend.search(session, "体育祭", ["s1"])
+        assert [hit.announcement_id for hit in hits] == ["a1"]
+
+        hits = await backend.search(session, "祭", ["s1"])
+        assert {hit.announcement_id for hit in hits} == {"a1", "a2"}
+
+    @pytest.mark.asyncio
+    async def test_title_matches_rank_higher(self, backend_session):
+        """Test that a title hit outranks a body hit"""
+        backend, session = backend_session
+        await backend.index_announcement(
+            session, make_announcement("body", "連絡", "数学の小テストがあります")
+        )
+        await backend.index_announcement(
+            session, make_announcement("title", "数学の連絡", "小テストがあります")
+        )
+
+        hits = await backend.search(session, "数学", ["s1"])
+        assert [hit.announcement_id for hit in hits] == ["title", "body"]
+
+    @pytest.mark.asyncio
+    async def test_stream_filter_update_and_remove(self, backend_session):
+        """Test stream scoping, re-indexing and removal"""
+        backend, session = backend_session
+        announcement = make_announcement("a1", "部活", "集合", tags=["数学"])
+        await backend.index_announcement(session, announcement)
+        await backend.index_announcement(
+            session, make_announcement("a2", "部活", "集合", stream_id="s2")
+        )
+
+        assert [
+            h.announcement_id for h in await backend.search(session, "数学", ["s1"])
+        ] == ["a1"]
+        assert await backend.search(session, "数学", ["s2"]) == []
+
+        announcement.tags = json.dumps(["英語"])
+        await backend.index_announcement(session, announcement)
+        assert await backend.search(session, "数学", ["s1"]) == []
+
+        await backend.remove_announcement(session, "a1")
+        assert await backend.search(session, "部活", ["s1"]) == []
+
+    @pytest.mark.asyncio
+    async def test_orphaned_hits_keep_scores_aligned(self, backend_session):
+        """Test that a hit without a row does not shift later scores"""
+        _, session = backend_session
+        session.add_all(
+            [
+                make_announcement("a1", "お知らせ", "本文"),
+                make_announcement("a3", "お知らせ", "本文"),
+            ]
+        )
+        await session.flush()
+
+        hits = [SearchHit("a1", 3.0), SearchHit("orphan", 2.0), SearchHit("a3", 1.0)]
+        ranked = await load_ranked_announcements(session, hits)
+        assert [(hit.score, a.id) for hit, a in ranked] == [(3.0, "a1"), (1.0, "a3")]
+
+
+def test_postgres_tsquery():
+    """Test tsquery generation for the PostgreSQL backend"""
+    assert PostgresSearchBackend.build_tsquery("体育祭 a") == "('体育' <-> '育祭') & 'a':*"
@@ -0,0 +1,92 @@
+"""
+Tests for per-worker stream event fan-out
+Run with: python -m pytest test_stream_events.py -v
+"""
+
+import asyncio
+import json
+
+from src.announcement_targets import Audience
+from src.stream_events import (
+    SUBSCRIBER_QUEUE_SIZE,
+    StreamEventHub,
+    channel_for,
+    event_for_audience,
+    format_sse,
+)
+
+
+class TestStreamEventHub:
+    def test_dispatch_reaches_only_stream_subscribers(self):
+        hub = StreamEventHub()
+        queue_a = asyncio.Queue()
+        queue_b = asyncio.Queue()
+        hub.subscribers = {"stream-a": {queue_a}, "stream-b": {queue_b}}
+
+        hub.dispatch(channel_for("stream-a"), '{"type": "announcement:new"}')
+
+        assert queue_a.get_nowait() == '{"type": "announcement:new"}'
+        assert queue_b.empty()
+
+    def test_full_queue_drops_events(self):
+        hub = StreamEventHub()
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        hub.subscribers = {"stream-a": {queue}}
+
+        for i in range(SUBSCRIBER_QUEUE_SIZE + 5):
+            hub.dispatch(channel_for("stream-a"), str(i))
+
+        assert queue.qsize() == SUBSCRIBER_QUEUE_SIZE
+        assert queue.get_nowait() == "0"
+
+    def test_unsubscribe_removes_empty_stream(self):
+        hub = StreamEventHub()
+        queue = asyncio.Queue()
+        hub.subscribers = {"stream-a": {queue}}
+
+        hub.unsubscribe("stream-a", queue)
+        hub.unsubscribe("stream-a", queue)
+
+        assert hub.subscribers == {}
+
+
+class TestFormatSSE:
+    def test_event_frame(self):
+        assert format_sse("reaction:delta", '{"delta": 1}') == (
+            'event: reaction:delta\ndata: {"delta": 1}\n\n'
+        )
+
+
+class TestEventForAudience:
+    def message(self, event_type, targets=None):
+        event = {"type": event_type, "stream_id": "s1", "data": {"id": "a1"}}
+        if targets:
+            event["targets"] = targets
+        return json.dumps(event)
+
+    def test_untargeted_events_pass_through(self):
+        message = self.message("announcement:new")
+        student = Audience(grade=1, class_name="A")
+        assert event_for_audience(message, student) == ("announcement:new", message)
+
+    def test_targeted_events_reach_only_their_audience(self):
+        message = self.message("announcement:new", {"grades": [2], "classes": []})
+
+        event_type, data = event_for_audience(message, Audience(2, "B"))
+        assert event_type == "announcement:new"
+        assert "targets" not in json.loads(data)
+        assert event_for_audience(message, Audience(1, "A")) is None
+        # 教員とストリームの管理者には対象に関わらず送る
+        assert event_for_audience(message, None) is not None
+        assert event_for_audience(message, Audience(1, "A", ("s1",))) is not None
+
+    def test_update_that_excludes_the_viewer_becomes_delete(self):
+        message = self.message("announcement:update", {"grades": [], "classes": ["B"]})
+
+        event_type, data = event_for_audience(message, Audience(1, "A"))
+        assert event_type == "announcement:delete"
+        assert json.loads(data) == {
+            "type": "announcement:delete",
+            "stream_id": "s1",
+            "data": {"id": "a1"},
+        }
@@ -0,0 +1,300 @@
+"""
+Tests for bulk stream membership import
+Run with: python -m pytest test_stream_members.py -v
+"""
+
+from datetime import datetime
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel, func, select
+
+from src import stream_members
+from src.database import create_missing_indexes
+from src.models import AnnouncementReadMark, Stream, StreamMembership, StreamRole, User
+from src.stream_members import (
+    MEMBER_ORDER,
+    MemberRow,
+    encode_member_cursor,
+    import_memberships,
+    iter_csv_members,
+    member_filter_condition,
+    member_keyset_condition,
+    merge_duplicate_memberships,
+)
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+@pytest_asyncio.fixture
+async def engine():
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    yield engine
+    await engine.dispose()
+
+
+async def chunked(data: bytes, size: int):
+    for i in range(0, len(data), size):
+        yield data[i : i + size]
+
+
+async def rows(*members):
+    for row, (email, role) in enumerate(members, 1):
+        yield MemberRow(row=row, email=email, role=role)
+
+
+async def seed(session: AsyncSession, students: int):
+    teacher = User(email="teacher@example.com", name="先生", role="teacher")
+    session.add(teacher)
+    session.add_all(
+        User(email=f"student{i}@example.com", name=f"生徒{i}") for i in range(students)
+    )
+    await session.flush()
+    stream = Stream(name="全校", created_by=teacher.id)
+    session.add(stream)
+    await session.flush()
+    session.add(
+        StreamMembership(user_id=teacher.id, stream_id=stream.id, role=StreamRole.ADMIN)
+    )
+    await session.commit()
+    return stream
+
+
+class TestCSVParsing:
+    """Test cases for incremental CSV parsing"""
+
+    @pytest.mark.asyncio
+    async def test_rows_split_across_chunks(self):
+        data = "﻿email,role\r\na@example.com,admin\r\nb@example.com\r\n\r\n"
+        members = [m async for m in iter_csv_members(chunked(data.encode(), 3))]
+
+        assert [(m.row, m.email, m.role) for m in members] == [
+            (1, "a@example.com", "admin"),
+            (2, "b@example.com", None),
+        ]
+
+    @pytest.mark.asyncio
+    async def test_overlong_line_is_rejected(self):
+        data = b"x" * (stream_members.MAX_CSV_LINE_LENGTH + 10)
+        with pytest.raises(ValueError):
+            async for _ in iter_csv_members(chunked(data, 1024)):
+                pass
+
+
+class TestImportMemberships:
+    """Test cases for batched membership upserts"""
+
+    @pytest.mark.asyncio
+    async def test_report_per_row(self, engine):
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            stream = await seed(session, 2)
+            report = await import_memberships(
+                session,
+                stream.id,
+                rows(
+                    ("student0@example.com", None),
+                    ("student1@example.com", "stream_admin"),
+                    ("student0@example.com", None),
+                    ("teacher@example.com", None),
+                    ("nobody@example.com", None),
+                    ("student1", "boss"),
+                ),
+            )
+            await session.commit()
+
+            result = await session.execute(
+                select(StreamMembership.role).where(
+                    StreamMembership.stream_id == stream.id
+                )
+            )
+            roles = sorted(result.scalars().all())
+
+        assert [r["status"] for r in report["results"]] == [
+            "added",
+            "added",
+            "duplicate",
+            "already_member",
+            "user_not_found",
+            "invalid",
+        ]
+        assert report["summary"]["added"] == 2
+        assert roles == ["admin", "stream_admin", "student"]
+        assert len(report["added_user_ids"]) == 2
+        assert all("user_id" not in r for r in report["results"])
+
+    @pytest.mark.asyncio
+    async def test_queries_per_batch(self, engine, monkeypatch):
+        """Test that each batch resolves users and inserts in two statements"""
+        monkeypatch.setattr(stream_members, "MEMBERSHIP_IMPORT_BATCH_SIZE", 10)
+        statements = []
+        event.listen(
+            engine.sync_engine,
+            "before_cursor_execute",
+            lambda *args: statements.append(args[2]),
+        )
+
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            stream = await seed(session, 25)
+            statements.clear()
+            report = await import_memberships(
+                session,
+                stream.id,
+                rows(*((f"student{i}@example.com", None) for i in range(25))),
+            )
+
+        assert report["summary"]["added"] == 25
+        assert len(statements) == 6
+
+
+class TestMergeDuplicateMemberships:
+    """Test cases for the manual duplicate cleanup"""
+
+    @pytest.mark.asyncio
+    async def test_keeps_highest_role_and_moves_read_state(self):
+        engine = create_async_engine(TEST_DATABASE_URL)
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+            await conn.exec_driver_sql("DROP INDEX ux_stream_memberships_user_stream")
+            for membership_id, role, day, last_read_id in (
+                ("m1", StreamRole.STUDENT, 1, "a2"),
+                ("m2", StreamRole.STREAM_ADMIN, 3, None),
+                ("m3", StreamRole.STREAM_ADMIN, 2, None),
+            ):
+                await conn.execute(
+                    StreamMembership.__table__.insert().values(
+                        id=membership_id,
+                        user_id="u1",
+                        stream_id="s1",
+                        role=role,
+                        joined_at=datetime(2024, 4, day),
+                        last_read_at=datetime(2024, 5, 1) if last_read_id else None,
+                        last_read_id=last_read_id,
+                    )
+                )
+            await conn.execute(
+                AnnouncementReadMark.__table__.insert().values(
+                    membership_id="m1", announcement_id="a3", is_read=True
+                )
+            )
+
+            # 重複がある間、起動時のインデックス作成は見送られる（データは消さない）
+            await conn.run_sync(create_missing_indexes)
+            assert (
+                await conn.execute(select(func.count(StreamMembership.id)))
+            ).scalar_one() == 3
+
+            assert await merge_duplicate_memberships(conn) == 2
+            await conn.run_sync(create_missing_indexes)
+
+            survivor = (await conn.execute(select(StreamMembership.__table__))).one()
+            assert (survivor.id, survivor.role) == ("m3", StreamRole.STREAM_ADMIN)
+            assert survivor.last_read_id == "a2"
+            marks = await conn.execute(select(AnnouncementReadMark.__table__))
+            assert [(m.membership_id, m.announcement_id) for m in marks] == [
+                ("m3", "a3")
+            ]
+        await engine.dispose()
+
+
+class TestCreateMissingIndexes:
+    """Test cases for index creation on existing databases"""
+
+    @pytest.mark.asyncio
+    async def test_errors_other_than_duplicates_are_raised(self):
+        engine = create_async_engine(TEST_DATABASE_URL)
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+            await conn.exec_driver_sql(
+                "DROP INDEX ux_stream_memberships_stream_ordinal"
+            )
+            await conn.exec_driver_sql(
+                "ALTER TABLE stream_memberships DROP COLUMN ordinal"
+            )
+
+            with pytest.raises(OperationalError, match="ordinal"):
+                await conn.run_sync(create_missing_indexes)
+        await engine.dispose()
+
+
+class TestMemberListing:
+    """Test cases for filtered, keyset-paginated member listing"""
+
+    async def list_members(self, session, stream_id, cursor=None, limit=3, **filters):
+        statement = (
+            select(User.name)
+            .join(StreamMembership, StreamMembership.user_id == User.id)
+            .where(member_filter_condition(stream_id, **filters))
+        )
+        if cursor:
+            statement = statement.where(member_keyset_condition(cursor))
+        statement = statement.order_by(*MEMBER_ORDER).limit(limit)
+        return (await session.execute(statement)).scalars().all()
+
+    @pytest.mark.asyncio
+    async def test_keyset_pages_cover_all_members(self, engine):
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            stream = await seed(session, 7)
+            await import_memberships(
+                session,
+                stream.id,
+                rows(*((f"student{i}@example.com", None) for i in range(7))),
+            )
+            await session.commit()
+
+            names, cursor = [], None
+            while True:
+                page = await self.list_members(session, stream.id, cursor)
+                names.extend(page)
+                if len(page) < 3:
+                    break
+                last = (
+                    await session.execute(select(User).where(User.name == page[-1]))
+                ).scalar_one()
+                cursor = encode_member_cursor(last)
+
+        assert names == sorted(names)
+        assert len(names) == len(set(names)) == 8
+
+    @pytest.mark.asyncio
+    async def test_filters(self, engine):
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            stream = await seed(session, 3)
+            students = (
+                (await session.execute(select(User).where(User.name.startswith("生徒"))))
+                .scalars()
+                .all()
+            )
+            for i, student in enumerate(students):
+                student.grade = 1 + i % 2
+                student.class_name = f"{student.grade}年A組"
+            await import_memberships(
+                session,
+                stream.id,
+                rows(*((s.email, None) for s in students)),
+            )
+            await session.commit()
+
+            by_role = await self.list_members(
+                session, stream.id, limit=10, role=StreamRole.ADMIN
+            )
+            by_grade = await self.list_members(session, stream.id, limit=10, grade=2)
+            by_class = await self.list_members(
+                session, stream.id, limit=10, class_name="1年A組"
+            )
+            by_prefix = await self.list_members(session, stream.id, limit=10, q="teach")
+            escaped = await self.list_members(session, stream.id, limit=10, q="%")
+
+        assert by_role == ["先生"]
+        assert len(by_grade) == 1
+        assert len(by_class) == 2
+        assert by_prefix == ["先生"]
+        assert escaped == []
+
+    def test_invalid_cursor_is_rejected(self):
+        with pytest.raises(ValueError):
+            member_keyset_condition("not-a-cursor")
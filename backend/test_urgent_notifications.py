@@ -0,0 +1,188 @@
+"""
+Tests for chunked urgent-announcement notifications
+Run with: python -m pytest test_urgent_notifications.py -v
+"""
+
+import asyncio
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel, select
+
+from src import database
+from src.announcement_targets import set_announcement_targets
+from src.models import Announcement, Stream, StreamMembership, User
+from src.urgent_notifications import (
+    NotificationDeliveryError,
+    deliver_chunk,
+    fan_out_notification,
+    plan_notification_chunks,
+)
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    async def exists(self, key):
+        return int(key in self.data)
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+
+class FakeMailer:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.sent = []
+
+    def __call__(self, to_email, subject, body, html_body=None):
+        if to_email in self.failing:
+            return False
+        self.sent.append((to_email, subject))
+        return True
+
+
+@pytest_asyncio.fixture
+async def session():
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
+    await engine.dispose()
+
+
+async def seed(session: AsyncSession, students: int = 7):
+    teacher = User(email="teacher@example.com", name="先生", role="teacher")
+    session.add(teacher)
+    await session.flush()
+    stream = Stream(name="1年", created_by=teacher.id)
+    session.add(stream)
+    await session.flush()
+
+    users = [
+        User(
+            email=f"s{i}@example.com",
+            name=f"生徒{i}",
+            grade=1,
+            class_name="1年A組" if i % 2 == 0 else "1年B組",
+        )
+        for i in range(students)
+    ]
+    session.add_all(users)
+    await session.flush()
+    session.add(StreamMembership(user_id=teacher.id, stream_id=stream.id))
+    session.add_all(
+        StreamMembership(user_id=user.id, stream_id=stream.id) for user in users
+    )
+    announcement = Announcement(
+        title="休校",
+        content="本日は休校です",
+        stream_id=stream.id,
+        created_by=teacher.id,
+        is_urgent=True,
+    )
+    session.add(announcement)
+    await session.commit()
+    return announcement
+
+
+@pytest.mark.asyncio
+async def test_chunks_cover_memberships_once(session):
+    announcement = await seed(session)
+    chunks = await plan_notification_chunks(session, announcement.stream_id, 3)
+
+    assert [after for after, _ in chunks][0] is None
+    assert [after for after, _ in chunks[1:]] == [last for _, last in chunks[:-1]]
+    assert len(chunks) == 3  # 8 メンバーを 3 件ずつ
+
+
+@pytest.mark.asyncio
+async def test_fan_out_runs_once(session):
+    announcement = await seed(session)
+    client = FakeRedis()
+    enqueued = []
+
+    count = await fan_out_notification(
+        session, client, announcement.id, enqueued.append, chunk_size=3
+    )
+    again = await fan_out_notification(
+        session, client, announcement.id, enqueued.append, chunk_size=3
+    )
+
+    assert count == 3
+    assert again == 0
+    assert len(enqueued) == 3
+
+
+@pytest.mark.asyncio
+async def test_deliver_skips_author_and_respects_audience(session):
+    announcement = await seed(session)
+    await set_announcement_targets(session, announcement, classes=["1年A組"])
+    await session.commit()
+    client = FakeRedis()
+    mailer = FakeMailer()
+
+    for chunk in await plan_notification_chunks(session, announcement.stream_id, 3):
+        await deliver_chunk(session, client, announcement.id, chunk, mailer)
+
+    assert sorted(email for email, _ in mailer.sent) == [
+        "s0@example.com",
+        "s2@example.com",
+        "s4@example.com",
+        "s6@example.com",
+    ]
+    assert all(subject == "【緊急】1年: 休校" for _, subject in mailer.sent)
+
+
+@pytest.mark.asyncio
+async def test_retry_does_not_send_twice(session):
+    announcement = await seed(session, students=4)
+    client = FakeRedis()
+    chunk = (await plan_notification_chunks(session, announcement.stream_id, 10))[0]
+
+    flaky = FakeMailer(failing={"s1@example.com"})
+    with pytest.raises(NotificationDeliveryError):
+        await deliver_chunk(session, client, announcement.id, chunk, flaky)
+    assert len(flaky.sent) == 3
+
+    retry = FakeMailer()
+    summary = await deliver_chunk(session, client, announcement.id, chunk, retry)
+    assert summary == {"sent": 1, "skipped": 3, "failed": 0}
+    assert [email for email, _ in retry.sent] == ["s1@example.com"]
+
+    # 完了した範囲は再実行しても何もしない
+    summary = await deliver_chunk(session, client, announcement.id, chunk, retry)
+    assert summary == {"sent": 0, "skipped": 0, "failed": 0}
+
+
+def test_task_sessions_work_across_event_loops(tmp_path, monkeypatch):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'tasks.db'}"
+    monkeypatch.setattr(database, "DATABASE_URL", url)
+
+    async def create_tables():
+        engine = create_async_engine(url)
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        await engine.dispose()
+
+    async def add_user(email):
+        async with database.task_sessions() as sessions, sessions() as session:
+            session.add(User(email=email, name="生徒"))
+            await session.commit()
+            return len((await session.execute(select(User.id))).all())
+
+    # Celery のタスクは実行ごとに asyncio.run で新しいイベントループを使う
+    asyncio.run(create_tables())
+    assert asyncio.run(add_user("a@example.com")) == 1
+    assert asyncio.run(add_user("b@example.com")) == 2
@@ -0,0 +1,107 @@
+"""
+Tests for the two-level authenticated user cache
+Run with: python -m pytest test_user_cache.py -v
+"""
+
+import pytest
+import pytest_asyncio
+from fastapi.security import HTTPAuthorizationCredentials
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel
+
+from src import auth
+from src.auth import auth_manager, get_current_user
+from src.metrics import metrics
+from src.models import User
+from src.user_cache import LocalUserCache, UserCache
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+@pytest_asyncio.fixture
+async def engine(monkeypatch):
+    monkeypatch.setattr(auth, "user_cache", UserCache(LocalUserCache(), False))
+    metrics.reset()
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    yield engine
+    await engine.dispose()
+
+
+def count_selects(engine):
+    statements = []
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def record(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+
+    return statements
+
+
+def credentials_for(user: User) -> HTTPAuthorizationCredentials:
+    token = auth_manager.create_access_token(data={"sub": user.id})
+    return HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+
+async def create_user(engine) -> User:
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        user = User(email="s@example.com", name="生徒", grade=1)
+        session.add(user)
+        await session.commit()
+        return user
+
+
+def test_local_cache_expires_and_evicts(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("src.user_cache.time.monotonic", lambda: now[0])
+    cache = LocalUserCache(max_entries=2, ttl_seconds=5)
+    cache.set("a", {"id": "a"})
+    cache.set("b", {"id": "b"})
+    cache.get("a")
+    cache.set("c", {"id": "c"})
+
+    assert cache.get("b") is None  # 最も古く使われたものから追い出す
+    assert cache.get("a") == {"id": "a"}
+    now[0] += 6
+    assert cache.get("a") is None
+
+
+@pytest.mark.asyncio
+async def test_second_lookup_skips_database(engine):
+    user = await create_user(engine)
+    credentials = credentials_for(user)
+    selects = count_selects(engine)
+
+    async with AsyncSession(engine) as session:
+        first = await get_current_user(credentials, session)
+    async with AsyncSession(engine) as session:
+        second = await get_current_user(credentials, session)
+        assert second.name == first.name == "生徒"
+        assert second.grade == 1
+
+    assert len(selects) == 1
+    assert metrics.get("user_cache.miss") == 1
+    assert metrics.get("user_cache.local_hit") == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_user_can_be_updated_and_invalidated(engine):
+    user = await create_user(engine)
+    credentials = credentials_for(user)
+    async with AsyncSession(engine) as session:
+        await get_current_user(credentials, session)
+
+    async with AsyncSession(engine) as session:
+        cached = await get_current_user(credentials, session)
+        cached.name = "新しい名前"
+        session.add(cached)
+        await session.commit()
+    await auth.user_cache.invalidate(user.id)
+
+    async with AsyncSession(engine) as session:
+        refreshed = await get_current_user(credentials, session)
+        assert refreshed.name == "新しい名前"
+    assert metrics.get("user_cache.miss") == 2